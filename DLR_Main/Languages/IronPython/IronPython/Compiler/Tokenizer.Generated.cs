@@ -148,5 +148,15 @@ namespace IronPython.Compiler {
 
             return null;
         }
+
+        #region Generated Tokenize Op Table
+
+        // *** BEGIN GENERATED CODE ***
+        // generated by function: tokenize_table_region_generator from: generate_ops.py
+
+
+        // *** END GENERATED CODE ***
+
+        #endregion
     }
 }
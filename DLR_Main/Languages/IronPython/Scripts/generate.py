@@ -16,6 +16,9 @@
 import re
 import sys
 import nt
+import time
+import hashlib
+import threading
 
 def get_parent_directory(path, levels=1):
     while levels:
@@ -163,6 +166,16 @@ class CodeWriter:
     def text(self):
         return '\n'.join(self.lines)
 
+    # Appends the lines to the list of strings out, each after a newline and
+    # indent if should_indent says so, so that a whole file can be built with
+    # one join instead of concatenating its text line by line.
+    def render(self, out, indent):
+        for line in self.lines:
+            out.append("\n")
+            if should_indent(line):
+                out.append(indent)
+            out.append(line)
+
     def conditions(self):
         return ConditionWriter(self)
 
@@ -261,33 +274,271 @@ class BlockReplacer:
         return None
     
     def replace(self, cw, text, indent):
-        code = cw.lines
-        code.insert(0, self.start)
-        code.append(self.end)
-        
-        def should_indent(line):
-            if not line: return False
-            if line.startswith("#region"): return True
-            if line.startswith("#endregion"): return True
-            if line.startswith("#"): return False
-            return True
-        
-       #code_text = '\n' + indent
-        code_text = indent[0]
-        delim = False
-        for line in code:
-            if delim:
-                code_text += "\n"
-                if should_indent(line):
-                    code_text += indent[0]
-            code_text += line
-            delim = True
-        
-        #return self.block_pat.sub(code_text, text)
-        #indicies = self.match(text)
-        
-        res = text[0:indent[1]] + code_text + text[indent[2]:len(text)]
-        return res
+        # Build the new text as a list of pieces and join it once, since
+        # adding to a string line by line is quadratic for large regions.
+        out = [text[0:indent[1]], indent[0], self.start]
+        cw.render(out, indent[0])
+        out.append("\n")
+        if should_indent(self.end):
+            out.append(indent[0])
+        out.append(self.end)
+        out.append(text[indent[2]:len(text)])
+        return "".join(out)
+
+def should_indent(line):
+    if not line: return False
+    if line.startswith("#region"): return True
+    if line.startswith("#endregion"): return True
+    if line.startswith("#"): return False
+    return True
+
+# Scans the source directories once and maps the name of every
+# '#region Generated' block to the files that contain it.  It keeps the text
+# of those files, so each is read once however many generators use it.
+class SourceIndex:
+    def __init__(self):
+        self.regions = {}   # region name -> [(filename, offset), ...]
+        self.texts = {}     # filename -> text, for files with regions
+        self.order = {}     # filename -> position in scan order
+        self.scanned = 0
+
+    def scan(self):
+        for src_dir in source_directories:
+            self.scan_dir(src_dir)
+
+    def scan_dir(self, dirname):
+        if dirname.lower() in exclude_directories:
+            return
+        for file in listdir(dirname):
+            filename = pathjoin(dirname, file)
+            if isdir(filename):
+                self.scan_dir(filename)
+            elif filename.endswith(".cs"):
+                self.scan_file(filename)
+
+    def scan_file(self, filename):
+        thefile = open(filename)
+        text = thefile.read()
+        thefile.close()
+        self.scanned += 1
+
+        marker = START % ""
+        offset = text.find(marker)
+        if offset == -1:
+            return
+        self.texts[filename] = text
+        self.order[filename] = len(self.order)
+        while offset != -1:
+            start = offset + len(marker)
+            end = text.find('\n', start)
+            if end == -1:
+                end = len(text)
+            name = text[start:end].rstrip('\r')
+            self.regions.setdefault(name, []).append((filename, offset))
+            offset = text.find(marker, end)
+
+    # Returns the files, in scan order, that BlockReplacer(name) matches.  Like
+    # BlockReplacer.match, this matches regions whose name starts with name.
+    def find(self, name):
+        files = {}
+        for region, places in self.regions.iteritems():
+            if region.startswith(name):
+                for filename, offset in places:
+                    files[filename] = True
+        return sorted(files, key=self.order.get)
+
+# Applies every generator's replacement for one file to its text in memory,
+# then writes the file (or its .diff in check-only mode) once.  It collects
+# its messages in log so that files generated on different threads do not
+# interleave their output.
+#
+# With a GeneratorCache, a region whose generator source and text are the same
+# as when the cache last recorded them is left alone without running the
+# generator.  With times, the seconds each generator took are added to
+# times[name] under times_lock.
+class SourceFile:
+    def __init__(self, filename, text):
+        self.filename = filename
+        self.text = text
+        self.generators = []
+        self.log = []
+
+    def add(self, name, generator):
+        self.generators.append((name, generator))
+
+    def generate(self, cache=None, times=None, times_lock=None):
+        checkonly = sys.argv.count('checkonly') > 0
+        text = self.text
+        result = []
+        generated = []
+        for name, generator in self.generators:
+            message = "generate "
+            if checkonly:
+                message += "(check-only) "
+            message += "%s [%s] ... " % (self.filename, name)
+
+            replacer = BlockReplacer(name)
+            if cache is not None:
+                key = cache.generator_key(generator)
+                if cache.unchanged(self.filename, name, key,
+                                   region_text(replacer, text)):
+                    self.log.append(message + "ok (cached)")
+                    result.append(True)
+                    continue
+
+            start = time.clock()
+            g = FileGenerator(self.filename, generator, replacer, text)
+            new_text = g.render()
+            if times is not None:
+                times_lock.acquire()
+                try:
+                    times[name] = times.get(name, 0) + time.clock() - start
+                finally:
+                    times_lock.release()
+
+            if new_text == text:
+                message += "ok"
+                result.append(True)
+            elif checkonly:
+                message += "different!"
+                result.append(False)
+            else:
+                message += "updated"
+                result.append(True)
+            self.log.append(message)
+            text = new_text
+            if cache is not None:
+                generated.append((name, key, region_text(replacer, text)))
+
+        if text != self.text:
+            if checkonly:
+                name = self.filename + ".diff"
+                self.log.append("    generated file saved as: " + name)
+                save_file(name, text)
+                # The file still has the old regions.
+                generated = []
+            else:
+                if sys.argv.count('checkout') > 0:
+                    nt.spawnl(0, "tf.exe", "tf.exe", "edit", self.filename)
+                save_file(self.filename, text)
+        for name, key, region in generated:
+            cache.update(self.filename, name, key, region)
+        return result
+
+def region_text(replacer, text):
+    indent = replacer.match(text)
+    return text[indent[1]:indent[2]]
+
+# Remembers, for each file and region name, a hash of the generator's source
+# and of the region's text after the generator last ran, in cache_file between
+# runs.  The generator's source is the file it is defined in plus this file,
+# so a region is regenerated when either changes or someone edits the region.
+# Generators whose output depends on anything else, such as the assemblies
+# they reflect over, need to run without 'cached' when that changes.
+class GeneratorCache:
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}   # (file, region name) -> (generator key, hash)
+        self.keys = {}      # source file -> hash
+        self.lock = threading.Lock()
+
+    def load(self):
+        try:
+            f = open(self.filename)
+        except IOError:
+            return
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) == 4:
+                self.entries[(fields[0], fields[1])] = (fields[2], fields[3])
+        f.close()
+
+    def save(self):
+        f = open(self.filename, 'w')
+        for (filename, name), (key, digest) in sorted(self.entries.items()):
+            f.write('\t'.join([filename, name, key, digest]) + '\n')
+        f.close()
+
+    def generator_key(self, generator):
+        return self.file_hash(generator.func_code.co_filename) + \
+               self.file_hash(__file__)
+
+    def file_hash(self, filename):
+        self.lock.acquire()
+        try:
+            if filename not in self.keys:
+                f = open(filename)
+                self.keys[filename] = hashlib.md5(f.read()).hexdigest()
+                f.close()
+            return self.keys[filename]
+        finally:
+            self.lock.release()
+
+    def unchanged(self, filename, name, key, region):
+        digest = hashlib.md5(region).hexdigest()
+        return self.entries.get((filename, name)) == (key, digest)
+
+    def update(self, filename, name, key, region):
+        digest = hashlib.md5(region).hexdigest()
+        self.lock.acquire()
+        try:
+            self.entries[(filename, name)] = (key, digest)
+        finally:
+            self.lock.release()
+
+# Runs generate on each SourceFile in sources, on threads if parallel, and
+# returns their results in the order of sources.  Files are independent, so
+# threads can work on different ones; IronPython runs them at the same time
+# since it has no global interpreter lock.
+def generate_files(sources, cache, times, parallel):
+    times_lock = threading.Lock()
+    if not parallel:
+        result = []
+        for source in sources:
+            result.extend(source.generate(cache, times, times_lock))
+            print "\n".join(source.log)
+        return result
+
+    results = [None] * len(sources)
+    errors = []
+    todo = range(len(sources))
+    todo.reverse()
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            lock.acquire()
+            try:
+                if not todo or errors:
+                    return
+                i = todo.pop()
+            finally:
+                lock.release()
+            try:
+                results[i] = sources[i].generate(cache, times, times_lock)
+            except Exception, e:
+                lock.acquire()
+                errors.append(e)
+                lock.release()
+            lock.acquire()
+            try:
+                print "\n".join(sources[i].log)
+            finally:
+                lock.release()
+
+    count = min(System.Environment.ProcessorCount, len(sources))
+    threads = [threading.Thread(target=worker) for i in range(count)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+
+    result = []
+    for r in results:
+        result.extend(r)
+    return result
 
 def save_file(name, text):
     f = open(name, 'w')
@@ -295,32 +546,38 @@ def save_file(name, text):
     f.close()
 
 class FileGenerator:
-    def __init__(self, filename, generator, replacer):
+    def __init__(self, filename, generator, replacer, text=None):
         self.filename = filename
         self.generator = generator
         self.replacer = replacer
 
-        thefile = open(filename)
-        self.text = thefile.read()
-        thefile.close()
+        if text is None:
+            thefile = open(filename)
+            text = thefile.read()
+            thefile.close()
+        self.text = text
         self.indent = self.replacer.match(self.text)
         self.has_match = self.indent is not None
 
     def collect_info(self):
         pass
 
+    # Returns the file's text with the generator's output in its region.
+    def render(self):
+        cw = CodeWriter()
+        cw.text = self.replacer.replace(CodeWriter(), self.text, self.indent)
+        cw.begin_generated(self.generator)
+        self.generator(cw)
+        cw.end_generated()
+        return self.replacer.replace(cw, self.text, self.indent)
+
     def generate(self):
         print "generate",
         if sys.argv.count('checkonly') > 0:
             print "(check-only)",
         print self.filename, "...",
 
-        cw = CodeWriter()
-        cw.text = self.replacer.replace(CodeWriter(), self.text, self.indent)
-        cw.begin_generated(self.generator)
-        self.generator(cw)
-        cw.end_generated()
-        new_text = self.replacer.replace(cw, self.text, self.indent)
+        new_text = self.render()
         if self.text != new_text:
             if sys.argv.count('checkonly') > 0:
                 print "different!"
@@ -338,9 +595,64 @@ class FileGenerator:
 
         return True
 
+# Runs the (region name, generator function) pairs g over the source tree and
+# returns a list with a result for each region generated, False where a
+# check-only run found a difference.
+#
+# This scans the tree once (see SourceIndex) and rewrites each file once with
+# all its regions (see SourceFile).  Pass these on the command line to change
+# how it runs:
+#     unindexed   run each generator over the tree separately as before
+#     cached      skip regions that have not changed (see GeneratorCache)
+#     parallel    generate different files on different threads
+#     timing      print how long the run and each generator took
 def generate(*g):
-    result = []
+    start = time.clock()
+    if sys.argv.count('unindexed') > 0:
+        result = []
+        for name, func in g:
+            run = CodeGenerator(name, func).doit()
+            result.extend(run)
+        if sys.argv.count('timing') > 0:
+            print "timing: %d generators unindexed in %.2fs" % (
+                len(g), time.clock() - start)
+        return result
+
+    index = SourceIndex()
+    index.scan()
+    scanned = time.clock()
+
+    files = {}
     for name, func in g:
-        run = CodeGenerator(name, func).doit()
-        result.extend(run)
+        found = index.find(name)
+        if not found:
+            raise Exception("didn't find a match for %s" % name)
+        for filename in found:
+            if filename not in files:
+                files[filename] = SourceFile(filename, index.texts[filename])
+            files[filename].add(name, func)
+
+    cache = None
+    if sys.argv.count('cached') > 0:
+        # The cache lives in %TEMP% so that it never shows up as a change in
+        # the source tree.  Entries are keyed by full file name, so several
+        # enlistments can share it.
+        cache = GeneratorCache(System.IO.Path.Combine(
+            System.IO.Path.GetTempPath(), "IronPython.generate.cache"))
+        cache.load()
+    times = {}
+    sources = [files[filename]
+               for filename in sorted(files, key=index.order.get)]
+    result = generate_files(sources, cache, times,
+                            sys.argv.count('parallel') > 0)
+    if cache is not None:
+        cache.save()
+
+    if sys.argv.count('timing') > 0:
+        print "timing: scanned %d files (%d with regions) in %.2fs" % (
+            index.scanned, len(index.texts), scanned - start)
+        print "timing: generated %d regions in %d files in %.2fs" % (
+            len(result), len(files), time.clock() - scanned)
+        for name, secs in sorted(times.items(), key=lambda x: -x[1]):
+            print "timing:     %8.3fs  %s" % (secs, name)
     return result
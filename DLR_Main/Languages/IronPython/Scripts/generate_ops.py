@@ -323,7 +323,19 @@ def gen_tests(ops, pos, indent=1):
 
     return ["    "*indent + l for l in ret]
 
+# tokenize_generator emits the cases of NextOperator's switch on an operator's
+# first character, with nested NextChar() tests by default.  Set
+# tokenize_table_driven to instead send every first character to the DFA that
+# tokenize_table_generator emits into the "Tokenize Op Table" region.
+# test_operator_table.py checks the DFA against tokenize_test_cases.
+tokenize_table_driven = False
+
 def tokenize_generator(cw):
+    if tokenize_table_driven:
+        for ch in operator_start_chars():
+            cw.write("case '%s':" % ch)
+        cw.write("    return NextOperatorFromTable(ch);")
+        return
     ret = []
     done = {}
     for op in ops:
@@ -336,6 +348,195 @@ def tokenize_generator(cw):
         done[ch] = True
     return ret
 
+def operator_start_chars():
+    chars = []
+    for op in ops:
+        if op.symbol[0] not in chars:
+            chars.append(op.symbol[0])
+    return chars
+
+def tokenize_table_region_generator(cw):
+    if tokenize_table_driven:
+        tokenize_table_generator(cw)
+
+# What NextOperator gives for text by default, worked out from start_symbols
+# the way gen_tests writes its tests: the token (None for no operator and
+# 'BadChar' for a prefix of operators that is not one), how many characters
+# it reads, and any grouping level change.
+def tokenize_test_case(text):
+    sops = start_symbols.get(text[0])
+    if not sops:
+        return None, 1, None
+    pos = 1
+    while pos < len(text):
+        longer = [op for op in sops if len(op.symbol) > pos and op.symbol[pos] == text[pos]]
+        if not longer: break
+        sops = longer
+        pos += 1
+    matches = [op for op in sops if len(op.symbol) == pos]
+    if not matches:
+        return 'BadChar', pos, None
+    op = matches[0]
+    level = None
+    if isinstance(op, Grouping):
+        if op.side == 'l':
+            level = op.base_name + 'Level++'
+        else:
+            level = op.base_name + 'Level--'
+    return 'Tokens.%sToken' % op.title_name(), pos, level
+
+# Every input NextOperator can tell apart, with what it gives for each (see
+# tokenize_test_case), as (text, token, length, level) tuples.  The texts are
+# the strings as long as the longest operator drawn from the operators'
+# characters, a letter and a non-ASCII character, and their prefixes, which
+# stand for the input ending.
+def tokenize_test_cases():
+    chars = ['a', u'\u0100']
+    for op in ops:
+        for ch in op.symbol:
+            if ch not in chars:
+                chars.append(ch)
+    longest = max([len(op.symbol) for op in ops])
+    texts = list(chars)
+    last = texts
+    for length in range(2, longest + 1):
+        last = [text + ch for text in last for ch in chars]
+        texts.extend(last)
+    return [(text,) + tokenize_test_case(text) for text in texts]
+
+# The DFA that tokenize_table_generator emits.  Its states are the prefixes
+# of the symbols in ops, numbered from 1 with the prefixes that a longer
+# symbol continues first, so that the tokenizer can stop reading once the
+# state reaches first_leaf.  Only the characters after a symbol's first
+# get a class, which keeps the transition table to a few columns.
+class OperatorTable:
+    def __init__(self, ops):
+        self.ops = {}   # symbol -> the first op in ops with it
+        prefixes = {}
+        for op in ops:
+            if not self.ops.has_key(op.symbol):
+                self.ops[op.symbol] = op
+            for i in range(1, len(op.symbol) + 1):
+                prefixes[op.symbol[:i]] = True
+
+        inner = [p for p in prefixes if [q for q in prefixes if len(q) > len(p) and q.startswith(p)]]
+        leaves = [p for p in prefixes if p not in inner]
+        inner.sort()
+        leaves.sort()
+        self.states = [None] + inner + leaves
+        self.first_leaf = len(inner) + 1
+        self.state_of = {}
+        for state in range(1, len(self.states)):
+            self.state_of[self.states[state]] = state
+
+        continuations = {}
+        for p in prefixes:
+            for ch in p[1:]:
+                continuations[ch] = True
+        self.continuations = continuations.keys()
+        self.continuations.sort()
+        self.classes = len(self.continuations) + 1
+
+    # The state after the first character of each symbol, indexed by the
+    # character, up to the last character that starts a symbol.
+    def starts(self):
+        size = max([ord(p[0]) for p in self.state_of]) + 1
+        return [self.state_of.get(chr(i), 0) for i in range(size)]
+
+    # The class of each character, indexed by the character, up to the last
+    # character that continues a symbol.  Class 0 continues none.
+    def char_classes(self):
+        size = max([ord(ch) for ch in self.continuations]) + 1
+        classes = [0] * size
+        for i, ch in enumerate(self.continuations):
+            classes[ord(ch)] = i + 1
+        return classes
+
+    # The next state from each state below first_leaf on each class, or 0
+    # where the symbol read so far ends.
+    def transitions(self, state):
+        row = [0]
+        for ch in self.continuations:
+            row.append(self.state_of.get(self.states[state] + ch, 0))
+        return row
+
+def gen_byte_array(cw, name, values):
+    cw.enter_block('private static readonly byte[] %s = new byte[]' % name)
+    for i in range(0, len(values), 16):
+        cw.write(', '.join([str(v) for v in values[i:i + 16]]) + ',')
+    cw.dedent()
+    cw.write('};')
+
+# Emits the tables of an OperatorTable and NextOperatorFromTable, which reads
+# an operator by looping over them in place of the nested tests, reading
+# characters while they continue a symbol.  NextOperator only calls it for
+# characters that start an operator.
+def tokenize_table_generator(cw):
+    table = OperatorTable(ops)
+    cw.write('private const int OperatorClasses = %d;' % table.classes)
+    cw.write('private const int OperatorFirstLeaf = %d;' % table.first_leaf)
+    cw.writeline()
+    cw.write('// The state after the first character of an operator, indexed by the character.')
+    gen_byte_array(cw, '_operatorStarts', table.starts())
+    cw.writeline()
+    cw.write('// The class of each character that can continue an operator, indexed by the character.')
+    gen_byte_array(cw, '_operatorClasses', table.char_classes())
+    cw.writeline()
+    cw.write('// The next state from each state below OperatorFirstLeaf, indexed by')
+    cw.write('// (state - 1) * OperatorClasses + class.  0 means the operator ends.')
+    cw.enter_block('private static readonly byte[] _operatorTransitions = new byte[]')
+    for state in range(1, table.first_leaf):
+        cw.write('%s, // %s' % (', '.join([str(v) for v in table.transitions(state)]), table.states[state]))
+    cw.dedent()
+    cw.write('};')
+    cw.writeline()
+    cw.write('// The token for each state, or null if no operator ends there.')
+    cw.enter_block('private static readonly Token[] _operatorTokens = new Token[]')
+    cw.write('null,')
+    for state in range(1, len(table.states)):
+        op = table.ops.get(table.states[state])
+        if op is None:
+            cw.write('null, // %s' % table.states[state])
+        else:
+            cw.write('Tokens.%sToken,' % op.title_name())
+    cw.dedent()
+    cw.write('};')
+    cw.writeline()
+
+    cw.enter_block('private Token NextOperatorFromTable(int ch)')
+    cw.write('int state = _operatorStarts[ch];')
+    cw.enter_block('while (state < OperatorFirstLeaf)')
+    cw.write('int next = Peek();')
+    cw.enter_block('if ((uint)next >= (uint)_operatorClasses.Length)')
+    cw.write('break;')
+    cw.exit_block()
+    cw.write('next = _operatorTransitions[(state - 1) * OperatorClasses + _operatorClasses[next]];')
+    cw.enter_block('if (next == 0)')
+    cw.write('break;')
+    cw.exit_block()
+    cw.write('NextChar();')
+    cw.write('state = next;')
+    cw.exit_block()
+    cw.writeline()
+    cw.enter_block('switch (state)')
+    for op in ops:
+        if not isinstance(op, Grouping): continue
+        cw.case_label('case %d: // %s' % (table.state_of[op.symbol], op.symbol))
+        if op.side == 'l':
+            cw.write("_state.%sLevel++;" % op.base_name)
+        else:
+            cw.write("_state.%sLevel--;" % op.base_name)
+        cw.write('break;')
+        cw.dedent()
+    cw.exit_block()
+    cw.writeline()
+    cw.write('Token res = _operatorTokens[state];')
+    cw.enter_block('if (res == null)')
+    cw.write('return BadChar(ch);')
+    cw.exit_block()
+    cw.write('return res;')
+    cw.exit_block()
+
 friendlyOverload = {'elif':"ElseIf"}
 def keywordToFriendly(kw):
     if friendlyOverload.has_key(kw):
@@ -370,7 +571,18 @@ def tokenkinds_generator(cw):
         cw.write("Keyword%s = %d," % (keywordToFriendly(kw), i))
         i += 1
 
-def gen_mark_end(cw, keyword):
+# keyword_lookup_generator emits a tree of NextChar() tests by default.  Set
+# keyword_lookup_hashed to emit keyword_hash_generator's switch instead.
+# time_keyword_lookup.py compares the two.
+keyword_lookup_hashed = False
+
+def keyword_list():
+    keyword_list = list(kwlist)
+    keyword_list.append('None')
+    keyword_list.sort()
+    return keyword_list
+
+def gen_keyword_token(cw, keyword):
     if keyword == 'print': cw.enter_block('if (!_printFunction)')
         
     cw.write('MarkTokenEnd();')
@@ -378,10 +590,13 @@ def gen_mark_end(cw, keyword):
         cw.write('return Tokens.NoneToken;')
     else:
         cw.write('return Tokens.Keyword%sToken;' % keywordToFriendly(keyword))
-    cw.exit_block()
     
     if keyword == 'print': cw.exit_block()
 
+def gen_mark_end(cw, keyword):
+    gen_keyword_token(cw, keyword)
+    cw.exit_block()
+
 def gen_token_tree(cw, tree, keyword):
     cw.write('ch = NextChar();')
     for i, (k, (v, end)) in enumerate(tree.iteritems()):
@@ -415,15 +630,17 @@ def gen_token_tree(cw, tree, keyword):
     cw.exit_block()
     
 def keyword_lookup_generator(cw):
+    if keyword_lookup_hashed:
+        keyword_hash_generator(cw)
+    else:
+        keyword_tree_generator(cw)
+
+def keyword_tree_generator(cw):
     cw.write('int ch;')
     cw.write('BufferBack();')
     
-    keyword_list = list(kwlist)
-    keyword_list.append('None')
-    keyword_list.sort()
-    
     tree = {}
-    for kw in keyword_list:
+    for kw in keyword_list():
         prev = cur = tree
         for letter in kw:
             val = cur.get(letter)
@@ -437,6 +654,71 @@ def keyword_lookup_generator(cw):
     gen_token_tree(cw, tree, '')
     return
 
+# Maps each keyword length to the keywords' first characters, and each of
+# those to the keywords' last characters, so that a name's length, first and
+# last character pick at most one keyword.
+def keyword_hash_table(keywords):
+    table = {}
+    for kw in keywords:
+        lasts = table.setdefault(len(kw), {}).setdefault(kw[0], {})
+        assert not lasts.has_key(kw[-1]), \
+               "%s and %s need another character to tell apart" % (lasts.get(kw[-1]), kw)
+        lasts[kw[-1]] = kw
+    return table
+
+# Writes the test of the characters of keyword that the switches have not
+# already checked, and the keyword's return.  Returns whether the code after
+# it is reachable.
+def gen_keyword_match(cw, keyword, known):
+    tests = ["_buffer[_start + %d] == '%c'" % (i, keyword[i])
+             for i in range(len(keyword)) if i not in known]
+    if tests:
+        cw.enter_block('if (%s)' % ' && '.join(tests))
+        gen_mark_end(cw, keyword)
+        return True
+    gen_keyword_token(cw, keyword)
+    return keyword == 'print'
+
+# Reads the whole name and then switches on its length, its first character,
+# and its last character when keywords share the first two, which leaves one
+# keyword to compare the name against.  Names that are not keywords fall out
+# of the switch to ReadName's code after the region.
+def keyword_hash_generator(cw):
+    cw.write('int ch;')
+    cw.write('BufferBack();')
+    cw.enter_block('do')
+    cw.write('ch = NextChar();')
+    cw.exit_block('while (IsNamePart(ch));')
+    cw.write('BufferBack();')
+
+    table = keyword_hash_table(keyword_list())
+    cw.enter_block('switch (_position - _start)')
+    for length in sorted(table.keys()):
+        cw.case_label('case %d:' % length)
+        cw.enter_block('switch (_buffer[_start])')
+        firsts = table[length]
+        for first in sorted(firsts.keys()):
+            cw.case_label("case '%c':" % first)
+            lasts = firsts[first]
+            if len(lasts) == 1:
+                reachable = gen_keyword_match(cw, lasts.values()[0], [0])
+            else:
+                cw.enter_block('switch (_buffer[_start + %d])' % (length - 1))
+                for last in sorted(lasts.keys()):
+                    cw.case_label("case '%c':" % last)
+                    if gen_keyword_match(cw, lasts[last], [0, length - 1]):
+                        cw.write('break;')
+                    cw.dedent()
+                cw.exit_block()
+                reachable = True
+            if reachable:
+                cw.write('break;')
+            cw.dedent()
+        cw.exit_block()
+        cw.write('break;')
+        cw.dedent()
+    cw.exit_block()
+
 def tokens_generator(cw):
     uc = unique_checker()
     for op in ops:
@@ -656,6 +938,7 @@ def main():
         ("Python Fast Ops RetBool Chooser", fast_op_ret_bool_chooser),
         ("Python Fast Ops Ret Bool", fast_op_ret_bool),
         ("Tokenize Ops", tokenize_generator),
+        ("Tokenize Op Table", tokenize_table_region_generator),
         ("Token Kinds", tokenkinds_generator),
         ("Tokens", tokens_generator),
         ("Table of Operators", gen_OperatorTable),
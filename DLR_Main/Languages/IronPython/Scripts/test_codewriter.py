@@ -0,0 +1,165 @@
+#####################################################################################
+#
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#
+# This source code is subject to terms and conditions of the Apache License, Version 2.0. A 
+# copy of the license can be found in the License.html file at the root of this distribution. If 
+# you cannot locate the  Apache License, Version 2.0, please send an email to 
+# ironpy@microsoft.com. By using this source code in any fashion, you are agreeing to be bound 
+# by the terms of the Apache License, Version 2.0.
+#
+# You must not remove this notice, or any other, from this software.
+#
+#
+#####################################################################################
+
+# Checks that BlockReplacer.replace, which renders a CodeWriter's lines into a
+# list of pieces and joins them once, gives the same text as building the
+# region by concatenating it line by line did.  The writers cover nested
+# blocks, blank and whitespace-only lines, #region and other preprocessor
+# lines, and regions indented in the file.  time_generators.py times both on
+# large regions.
+
+import random
+import sys
+
+from generate import CodeWriter, BlockReplacer
+
+TEXTS = [
+"""namespace Test {
+    class Big {
+        #region Generated Test Region
+        #endregion
+    }
+}
+""",
+"""#region Generated Test Region
+#endregion
+""",
+"""class Tabbed {
+\t\t#region Generated Test Region
+\t\tstale line
+\t\t#endregion
+}""",
+]
+
+# BlockReplacer.replace as it was before it rendered into a list: adds each
+# line to a string.
+def concatenated_replace(replacer, cw, text, indent):
+    code = [replacer.start] + cw.lines + [replacer.end]
+
+    def should_indent(line):
+        if not line: return False
+        if line.startswith("#region"): return True
+        if line.startswith("#endregion"): return True
+        if line.startswith("#"): return False
+        return True
+
+    code_text = indent[0]
+    delim = False
+    for line in code:
+        if delim:
+            code_text += "\n"
+            if should_indent(line):
+                code_text += indent[0]
+        code_text += line
+        delim = True
+    return text[0:indent[1]] + code_text + text[indent[2]:len(text)]
+
+def nested_writer():
+    cw = CodeWriter()
+    cw.writeline("// nested blocks")
+    cw.enter_block("public static class Outer")
+    cw.writeline()
+    cw.enter_block("public static int F(int x)")
+    cw.enter_block("switch (x)")
+    cw.case_label("case 0:")
+    cw.writeline("return 1;")
+    cw.dedent()
+    cw.case_block("case 1:")
+    cw.writeline("   ")
+    cw.writeline("return 2;")
+    cw.exit_case_block()
+    cw.exit_block()
+    cw.enter_block("if (x > 0)")
+    cw.writeline("x--;")
+    cw.else_block()
+    cw.writeline("x++;")
+    cw.exit_block()
+    cw.writeline("return x;")
+    cw.exit_block()
+    cw.writeline()
+    cw.writeline()
+    cw.exit_block()
+    return cw
+
+def preprocessor_writer():
+    cw = CodeWriter(1)
+    cw.writeline("#region Inner")
+    cw.writeline("#if DEBUG")
+    cw.enter_block("void Check()")
+    cw.writeline("#endregion")
+    cw.writeline("# not a directive")
+    cw.exit_block()
+    cw.writeline("#endif")
+    cw.writeline("#endregion")
+    cw.write("a\n\nb\n    c")
+    return cw
+
+# Writes a random mix of the writer's calls, seeded so failures repeat.
+def random_writer(seed):
+    rand = random.Random(seed)
+    cw = CodeWriter(rand.randint(0, 2))
+    depth = 0
+    for i in range(rand.randint(0, 200)):
+        kind = rand.randint(0, 6)
+        if kind == 0:
+            cw.enter_block("block%d()" % i)
+            depth += 1
+        elif kind == 1 and depth > 0:
+            cw.exit_block()
+            depth -= 1
+        elif kind == 2:
+            cw.writeline()
+        elif kind == 3:
+            cw.writeline(rand.choice(["#region R", "#endregion", "#if X", "  ", "\t"]))
+        elif kind == 4:
+            cw.write("line %d\nnext\n\nlast" % i)
+        else:
+            cw.writeline("statement%d;" % i)
+    return cw
+
+def writers():
+    result = [("empty", CodeWriter()), ("nested", nested_writer()),
+              ("preprocessor", preprocessor_writer())]
+    for seed in range(200):
+        result.append(("random %d" % seed, random_writer(seed)))
+    return result
+
+def test_main(level='full'):
+    replacer = BlockReplacer("Test Region")
+    failures = 0
+    count = 0
+    for text in TEXTS:
+        indent = replacer.match(text)
+        for name, cw in writers():
+            count += 1
+            lines = list(cw.lines)
+            expected = concatenated_replace(replacer, cw, text, indent)
+            result = replacer.replace(cw, text, indent)
+            if result != expected:
+                failures += 1
+                print "FAIL: %s writer gives %r, expected %r" % (name, result, expected)
+            if cw.lines != lines:
+                failures += 1
+                print "FAIL: replace changed the %s writer's lines" % name
+
+    print "checked %d regions" % count
+    if failures:
+        print "FAIL: %d failures" % failures
+        sys.exit(1)
+    else:
+        print "PASS"
+
+if __name__=="__main__":
+    test_main()
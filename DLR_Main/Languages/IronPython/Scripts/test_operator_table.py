@@ -0,0 +1,117 @@
+#####################################################################################
+#
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#
+# This source code is subject to terms and conditions of the Apache License, Version 2.0. A
+# copy of the license can be found in the License.html file at the root of this distribution. If
+# you cannot locate the  Apache License, Version 2.0, please send an email to
+# ironpy@microsoft.com. By using this source code in any fashion, you are agreeing to be bound
+# by the terms of the Apache License, Version 2.0.
+#
+# You must not remove this notice, or any other, from this software.
+#
+#
+#####################################################################################
+
+# Checks the operator DFA that generate_ops.tokenize_table_generator emits
+# against the cases generate_ops.tokenize_test_cases works out from ops for
+# every input NextOperator can tell apart.  The tables are read back out of the
+# generated C# and run the way NextOperatorFromTable runs them.  It also checks
+# that the table-driven switch cases send exactly the characters that start an
+# operator to NextOperatorFromTable.
+
+import re
+import sys
+
+from generate import CodeWriter
+import generate_ops
+
+def generated_tables():
+    cw = CodeWriter()
+    generate_ops.tokenize_table_generator(cw)
+    text = cw.text()
+
+    tables = {}
+    for name in ['OperatorClasses', 'OperatorFirstLeaf']:
+        tables[name] = int(re.search(name + r' = (\d+);', text).group(1))
+    for name in ['_operatorStarts', '_operatorClasses', '_operatorTransitions']:
+        body = re.search(name + r' = new byte\[\] \{(.*?)\};', text, re.DOTALL).group(1)
+        body = re.sub('//.*', '', body)
+        tables[name] = [int(v) for v in re.findall(r'\d+', body)]
+    body = re.search(r'_operatorTokens = new Token\[\] \{(.*?)\};', text, re.DOTALL).group(1)
+    body = re.sub('//.*', '', body)
+    tables['_operatorTokens'] = re.findall(r'null|Tokens\.\w+Token', body)
+    levels = {}
+    for state, field, change in re.findall(r'case (\d+): //.*\n\s*_state\.(\w+)(\+\+|--);', text):
+        levels[int(state)] = field + change
+    tables['levels'] = levels
+    return tables
+
+# Runs the tables as NextOperatorFromTable does on text, and returns the token
+# (None for no operator, 'BadChar' for a character that starts no whole
+# operator), how many characters were read, and any level change.  Characters
+# that start no operator give None without running the tables, as
+# NextOperator's switch does.
+def run_tables(tables, text):
+    starts = tables['_operatorStarts']
+    classes = tables['_operatorClasses']
+    ch = ord(text[0])
+    if ch >= len(starts) or starts[ch] == 0:
+        return None, 1, None
+    state = starts[ch]
+    length = 1
+    while state < tables['OperatorFirstLeaf'] and length < len(text):
+        next = ord(text[length])
+        if next >= len(classes):
+            break
+        next = tables['_operatorTransitions'][(state - 1) * tables['OperatorClasses'] + classes[next]]
+        if next == 0:
+            break
+        length += 1
+        state = next
+    token = tables['_operatorTokens'][state]
+    if token == 'null':
+        token = 'BadChar'
+    return token, length, tables['levels'].get(state)
+
+# The characters the table-driven switch cases send to NextOperatorFromTable.
+def table_cases():
+    cw = CodeWriter()
+    generate_ops.tokenize_table_driven = True
+    try:
+        generate_ops.tokenize_generator(cw)
+    finally:
+        generate_ops.tokenize_table_driven = False
+    return re.findall(r"case '(.)':", cw.text())
+
+def test_main(level='full'):
+    tables = generated_tables()
+    failures = 0
+    count = 0
+    for case in generate_ops.tokenize_test_cases():
+        count += 1
+        text = case[0]
+        result = run_tables(tables, text)
+        expect = case[1:]
+        if result != expect:
+            failures += 1
+            if failures <= 10:
+                print "FAIL: %r gives %r, expected %r" % (text, result, expect)
+    for op in generate_ops.ops:
+        if run_tables(tables, op.symbol)[1] != len(op.symbol):
+            failures += 1
+            print "FAIL: %r is not read whole" % op.symbol
+    starts = generate_ops.start_symbols.keys()
+    if sorted(table_cases()) != sorted(starts):
+        failures += 1
+        print "FAIL: table cases are for %r, expected %r" % (table_cases(), starts)
+
+    print "checked %d strings" % count
+    if failures:
+        print "FAIL: %d failures" % failures
+        sys.exit(1)
+    else:
+        print "PASS"
+
+if __name__=="__main__":
+    test_main()
@@ -0,0 +1,105 @@
+#####################################################################################
+#
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#
+# This source code is subject to terms and conditions of the Apache License, Version 2.0. A 
+# copy of the license can be found in the License.html file at the root of this distribution. If 
+# you cannot locate the  Apache License, Version 2.0, please send an email to 
+# ironpy@microsoft.com. By using this source code in any fashion, you are agreeing to be bound 
+# by the terms of the Apache License, Version 2.0.
+#
+# You must not remove this notice, or any other, from this software.
+#
+#
+#####################################################################################
+
+# Times a full check-only regeneration with every generator that test_cgcheck
+# runs, first running each generator over the source tree separately as
+# generate.py used to ('unindexed'), then with the single-scan index.  Pass
+# 'update' to let the indexed run rewrite files instead of only diffing them.
+# Pass 'regions' to instead time generating regions of 25,000 and 100,000
+# lines into a file's text, which should take time linear in the lines.
+
+import sys
+import time
+
+from generate import CodeWriter, BlockReplacer
+
+generators = [
+    'generate_AssemblyTypeNames',
+    'generate_alltypes',
+    'generate_calls',
+    'generate_casts',
+    'generate_dict_views',
+    'generate_dynsites',
+    'generate_exceptions',
+    'generate_math',
+    'generate_ops',
+    'generate_reflected_calls',
+    'generate_set',
+    'generate_walker',
+    'generate_typecache',
+    'generate_tree',
+    'generate_dynamic_instructions',
+    'generate_comdispatch',
+]
+
+def run_all(argv):
+    old_args = sys.argv
+    sys.argv = argv
+    times = []
+    try:
+        for gen in generators:
+            g = __import__(gen)
+            start = time.clock()
+            g.main()
+            times.append((gen, time.clock() - start))
+    finally:
+        sys.argv = old_args
+    return times
+
+REGION_TEXT = """namespace Test {
+    class Big {
+        #region Generated Big Region
+        #endregion
+    }
+}
+"""
+
+def time_region(lines):
+    start = time.clock()
+    cw = CodeWriter()
+    for i in range(lines // 4):
+        cw.enter_block("public static int F%(i)d()", i=i)
+        cw.writeline("return %d;" % i)
+        cw.exit_block()
+        cw.writeline()
+    replacer = BlockReplacer("Big Region")
+    replacer.replace(cw, REGION_TEXT, replacer.match(REGION_TEXT))
+    return time.clock() - start
+
+def time_regions():
+    time_region(1000)   # warm up
+    for lines in [25000, 100000]:
+        print "%-32s %9.2fs" % ("%d line region" % lines, time_region(lines))
+
+def main():
+    if sys.argv.count('regions') > 0:
+        time_regions()
+        return
+    indexed = ['checkonly']
+    if sys.argv.count('update') > 0:
+        indexed = []
+    before = run_all(['checkonly', 'unindexed'])
+    after = run_all(indexed)
+
+    print
+    print "%-32s %10s %10s" % ("generator", "unindexed", "indexed")
+    for (gen, old), (gen, new) in zip(before, after):
+        print "%-32s %9.2fs %9.2fs" % (gen, old, new)
+    print "%-32s %9.2fs %9.2fs" % ("total",
+                                     sum([t for g, t in before]),
+                                     sum([t for g, t in after]))
+
+if __name__ == "__main__":
+    main()
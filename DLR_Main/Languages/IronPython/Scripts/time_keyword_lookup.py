@@ -0,0 +1,216 @@
+#####################################################################################
+#
+#  Copyright (c) Microsoft Corporation. All rights reserved.
+#
+# This source code is subject to terms and conditions of the Apache License, Version 2.0. A
+# copy of the license can be found in the License.html file at the root of this distribution. If
+# you cannot locate the  Apache License, Version 2.0, please send an email to
+# ironpy@microsoft.com. By using this source code in any fashion, you are agreeing to be bound
+# by the terms of the Apache License, Version 2.0.
+#
+# You must not remove this notice, or any other, from this software.
+#
+#
+#####################################################################################
+
+# Compares the two keyword lookups generate_ops can emit for the tokenizer's
+# ReadName: the tree of NextChar() tests and the switch on a name's length,
+# first and last characters.  Each one is generated into a copy of ReadName
+# over a plain buffer, compiled with the C# compiler, and timed reading the
+# names of a keyword-dense and an identifier-dense corpus.  Both must return
+# the same tokens for every name.  Pass 'source' to print the C# instead.
+
+import sys
+import random
+
+from generate import CodeWriter
+import generate_ops
+
+iterations = 20
+corpus_words = 100000
+
+lookup_template = """
+public class %(name)s {
+    private const int EOF = -1;
+    private char[] _buffer;
+    private int _start, _position, _end, _tokenEnd;
+    private bool _printFunction;
+
+    public %(name)s(string text) {
+        _buffer = text.ToCharArray();
+        _end = _buffer.Length;
+    }
+
+    private int Peek() {
+        return _position < _end ? _buffer[_position] : EOF;
+    }
+
+    private int NextChar() {
+        int result = Peek();
+        _position++;
+        return result;
+    }
+
+    private void BufferBack() {
+        _position--;
+    }
+
+    private void MarkTokenEnd() {
+        _tokenEnd = Math.Min(_position, _end);
+    }
+
+    private static bool IsNamePart(int ch) {
+        return Char.IsLetterOrDigit((char)ch) || ch == '_';
+    }
+
+    private int ReadName() {
+%(lookup)s
+
+        BufferBack();
+        ch = NextChar();
+
+        while (IsNamePart(ch)) {
+            ch = NextChar();
+        }
+        BufferBack();
+
+        MarkTokenEnd();
+        return Tokens.NameToken;
+    }
+
+    // Reads every name in the buffer, which holds names separated by single
+    // spaces, and adds their tokens to tokens if it is not null.
+    public void Run(List<int> tokens) {
+        _position = 0;
+        while (_position < _end) {
+            _start = _position;
+            NextChar();
+            int token = ReadName();
+            if (tokens != null) {
+                tokens.Add(token);
+            }
+            _position = _tokenEnd + 1;
+        }
+    }
+
+    public double Time(int iterations) {
+        Stopwatch watch = Stopwatch.StartNew();
+        for (int i = 0; i < iterations; i++) {
+            Run(null);
+        }
+        return watch.Elapsed.TotalSeconds;
+    }
+}
+"""
+
+def tokens_source():
+    cw = CodeWriter()
+    cw.enter_block('public static class Tokens')
+    cw.write('public const int NameToken = 0;')
+    cw.write('public const int NoneToken = 1;')
+    i = 2
+    for kw in generate_ops.kwlist:
+        cw.write('public const int Keyword%sToken = %d;' % (generate_ops.keywordToFriendly(kw), i))
+        i += 1
+    cw.exit_block()
+    return cw.text()
+
+def lookup_source(name, generator):
+    cw = CodeWriter(2)
+    generator(cw)
+    return lookup_template % {'name' : name, 'lookup' : cw.text()}
+
+def source():
+    return '\n'.join([
+        'using System;',
+        'using System.Collections.Generic;',
+        'using System.Diagnostics;',
+        '',
+        tokens_source(),
+        lookup_source('TreeLookup', generate_ops.keyword_tree_generator),
+        lookup_source('HashLookup', generate_ops.keyword_hash_generator),
+    ])
+
+def compile_lookups(text):
+    import clr
+    clr.AddReference('System')
+    from Microsoft.CSharp import CSharpCodeProvider
+    from System.CodeDom.Compiler import CompilerParameters
+
+    parameters = CompilerParameters()
+    parameters.GenerateInMemory = True
+    parameters.CompilerOptions = '/optimize+'
+    parameters.ReferencedAssemblies.Add('System.dll')
+    results = CSharpCodeProvider().CompileAssemblyFromSource(parameters, text)
+    if results.Errors.HasErrors:
+        for error in results.Errors:
+            print error
+        raise AssertionError('the generated lookups do not compile')
+    return results.CompiledAssembly
+
+# Names that are not keywords, many of them starting like one.
+identifiers = [
+    'x', 'i', 'n', 'self', 'value', 'data', 'result', 'index', 'items', 'format',
+    'default', 'define', 'delta', 'elements', 'elsewhere', 'exception', 'execute',
+    'filename', 'found', 'fromkeys', 'globals', 'iface', 'imported', 'inner',
+    'isinstance', 'is_done', 'lambdas', 'nothing', 'order', 'passed', 'printer',
+    'raised', 'returns', 'tryagain', 'whilst', 'yields', 'aside', 'without',
+    'Nonesuch', 'classify', 'continued', 'breakpoint', 'assertion', 'andrew',
+    'finally_', 'ClassName', 'List', 'count2', 'get_value', 'setUp',
+]
+
+keywords = generate_ops.keyword_list()
+
+# Returns a string of count names separated by spaces, a keyword_share of
+# them keywords and the rest identifiers.
+def corpus(keyword_share, count):
+    rand = random.Random(count)
+    words = []
+    for i in xrange(count):
+        if rand.random() < keyword_share:
+            words.append(rand.choice(keywords))
+        else:
+            words.append(rand.choice(identifiers))
+    return ' '.join(words)
+
+def check(assembly, text):
+    from System import Activator
+    from System.Collections.Generic import List
+    results = []
+    for name in ['TreeLookup', 'HashLookup']:
+        tokens = List[int]()
+        Activator.CreateInstance(assembly.GetType(name), text).Run(tokens)
+        results.append(list(tokens))
+    if results[0] != results[1]:
+        for i, (tree, hashed) in enumerate(zip(results[0], results[1])):
+            if tree != hashed:
+                print 'name %d: tree gives %d, hash gives %d' % (i, tree, hashed)
+                break
+        raise AssertionError('the lookups disagree')
+
+def time_lookup(assembly, name, text):
+    from System import Activator
+    lookup = Activator.CreateInstance(assembly.GetType(name), text)
+    lookup.Time(2)
+    return lookup.Time(iterations)
+
+def main():
+    text = source()
+    if sys.argv.count('source') > 0:
+        print text
+        return
+    assembly = compile_lookups(text)
+
+    corpora = [
+        ('keyword-dense', corpus(0.75, corpus_words)),
+        ('identifier-dense', corpus(0.1, corpus_words)),
+    ]
+    print "%-20s %10s %10s" % ("corpus", "tree", "hash")
+    for name, words in corpora:
+        check(assembly, words)
+        tree_time = time_lookup(assembly, 'TreeLookup', words)
+        hash_time = time_lookup(assembly, 'HashLookup', words)
+        print "%-20s %9.3fs %9.3fs" % (name, tree_time, hash_time)
+
+if __name__ == "__main__":
+    main()
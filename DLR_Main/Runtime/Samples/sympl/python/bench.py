@@ -0,0 +1,1068 @@
+### bench.py runs micro-benchmarks for the Sympl implementation.  Run it with
+### ipy from this directory, naming the benchmarks to run (or none to run all
+### of them):
+###
+###     ipy bench.py lexer
+###
+### Most benchmarks build their input by repeating the example programs in
+### ..\examples until the text reaches the size they need.
+###
+
+import sys
+import time
+
+import sympl
+import runtime
+import lexer
+import parser
+import etgen
+import optimizer
+
+import System
+from System import GC, Environment
+from System.Dynamic import DynamicMetaObject, BindingRestrictions, CallInfo
+from System.Threading import Thread
+from System.IO import StringReader, File, Path, Directory
+
+
+_examples = [r"..\examples\test.sympl", r"..\examples\lists.sympl",
+             r"..\examples\indexing.sympl", r"..\examples\ops.sympl"]
+
+### MakeCorpus returns Sympl source text at least size chars long.
+###
+def MakeCorpus (size):
+    text = "\n".join([File.ReadAllText(f) for f in _examples])
+    copies = size // len(text) + 1
+    return "\n".join([text] * copies)
+
+def _time (fun, *args):
+    start = time.clock()
+    res = fun(*args)
+    return (time.clock() - start, res)
+
+def _report (name, secs, count, units, size = None):
+    line = "    %-24s %8.3fs %10d %s" % (name, secs, count, units)
+    if secs > 0:
+        line = line + "  %12.0f %s/s" % (count / secs, units)
+        if size is not None:
+            line = line + "  %7.2f MB/s" % (size / secs / (1024 * 1024))
+    print line
+
+
+##########
+### Lexer
+##########
+
+def _lexAll (lex):
+    tokens = []
+    token = lex.GetToken()
+    while token is not lexer.SyntaxToken.EOF:
+        tokens.append(token)
+        token = lex.GetToken()
+    return tokens
+
+def _tokenKey (token):
+    if isinstance(token, lexer.LiteralToken):
+        return (type(token), token.Value)
+    elif isinstance(token, lexer.IdOrKeywordToken):
+        return (type(token), token.Name)
+    return token
+
+### _UntrackedLexer is BufferedLexer without setting TokenEnd in GetToken, to
+### measure what source location tracking costs.  The rest of the cost, setting
+### TokenStart and passing spans to token constructors, is in the tokenizing
+### code both lexers share.
+###
+class _UntrackedLexer (lexer.BufferedLexer):
+    def GetToken (self):
+        token = self._putToken
+        if token is not None:
+            self._putToken = None
+        else:
+            token = self._getToken()
+        if lexer._debug: lexer.debugprint("getoken: " + str(token))
+        return token
+
+### BenchLexer times lexing a few MB of Sympl code with Lexer, which reads one
+### char at a time from the TextReader, and BufferedLexer, checking that they
+### return the same tokens.  It also reports BufferedLexer's throughput without
+### source location tracking, which should be within 5%.
+###
+def BenchLexer (size = 4 * 1024 * 1024):
+    text = MakeCorpus(size)
+    print "lexer: %d chars" % len(text)
+    results = []
+    times = {}
+    for cls in [lexer.Lexer, lexer.BufferedLexer, _UntrackedLexer]:
+        secs, tokens = _time(_lexAll, cls(StringReader(text)))
+        _report(cls.__name__, secs, len(tokens), "tokens", len(text))
+        results.append([_tokenKey(t) for t in tokens])
+        times[cls] = secs
+    if results[0] != results[1] or results[1] != results[2]:
+        raise Exception("Lexers returned different tokens.")
+    if times[_UntrackedLexer] > 0:
+        print "    location tracking overhead: %.1f%%" % (
+            (times[lexer.BufferedLexer] / times[_UntrackedLexer] - 1) * 100)
+
+
+##########
+### Module cache
+##########
+
+### MakeLibrary returns the text of a Sympl file defining count functions,
+### which is side-effect free to load.
+###
+def MakeLibrary (count):
+    return "\n".join(["(defun f%d (x y)\n  (if (< x y) (+ x %d) (list x y)))"
+                      % (i, i) for i in xrange(count)])
+
+### BenchModuleCache times loading a library file in a new runtime, loading it
+### again in the same runtime, which reuses the compiled code, and loading it
+### in another runtime, which reuses the parsed ASTs.
+###
+def BenchModuleCache (count = 500):
+    filename = Path.GetTempFileName()
+    try:
+        File.WriteAllText(filename, MakeLibrary(count))
+        sympl.Sympl.ParsedModules.Clear()
+        s = sympl.Sympl()
+        print "module cache: %d defuns" % count
+        secs, res = _time(s.ExecuteFile, filename)
+        _report("cold", secs, 1, "loads")
+        secs, res = _time(s.ExecuteFile, filename)
+        _report("same runtime", secs, 1, "loads")
+        secs, res = _time(sympl.Sympl().ExecuteFile, filename)
+        _report("new runtime", secs, 1, "loads")
+        for name, cache in [("compiled", s.CompiledModules),
+                            ("parsed", sympl.Sympl.ParsedModules)]:
+            print "    %-9s hits %d, misses %d, evictions %d" % (
+                name, cache.Hits, cache.Misses, cache.Evictions)
+    finally:
+        File.Delete(filename)
+
+
+##########
+### Analysis
+##########
+
+### _chainAnalyzeExpr is how etgen.AnalyzeExpr used to dispatch, testing the
+### expression's type against each kind of SymplExpr in turn.
+###
+def _chainAnalyzeExpr (expr, scope):
+    exprtype = type(expr)
+    if exprtype is parser.SymplImportExpr:
+        return etgen.AnalyzeImportExpr(expr, scope)
+    elif exprtype is parser.SymplFunCallExpr:
+        return etgen.AnalyzeFunCallExpr(expr, scope)
+    elif exprtype is parser.SymplDefunExpr:
+        return etgen.AnalyzeDefunExpr(expr, scope)
+    elif exprtype is parser.SymplLambdaExpr:
+        return etgen.AnalyzeLambdaExpr(expr, scope)
+    elif exprtype is parser.SymplIdExpr:
+        return etgen.AnalyzeIdExpr(expr, scope)
+    elif exprtype is parser.SymplQuoteExpr:
+        return etgen.AnalyzeQuoteExpr(expr, scope)
+    elif exprtype is parser.SymplLiteralExpr:
+        return etgen.AnalyzeLiteralExpr(expr, scope)
+    elif exprtype is parser.SymplAssignExpr:
+        return etgen.AnalyzeAssignExpr(expr, scope)
+    elif exprtype is parser.SymplLetStarExpr:
+        return etgen.AnalyzeLetStarExpr(expr, scope)
+    elif exprtype is parser.SymplBlockExpr:
+        return etgen.AnalyzeBlockExpr(expr, scope)
+    elif exprtype is parser.SymplEqExpr:
+        return etgen.AnalyzeEqExpr(expr, scope)
+    elif exprtype is parser.SymplConsExpr:
+        return etgen.AnalyzeConsExpr(expr, scope)
+    elif exprtype is parser.SymplListCallExpr:
+        return etgen.AnalyzeListCallExpr(expr, scope)
+    elif exprtype is parser.SymplIfExpr:
+        return etgen.AnalyzeIfExpr(expr, scope)
+    elif exprtype is parser.SymplDottedExpr:
+        return etgen.AnalyzeDottedExpr(expr, scope)
+    elif exprtype is parser.SymplLoopExpr:
+        return etgen.AnalyzeLoopExpr(expr, scope)
+    elif exprtype is parser.SymplBreakExpr:
+        return etgen.AnalyzeBreakExpr(expr, scope)
+    elif exprtype is parser.SymplEltExpr:
+        return etgen.AnalyzeEltExpr(expr, scope)
+    elif exprtype is parser.SymplNewExpr:
+        return etgen.AnalyzeNewExpr(expr, scope)
+    elif exprtype is parser.SymplBinaryExpr:
+        return etgen.AnalyzeBinaryExpr(expr, scope)
+    elif exprtype is parser.SymplUnaryExpr:
+        return etgen.AnalyzeUnaryExpr(expr, scope)
+    else:
+        raise Exception("Internal: no expression to analyze -- " +
+                        repr(expr))
+
+### _countNodes returns the number of SymplExprs in expr.
+###
+def _countNodes (expr):
+    if isinstance(expr, parser.SymplExpr):
+        return 1 + sum([_countNodes(v) for v in expr.__dict__.values()])
+    elif isinstance(expr, (list, tuple)):
+        return sum([_countNodes(x) for x in expr])
+    return 0
+
+def _analyzeAll (runtime, ASTs):
+    scope = etgen.AnalysisScope(
+                None, "bench", runtime,
+                etgen.Exprs.Expression.Parameter(sympl.Sympl, "symplRuntime"),
+                etgen.Exprs.Expression.Parameter(sympl.ExpandoObject,
+                                                 "fileModule"))
+    return [etgen.AnalyzeExpr(e, scope) for e in ASTs]
+
+### BenchAnalyze times analyzing a generated library, which is mostly
+### arithmetic and comparisons, with etgen.AnalyzeExpr's dispatch table and
+### with the old chain of type tests.
+###
+def BenchAnalyze (count = 5000):
+    ASTs = parser.ParseFile(StringReader(MakeLibrary(count)))
+    nodes = _countNodes(ASTs)
+    print "analysis: %d nodes" % nodes
+    runtime = sympl.Sympl()
+    _analyzeAll(runtime, ASTs) # Warm up binder tables.
+    dispatch = etgen.AnalyzeExpr
+    for name, fun in [("if/elif chain", _chainAnalyzeExpr),
+                      ("dispatch table", dispatch)]:
+        etgen.AnalyzeExpr = fun
+        try:
+            secs, res = _time(_analyzeAll, runtime, ASTs)
+        finally:
+            etgen.AnalyzeExpr = dispatch
+        _report(name, secs, nodes, "nodes")
+        print "    %-24s %8.2fus/node" % ("", secs * 1000000 / nodes)
+
+
+##########
+### Parser
+##########
+
+### MakeDeepQuote returns a quoted list nested depth levels deep.
+###
+def MakeDeepQuote (depth):
+    return "'" + "(a " * depth + "b" + ")" * depth
+
+### MakeLetChain returns depth nested let*s, each binding one variable to an
+### expression of the previous one.
+###
+def MakeLetChain (depth):
+    return ("(let* ((x0 0))\n" +
+            "".join(["(let* ((x%d (+ x%d 1)))\n" % (i + 1, i)
+                     for i in xrange(depth)]) +
+            "x%d" % depth + ")" * (depth + 1))
+
+def _parseAll (text, iterative, maxDepth = None):
+    default = parser.MaxRecursiveDepth
+    if maxDepth is not None:
+        parser.MaxRecursiveDepth = maxDepth
+    try:
+        return parser.ParseFile(StringReader(text), iterative = iterative)
+    finally:
+        parser.MaxRecursiveDepth = default
+
+### _treeKey returns a value that compares equal for equal parse trees,
+### including their source spans.
+###
+def _treeKey (expr):
+    if isinstance(expr, parser.SymplExpr):
+        return (type(expr), [(k, _treeKey(v))
+                             for k, v in sorted(expr.__dict__.items())])
+    elif isinstance(expr, (list, tuple)):
+        return [_treeKey(x) for x in expr]
+    elif isinstance(expr, lexer.Token):
+        return _tokenKey(expr)
+    return expr
+
+### BenchParser times the parser on a few MB of flat code three ways, checking
+### they build the same trees:
+###    * baseline is plain recursive descent, never switching to the explicit
+###      stack, which is how Sympl parsed before it had one.
+###    * default recurses and switches past parser.MaxRecursiveDepth, which
+###      flat code never reaches, so it should match baseline.
+###    * explicit stack runs the whole grammar on the explicit stack.
+### Then it times default and explicit stack on deeply nested code, which
+### overflows the stack for baseline.  Times include lexing.
+###
+def BenchParser (size = 4 * 1024 * 1024, depth = 20000):
+    text = MakeCorpus(size)
+    print "parser: %d chars" % len(text)
+    runs = [("baseline", False, sys.maxint), ("default", False, None),
+            ("explicit stack", True, None)]
+    trees = []
+    for name, iterative, maxDepth in runs:
+        secs, ASTs = _time(_parseAll, text, iterative, maxDepth)
+        _report(name, secs, len(ASTs), "exprs", len(text))
+        trees.append(_treeKey(ASTs))
+        ## Drop the trees before the next run so it does not pay to GC them.
+        ASTs = None
+    if trees[1] != trees[0] or trees[2] != trees[0]:
+        raise Exception("Parsers returned different trees.")
+    trees = None
+    for name, text in [("deep quote", MakeDeepQuote(depth)),
+                       ("let* chain", MakeLetChain(depth))]:
+        for run, iterative in [("", False), (" stack", True)]:
+            secs, ASTs = _time(_parseAll, text, iterative)
+            _report("%s %d%s" % (name, depth, run), secs, len(text), "chars",
+                    len(text))
+
+
+##########
+### Lists
+##########
+
+### _chainList is how Cons._List used to build lists, one Cons and one Rest
+### setter call per element.
+###
+def _chainList (*elements):
+    if len(elements) == 0: return None
+    head = runtime.Cons(elements[0], None)
+    tail = head
+    for elt in elements[1:]:
+        tail.Rest = runtime.Cons(elt, None)
+        tail = tail.Rest
+    return head
+
+def _buildLists (make, elements, repeat):
+    for i in xrange(repeat):
+        lst = make(*elements)
+    return lst
+
+def _indexList (lst, count):
+    getElt = runtime.RuntimeHelpers.GetConsElt
+    for i in xrange(count):
+        getElt(lst, i)
+
+def _iterateList (lst, repeat):
+    for i in xrange(repeat):
+        tail = lst
+        while tail is not None:
+            tail = tail.Rest
+
+### BenchLists times building lists with Cons._List, which makes VectorCons
+### lists, and with chained Cons cells, then indexing every element of each
+### list with GetConsElt (as elt does) and walking the list's Rests.
+###
+def BenchLists (count = 2000, repeat = 200):
+    elements = range(count)
+    print "lists: %d elements" % count
+    for name, make in [("cons", _chainList), ("vector", runtime.Cons._List)]:
+        secs, lst = _time(_buildLists, make, elements, repeat)
+        _report(name + " build", secs, count * repeat, "elts")
+        secs, res = _time(_indexList, lst, count)
+        _report(name + " index", secs, count, "elts")
+        ## The first walk of a vector list makes its VectorCons cells.
+        secs, res = _time(_iterateList, lst, 1)
+        _report(name + " first iterate", secs, count, "elts")
+        secs, res = _time(_iterateList, lst, repeat)
+        _report(name + " iterate", secs, count * repeat, "elts")
+
+
+##########
+### Memory
+##########
+
+### _DictCons and _DictIdToken are how Cons and IdOrKeywordToken used to be,
+### keeping their fields in the instance dict, Cons behind properties.
+###
+class _DictCons (object):
+    def __init__ (self, first, rest):
+        self._first = first
+        self._rest = rest
+
+    def _getFirst (self):
+        return self._first
+
+    def _setFirst (self, value):
+        self._first = value
+        return value
+
+    First = property(_getFirst, _setFirst)
+
+    def _getRest (self):
+        return self._rest
+
+    def _setRest (self, value):
+        self._rest = value
+        return value
+
+    Rest = property(_getRest, _setRest)
+
+class _DictIdToken (object):
+    def __init__ (self, name, kwd, start = -1, end = -1):
+        self.Start = start
+        self.End = end
+        self.Name = name
+        self.IsKeywordToken = kwd
+
+### _allocate makes count objects with make, returning the bytes each one
+### takes and the objects, which must stay alive until after measuring.
+###
+def _allocate (make, count):
+    objs = [None] * count
+    before = GC.GetTotalMemory(True)
+    for i in xrange(count):
+        objs[i] = make()
+    after = GC.GetTotalMemory(True)
+    return (after - before) / float(count), objs
+
+### BenchMemory reports bytes per object and allocation rate for Cons cells
+### and ID and number tokens, before and after they used __slots__.
+###
+def BenchMemory (count = 1000000):
+    print "memory: %d objects" % count
+    for name, make in [
+            ("dict cons", lambda: _DictCons(None, None)),
+            ("slotted cons", lambda: runtime.Cons(None, None)),
+            ("dict id token", lambda: _DictIdToken("x", False, 0, 1)),
+            ("slotted id token",
+             lambda: lexer.IdOrKeywordToken("x", False, 0, 1)),
+            ("slotted number token",
+             lambda: lexer.NumberToken(1, 0, 1))]:
+        secs, (size, objs) = _time(_allocate, make, count)
+        objs = None
+        _report(name, secs, count, "objs")
+        print "    %-24s %8.1f bytes/obj" % ("", size)
+
+
+##########
+### Binders
+##########
+
+### _OneLockBinderTable makes a BinderTable take one lock shared with other
+### tables for every lookup, as Sympl's binder tables used to.
+###
+class _OneLockBinderTable (object):
+    def __init__ (self, table, lock):
+        self._table = table
+        self._lock = lock
+
+    def Get (self, key):
+        with self._lock:
+            return self._table.Get(key)
+
+_binderTables = ["_getMemberBinders", "_setMemberBinders", "_invokeBinders",
+                 "_invokeMemberBinders", "_createInstanceBinders",
+                 "_getIndexBinders", "_setIndexBinders",
+                 "_binaryOperationBinders", "_unaryOperationBinders",
+                 "_runHelpersInvokeBinders"]
+
+def _useOneLock (runtime):
+    lock = sympl.thread.allocate_lock()
+    for name in _binderTables:
+        setattr(runtime, name,
+                _OneLockBinderTable(getattr(runtime, name), lock))
+
+### _analyzeInThreads analyzes ASTs repeat times in each of count threads,
+### all against the same runtime.
+###
+def _analyzeInThreads (runtime, ASTs, count, repeat):
+    def work ():
+        for i in xrange(repeat):
+            _analyzeAll(runtime, ASTs)
+    threads = [Thread(work) for i in xrange(count)]
+    for t in threads:
+        t.Start()
+    for t in threads:
+        t.Join()
+
+### BenchBinders times analyzing a generated library in 1, 2, 4, ... threads
+### up to the number of processors, sharing one runtime, with per-table binder
+### locks and with one lock for all lookups.  It then reports the lookups in
+### each binder table.
+###
+def BenchBinders (count = 500, repeat = 4):
+    ASTs = parser.ParseFile(StringReader(MakeLibrary(count)))
+    threads = _threadCounts()
+    print "binders: %d defuns, %d processors" % (count,
+                                                 Environment.ProcessorCount)
+    for name, oneLock in [("per-table locks", False), ("one lock", True)]:
+        runtime = sympl.Sympl()
+        if oneLock:
+            _useOneLock(runtime)
+        _analyzeAll(runtime, ASTs) # Warm up binder tables.
+        base = None
+        for n in threads:
+            secs, res = _time(_analyzeInThreads, runtime, ASTs, n, repeat)
+            _report("%s, %d threads" % (name, n), secs, n * repeat, "files")
+            if base is None:
+                base = secs
+            elif secs > 0:
+                print "    %-24s %8.2fx throughput" % ("", base * n / secs)
+        if not oneLock:
+            stats = runtime.GetBinderStats()
+    print "    binder lookups with per-table locks:"
+    for kind, binders, hits, misses in stats:
+        print "    %-24s %5d binders %9d hits %5d misses" % (
+            kind, binders, hits, misses)
+
+
+##########
+### Compile threads
+##########
+
+### _threadCounts returns 1, 2, 4, ... up to the number of processors.
+###
+def _threadCounts ():
+    counts = [1]
+    while counts[-1] * 2 <= Environment.ProcessorCount:
+        counts.append(counts[-1] * 2)
+    return counts
+
+### BenchCompileThreads times loading a library file in a new runtime with
+### each defun compiled in the module lambda (0 threads) and with defuns
+### compiled on 1, 2, 4, ... threads, checking the loaded functions work the
+### same.  The library is parsed once first so that times are analysis and
+### compilation.
+###
+def BenchCompileThreads (count = 1000):
+    filename = Path.GetTempFileName()
+    try:
+        File.WriteAllText(filename, MakeLibrary(count))
+        sympl.Sympl.ParsedModules.Clear()
+        sympl.Sympl().ExecuteFile(filename)
+        print "compile threads: %d defuns, %d processors" % (
+            count, Environment.ProcessorCount)
+        base = None
+        expected = None
+        for n in [0] + _threadCounts():
+            s = sympl.Sympl()
+            s.CompileThreads = n
+            secs, module = _time(s.ExecuteFile, filename)
+            _report("%d threads" % n, secs, 1, "loads")
+            if base is None:
+                base = secs
+            elif secs > 0:
+                print "    %-24s %8.2fx speedup" % ("", base / secs)
+            res = [s.ExecuteExpr("(f%d %d 5)" % (i, x), module)
+                   for i in (0, count - 1) for x in (2, 7)]
+            if expected is None:
+                expected = res
+            elif repr(res) != repr(expected):
+                raise Exception("Loaded functions returned " + repr(res) +
+                                ", not " + repr(expected))
+    finally:
+        File.Delete(filename)
+
+
+##########
+### Snippets
+##########
+
+_sumTo = """
+(defun sumto (n)
+   (set i 0)
+   (set sum 0)
+   (loop
+      (if (= i n)
+          (break))
+      (set sum (+ sum i))
+      (set i (+ i 1)))
+   sum)
+"""
+
+### BenchSnippets times ExecuteExpr in each SnippetMode, first running many
+### small one-shot snippets, then calling a function with a loop again and
+### again to show steady state speed.  The default n keeps the sum within an
+### Int32.
+###
+def BenchSnippets (count = 500, calls = 20, n = 50000):
+    print "snippets: %d one-shot snippets, %d calls of a %d iteration loop" % (
+        count, calls, n)
+    for mode in ["compile", "interpret", "adaptive"]:
+        s = sympl.Sympl()
+        s.SnippetMode = mode
+        module = s.CreateScope()
+        snippets = ["(+ %d (* 2 3))" % i for i in xrange(count)]
+        secs, res = _time(lambda: [s.ExecuteExpr(x, module) for x in snippets])
+        _report(mode + " one-shot", secs, count, "snippets")
+        s.ExecuteExpr(_sumTo, module)
+        call = "(sumto %d)" % n
+        secs, res = _time(s.ExecuteExpr, call, module)
+        _report(mode + " first call", secs, n, "iters")
+        secs, res = _time(lambda: [s.ExecuteExpr(call, module)
+                                   for i in xrange(calls)])
+        _report(mode + " later calls", secs, n * calls, "iters")
+        if res[-1] != n * (n - 1) / 2:
+            raise Exception("sumto returned " + repr(res[-1]))
+
+
+##########
+### Startup
+##########
+
+### _EagerSympl builds Globals as Sympl used to, reflecting over every type
+### and making an ExpandoObject per namespace and a TypeModel per type.
+###
+class _EagerSympl (sympl.Sympl):
+    def _addNamespacesAndTypes (self):
+        helpers = runtime.DynamicObjectHelpers
+        for assm in self._assemblies:
+            for typ in assm.GetExportedTypes():
+                names = typ.FullName.split('.')
+                table = self._globals
+                for ns in names[:-1]:
+                    if helpers.HasMember(table, ns):
+                        table = helpers.GetMember(table, ns)
+                    else:
+                        tmp = sympl.ExpandoObject()
+                        helpers.SetMember(table, ns, tmp)
+                        table = tmp
+                helpers.SetMember(table, names[-1], runtime.TypeModel(typ))
+
+def _startRuntime (cls):
+    s = cls()
+    module = s.CreateScope()
+    s.ExecuteExpr("(import system)", module)
+    s.ExecuteExpr("(system.math.max 1 2)", module)
+    return s
+
+### BenchStartup times making a runtime and running its first snippets, which
+### import System and call System.Math.Max, and reports the memory the runtime
+### holds.  It compares building Globals eagerly, lazily, and lazily with the
+### saved type index (first saving it, then reading it).  Reflection caches
+### its results within a process, so this understates the saving from reading
+### the index in a new process.
+###
+def BenchStartup ():
+    print "startup: %d assemblies" % len(sympl.Sympl()._assemblies)
+    indexdir = Path.Combine(Path.GetTempPath(), Path.GetRandomFileName())
+    Directory.CreateDirectory(indexdir)
+    try:
+        for name, cls, directory in [
+                ("eager", _EagerSympl, None),
+                ("lazy", sympl.Sympl, None),
+                ("lazy, saving index", sympl.Sympl, indexdir),
+                ("lazy, reading index", sympl.Sympl, indexdir)]:
+            sympl.Sympl.TypeIndexDirectory = directory
+            before = GC.GetTotalMemory(True)
+            secs, s = _time(_startRuntime, cls)
+            size = GC.GetTotalMemory(True) - before
+            _report(name, secs, 1, "runtimes")
+            print "    %-24s %8.0f KB" % ("", size / 1024.0)
+            s = None
+    finally:
+        sympl.Sympl.TypeIndexDirectory = None
+        Directory.Delete(indexdir, True)
+
+
+##########
+### Member cache
+##########
+
+### _UncachedMembers is a MemberCache that always reflects, as binders used to.
+###
+class _UncachedMembers (runtime.MemberCache):
+    def _get (self, kind, typ, name, count, flags, find):
+        self.Misses += 1
+        return find()
+
+def _polymorphicValues ():
+    elttypes = [System.Boolean, System.Byte, System.SByte, System.Char,
+                System.Int16, System.UInt16, System.Int32, System.UInt32,
+                System.Int64, System.UInt64, System.Single, System.Double,
+                System.Decimal, System.DateTime, System.TimeSpan, System.Guid,
+                System.String, System.Object, System.Version, System.Type]
+    generic = System.Collections.Generic
+    return ([generic.List[t]() for t in elttypes] +
+            [generic.Dictionary[System.String, t]() for t in elttypes] +
+            [generic.Queue[t]() for t in elttypes])
+
+def _bindAll (binders, targets, rounds):
+    for i in xrange(rounds):
+        for binder, args in binders:
+            for target in targets:
+                binder.FallbackInvokeMember(target, args, None)
+
+### BenchMemberCache times the work a polymorphic call site does when its
+### rules keep missing, binding member invokes on 60 collection types over
+### and over, with runtime.Members caching reflection and without caching.
+###
+def BenchMemberCache (rounds = 20):
+    param = etgen.Exprs.Expression.Parameter(object, "x")
+    targets = [DynamicMetaObject(param, BindingRestrictions.Empty, v)
+               for v in _polymorphicValues()]
+    arg = DynamicMetaObject(etgen.Exprs.Expression.Parameter(object, "y"),
+                            BindingRestrictions.Empty, 3)
+    binders = [(runtime.SymplInvokeMemberBinder("ToString", CallInfo(0)), []),
+               (runtime.SymplInvokeMemberBinder("Equals", CallInfo(1)),
+                [arg])]
+    count = rounds * len(targets) * len(binders)
+    print "member cache: %d binds over %d types" % (count, len(targets))
+    members = runtime.Members
+    try:
+        for name, cache in [("uncached", _UncachedMembers()),
+                            ("cached", runtime.MemberCache())]:
+            runtime.Members = cache
+            secs, res = _time(_bindAll, binders, targets, rounds)
+            _report(name, secs, count, "binds")
+            print "    %-24s hits %d, misses %d" % ("", cache.Hits,
+                                                      cache.Misses)
+    finally:
+        runtime.Members = members
+
+
+##########
+### Overloads
+##########
+
+_convertLoop = """
+(defun convertloop (n)
+   (set i 0)
+   (set res nil)
+   (loop
+      (if (= i n)
+          (break))
+      (set res (system.convert.todouble i))
+      (set res (system.convert.tostring i))
+      (set res (system.math.abs i))
+      (set i (+ i 1)))
+   res)
+"""
+
+### _firstApplicable picks overloads as binders did before SelectOverload.
+###
+def _firstApplicable (candidates, args):
+    for c in candidates:
+        if runtime.ParamsMatchArgs(c[1], args):
+            return c
+    return None
+
+### BenchOverloads times numeric interop calls, to Convert and Math methods
+### that have Object as well as Int32 overloads, when binders take the first
+### applicable overload and when they take the best fit.  It also reports gen0
+### collections as a rough count of the boxing the calls cause.
+###
+def BenchOverloads (n = 100000):
+    print "overloads: %d iterations of 3 interop calls" % n
+    select = runtime.SelectOverload
+    members = runtime.Members
+    try:
+        for name, fun in [("first applicable", _firstApplicable),
+                          ("best fit", select)]:
+            runtime.SelectOverload = fun
+            runtime.Members = runtime.MemberCache()
+            s = sympl.Sympl()
+            module = s.CreateScope()
+            s.ExecuteExpr(_convertLoop, module)
+            call = "(convertloop %d)" % n
+            s.ExecuteExpr("(convertloop 1)", module)
+            GC.Collect()
+            collections = GC.CollectionCount(0)
+            secs, res = _time(s.ExecuteExpr, call, module)
+            _report(name, secs, n * 3, "calls")
+            print "    %-24s %d gen0 collections" % (
+                "", GC.CollectionCount(0) - collections)
+    finally:
+        runtime.SelectOverload = select
+        runtime.Members = members
+
+
+##########
+### Numeric
+##########
+
+_numericLoops = ["""
+(defun fib (n)
+   (if (< n 2)
+       n
+       (+ (fib (- n 1)) (fib (- n 2)))))
+""", """
+(defun sumsquares (n)
+   (set i 0)
+   (set sum 0)
+   (loop
+      (if (= i n)
+          (break))
+      (set sum (+ sum (* i i)))
+      (set i (+ i 1)))
+   sum)
+"""]
+
+### BenchNumeric times fib and a sum of squares with runtime.BindArithmetic's
+### typed rules, and with the generic MakeBinary rules binders used before.
+### Fib does 3 ops per call, and the loop 4 per iteration.  The default n keeps
+### the sum within an Int32, which the generic rules would silently wrap.
+###
+def BenchNumeric (fibn = 22, n = 1000, calls = 200):
+    a, b = 1, 1
+    for i in xrange(fibn):
+        a, b = b, a + b
+    fibCalls = 2 * a - 1
+    print "numeric: fib %d, %d calls of sumsquares %d" % (fibn, calls, n)
+    bind = runtime.BindArithmetic
+    try:
+        for name, fun in [("generic", lambda op, left, right: None),
+                          ("typed", bind)]:
+            runtime.BindArithmetic = fun
+            s = sympl.Sympl()
+            module = s.CreateScope()
+            for defun in _numericLoops:
+                s.ExecuteExpr(defun, module)
+            call = "(fib %d)" % fibn
+            secs, res = _time(s.ExecuteExpr, call, module)
+            _report(name + " fib", secs, fibCalls * 3, "ops")
+            call = "(sumsquares %d)" % n
+            secs, res = _time(lambda: [s.ExecuteExpr(call, module)
+                                       for i in xrange(calls)])
+            _report(name + " sumsquares", secs, n * calls * 4, "ops")
+            if res[-1] != sum([i * i for i in xrange(n)]):
+                raise Exception("sumsquares returned " + repr(res[-1]))
+    finally:
+        runtime.BindArithmetic = bind
+
+
+##########
+### Rule sharing
+##########
+
+### MakeRuleProgram returns Sympl code defining count functions that do the
+### same few dynamic operations at their own sites, and a runall function that
+### calls each of them.
+###
+def MakeRuleProgram (count):
+    defuns = ["""
+(defun f%d (lst)
+   (set x (+ (elt lst 0) %d))
+   (set s (x.ToString))
+   (cons s (eq s "1")))""" % (i, i) for i in xrange(count)]
+    calls = ["(f%d lst)" % i for i in xrange(count)]
+    return defuns + ["(defun runall (lst) %s)" % " ".join(calls)]
+
+### BenchRules runs a program with count copies of the same operations and
+### reports, for each kind of binder, how many sites use the canonical binders
+### and how many rules those binders had to bind.  With L2 sharing, rules stay
+### near one per binder and operand types rather than one per site.
+###
+def BenchRules (count = 500):
+    s = sympl.Sympl()
+    module = s.CreateScope()
+    for defun in MakeRuleProgram(count):
+        s.ExecuteExpr(defun, module)
+    secs, res = _time(s.ExecuteExpr, "(runall (list 1 2))", module)
+    print "rules: %d functions" % count
+    _report("first run", secs, count, "calls")
+    secs, res = _time(s.ExecuteExpr, "(runall (list 1 2))", module)
+    _report("second run", secs, count, "calls")
+    totals = {}
+    for kind, key, sites, rules in s.GetRuleStats():
+        binders, allSites, allRules = totals.get(kind, (0, 0, 0))
+        totals[kind] = (binders + 1, allSites + sites, allRules + (rules or 0))
+    for kind in sorted(totals):
+        binders, sites, rules = totals[kind]
+        print "    %-24s %5d binders %7d sites %7d rules" % (
+            kind, binders, sites, rules)
+
+
+##########
+### Instrumentation
+##########
+
+### BenchInstrumentation times the rule sharing program with instrumentation
+### disabled and enabled, showing what enabling costs, and prints the report.
+###
+def BenchInstrumentation (count = 500):
+    print "instrumentation: %d functions" % count
+    instrumentation = runtime.BinderInstrumentation()
+    for name, enabled in [("disabled", False), ("enabled", True)]:
+        s = sympl.Sympl()
+        if enabled:
+            s.Instrumentation = instrumentation
+        module = s.CreateScope()
+        for defun in MakeRuleProgram(count):
+            s.ExecuteExpr(defun, module)
+        secs, res = _time(s.ExecuteExpr, "(runall (list 1 2))", module)
+        _report(name + " first run", secs, count, "calls")
+        secs, res = _time(s.ExecuteExpr, "(runall (list 1 2))", module)
+        _report(name + " second run", secs, count, "calls")
+    instrumentation.Report()
+
+
+##########
+### Globals
+##########
+
+### BenchGlobals times recursive fib, whose calls to itself each fetch the
+### global fib, with dynamic module lookups and with ResolveGlobals slots.
+###
+def BenchGlobals (fibn = 22, repeat = 3):
+    a, b = 1, 1
+    for i in xrange(fibn):
+        a, b = b, a + b
+    calls = 2 * a - 1
+    print "globals: %d runs of fib %d" % (repeat, fibn)
+    for name, resolve in [("dynamic lookup", False), ("global slots", True)]:
+        s = sympl.Sympl()
+        s.ResolveGlobals = resolve
+        module = s.CreateScope()
+        s.ExecuteExpr(_numericLoops[0], module)
+        call = "(fib %d)" % fibn
+        secs, res = _time(lambda: [s.ExecuteExpr(call, module)
+                                   for i in xrange(repeat)])
+        _report(name, secs, calls * repeat, "calls")
+        if res[-1] != b - a:
+            raise Exception("fib returned " + repr(res[-1]))
+
+
+##########
+### Optimizer
+##########
+
+### _constantLoop is a loop whose body has arithmetic on literals and a debug
+### branch that is off, the kind of code the optimizer is for.
+###
+_constantLoop = """
+(defun seconds (n)
+   (let* ((i 0) (total 0))
+      (loop
+         (if (eq i n) (break total))
+         (if false (System.Console.WriteLine "debug"))
+         (set total (+ total (* (* 24 60) 60)))
+         (set i (+ i 1)))))"""
+
+### BenchOptimizer reports what the optimizer finds in the examples and in
+### _constantLoop, how long it takes, and times running _constantLoop with
+### Optimize off and on.
+###
+def BenchOptimizer (size = 1024 * 1024, n = 100000):
+    print "optimizer: %d chars of examples" % size
+    ASTs = parser.ParseFile(StringReader(MakeCorpus(size)))
+    stats = optimizer.OptimizerStats()
+    secs, res = _time(optimizer.Optimize, ASTs, stats)
+    _report("optimize examples", secs, len(ASTs), "exprs")
+    print "    sites %d before, %d after; %s" % (
+        optimizer.CountSites(ASTs), optimizer.CountSites(res), stats.Report())
+    loop = parser.ParseFile(StringReader(_constantLoop))
+    stats = optimizer.OptimizerStats()
+    res = optimizer.Optimize(loop, stats)
+    print "    loop sites %d before, %d after; %s" % (
+        optimizer.CountSites(loop), optimizer.CountSites(res), stats.Report())
+    for name, optimize in [("loop unoptimized", False),
+                           ("loop optimized", True)]:
+        s = sympl.Sympl()
+        s.Optimize = optimize
+        module = s.CreateScope()
+        s.ExecuteExpr(_constantLoop, module)
+        secs, res = _time(s.ExecuteExpr, "(seconds %d)" % n, module)
+        _report(name, secs, n, "iterations")
+        if res != n * 24 * 60 * 60:
+            raise Exception("seconds returned " + repr(res))
+
+
+##########
+### Tail calls
+##########
+
+### _listWalkers count the elements of a list recursively, count-list calling
+### itself and walk-even and walk-odd calling each other.
+###
+_listWalkers = ["""
+(defun count-list (lst n)
+   (if (eq lst nil) n (count-list lst.Rest (+ n 1))))""", """
+(defun walk-even (lst n)
+   (if (eq lst nil) n (walk-odd lst.Rest (+ n 1))))""", """
+(defun walk-odd (lst n)
+   (if (eq lst nil) n (walk-even lst.Rest (+ n 1))))"""]
+
+### BenchTailCalls runs the list walkers with each TailCalls mode.  They walk
+### a list depth long where the mode lets them run in constant stack, and one
+### shallow long where they would otherwise run out of stack (which ends the
+### process on the CLR rather than raising an exception).
+###
+def BenchTailCalls (depth = 1000000, shallow = 1000):
+    print "tailcalls: lists of %d and %d elements" % (depth, shallow)
+    lists = {depth : _chainList(*range(depth)),
+             shallow : _chainList(*range(shallow))}
+    for mode in ["none", "self", "trampoline"]:
+        s = sympl.Sympl()
+        s.TailCalls = mode
+        module = s.CreateScope()
+        for defun in _listWalkers:
+            s.ExecuteExpr(defun, module)
+        for fun, deep in [("count-list", mode != "none"),
+                          ("walk-even", mode == "trampoline")]:
+            n = shallow
+            if deep:
+                n = depth
+            call = "(%s lst 0)" % fun
+            runtime.DynamicObjectHelpers.SetMember(module, "lst",
+                                                   lists[shallow])
+            s.ExecuteExpr(call, module)
+            runtime.DynamicObjectHelpers.SetMember(module, "lst", lists[n])
+            secs, res = _time(s.ExecuteExpr, call, module)
+            _report("%s %s" % (mode, fun), secs, n, "calls")
+            if res != n:
+                raise Exception(fun + " returned " + repr(res))
+
+
+##########
+### Streaming
+##########
+
+### _reparseLines feeds lines the way test.py's REPL used to, parsing all the
+### text so far after each line to see if it is complete, and returns the
+### number of exprs.
+###
+def _reparseLines (lines):
+    exprs = 0
+    text = ""
+    for line in lines:
+        text = text + " " + line
+        try:
+            parser.ParseExpr(StringReader(text))
+        except Exception:
+            continue
+        exprs = exprs + 1
+        text = ""
+    return exprs
+
+def _feedLines (lines):
+    exprs = 0
+    incremental = parser.IncrementalParser()
+    for line in lines:
+        if incremental.Feed(line + "\n") == "complete":
+            exprs = exprs + len(list(incremental.GetExprs(True)))
+    return exprs
+
+### BenchStream times entering a defun with a lines long body one line at a
+### time, reparsing the input so far after each line and with an
+### IncrementalParser, and times ExecuteStream running the rule sharing
+### program.
+###
+def BenchStream (lines = 2000, count = 500):
+    print "stream: defun of %d lines, %d functions" % (lines, count)
+    input = (["(defun long (x)"] +
+             ["   (set x (+ x %d))" % i for i in xrange(lines)] + ["   x)"])
+    for name, fun in [("reparse lines", _reparseLines),
+                      ("incremental lines", _feedLines)]:
+        secs, res = _time(fun, input)
+        _report(name, secs, len(input), "lines")
+        if res != 1:
+            raise Exception(name + " found " + repr(res) + " exprs")
+    text = "\n".join(MakeRuleProgram(count)) + "\n(runall (list 1 2))"
+    s = sympl.Sympl()
+    module = s.CreateScope()
+    secs, res = _time(s.ExecuteStream, StringReader(text), module)
+    _report("execute stream", secs, count + 2, "exprs", len(text))
+
+
+
+_benchmarks = [("lexer", BenchLexer), ("modulecache", BenchModuleCache),
+               ("analyze", BenchAnalyze), ("parser", BenchParser),
+               ("lists", BenchLists), ("memory", BenchMemory),
+               ("binders", BenchBinders),
+               ("compilethreads", BenchCompileThreads),
+               ("snippets", BenchSnippets), ("startup", BenchStartup),
+               ("membercache", BenchMemberCache),
+               ("overloads", BenchOverloads), ("numeric", BenchNumeric),
+               ("rules", BenchRules),
+               ("instrumentation", BenchInstrumentation),
+               ("globals", BenchGlobals), ("optimizer", BenchOptimizer),
+               ("tailcalls", BenchTailCalls), ("stream", BenchStream)]
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or [name for name, fun in _benchmarks]
+    for name, fun in _benchmarks:
+        if name in names:
+            fun()
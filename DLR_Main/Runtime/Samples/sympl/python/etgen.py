@@ -9,6 +9,7 @@ else:
 
 from System.Collections.Generic import IEnumerable
 from System.Dynamic import CallInfo
+from System.Runtime.CompilerServices import StrongBox
 
 import System
 
@@ -19,109 +20,143 @@ import lexer
 ### AnalyzeExpr performs semantic checkind and name binding on the expression.
 ### It returns an Expression.
 ###
-#def AnalyzeExpr (expr, scope):
-#    expr.Analyze(scope)
-#    dict[type(expr)](scope)
-#
-#def AnalyzeImportExpr (self, scope):
-#    pass
-#parser.SymplImportExpr.Analyze = AnalyzeImportExpr
+### AnalyzeExpr dispatches on the expression's type through the _analyzers
+### table (see RegisterAnalyzer at the end of the Analyze functions), so every
+### node kind costs one dict lookup rather than a test per kind before it.
 ###
 def AnalyzeExpr (expr, scope):
     exprtype = type(expr)
-    debugprint("exprtype: ", exprtype)
-    if exprtype is parser.SymplImportExpr:
-        return AnalyzeImportExpr(expr, scope)
-    elif exprtype is parser.SymplFunCallExpr:
-        return AnalyzeFunCallExpr(expr, scope)
-    elif exprtype is parser.SymplDefunExpr:
-        return AnalyzeDefunExpr(expr, scope)
-    elif exprtype is parser.SymplLambdaExpr:
-        return AnalyzeLambdaExpr(expr, scope)
-    elif exprtype is parser.SymplIdExpr:
-        return AnalyzeIdExpr(expr, scope)
-    elif exprtype is parser.SymplQuoteExpr:
-        return AnalyzeQuoteExpr(expr, scope)
-    elif exprtype is parser.SymplLiteralExpr:
-        return Exprs.Expression.Constant(expr.Value)
-    elif exprtype is parser.SymplAssignExpr:
-        return AnalyzeAssignExpr(expr, scope)
-    elif exprtype is parser.SymplLetStarExpr:
-        return AnalyzeLetStarExpr(expr, scope)
-    elif exprtype is parser.SymplBlockExpr:
-        return AnalyzeBlockExpr(expr, scope)
-    elif exprtype is parser.SymplEqExpr:
-        return AnalyzeEqExpr(expr, scope)
-    elif exprtype is parser.SymplConsExpr:
-        return AnalyzeConsExpr(expr, scope)
-    elif exprtype is parser.SymplListCallExpr:
-        return AnalyzeListCallExpr(expr, scope)
-    elif exprtype is parser.SymplIfExpr:
-        return AnalyzeIfExpr(expr, scope)
-    elif exprtype is parser.SymplDottedExpr:
-        return AnalyzeDottedExpr(expr, scope)
-    elif exprtype is parser.SymplLoopExpr:
-        return AnalyzeLoopExpr(expr, scope)
-    elif exprtype is parser.SymplBreakExpr:
-        return AnalyzeBreakExpr(expr, scope)
-    elif exprtype is parser.SymplEltExpr:
-        return AnalyzeEltExpr(expr, scope)
-    elif exprtype is parser.SymplNewExpr:
-        return AnalyzeNewExpr(expr, scope)
-    elif exprtype is parser.SymplBinaryExpr:
-        return AnalyzeBinaryExpr(expr, scope)
-    elif exprtype is parser.SymplUnaryExpr:
-        return AnalyzeUnaryExpr(expr, scope)
-    else:
-        raise Exception("Internal: no expression to analyze -- " +
-                        repr(expr))
+    if _debug: debugprint("exprtype: ", exprtype)
+    analyzer = _analyzers.get(exprtype)
+    if analyzer is None:
+        analyzer = _findAnalyzer(exprtype)
+        if analyzer is None:
+            raise Exception("Internal: no expression to analyze -- " +
+                            repr(expr))
+    return analyzer(expr, scope)
+
+### RegisterAnalyzer makes AnalyzeExpr call analyzer(expr, scope) for exprs of
+### type exprtype, which can be a new kind of SymplExpr or a subtype of one
+### that needs different analysis.  Subtypes of types with analyzers use their
+### base type's analyzer unless they have their own.
+###
+def RegisterAnalyzer (exprtype, analyzer):
+    ## Forget what subtypes inherited in case exprtype is a base type of them.
+    for t in _inheritedAnalyzers:
+        del _analyzers[t]
+    del _inheritedAnalyzers[:]
+    _analyzers[exprtype] = analyzer
+
+### _findAnalyzer looks for an analyzer for a base type of exprtype, and if
+### there is one, records it for exprtype so that it is found directly next
+### time.  It returns None if there is no analyzer.
+###
+def _findAnalyzer (exprtype):
+    for t in getattr(exprtype, "__mro__", ())[1:]:
+        analyzer = _analyzers.get(t)
+        if analyzer is not None:
+            _analyzers[exprtype] = analyzer
+            _inheritedAnalyzers.append(exprtype)
+            return analyzer
+    return None
+
+_analyzers = dict()
+_inheritedAnalyzers = []
+
+### AnalyzeBody analyzes a sequence of expressions, such as a function body,
+### and returns a list of Expressions.  If the scope has a document, then
+### before each expression it adds a DebugInfo expression marking the source
+### lines and columns the expression came from.  We only mark expressions in
+### bodies, not every sub expression, since that is where a debugger steps and
+### since some Expressions (for example, Assign's left side) have to be
+### particular node types.
+###
+def AnalyzeBody (exprs, scope):
+    document = scope.GetDocument()
+    if document is None:
+        return [AnalyzeExpr(e, scope) for e in exprs]
+    source = scope.GetSource()
+    body = []
+    for e in exprs:
+        if e.Start >= 0:
+            startLine, startCol = source.GetLineColumn(e.Start)
+            endLine, endCol = source.GetLineColumn(e.End)
+            body.append(Exprs.Expression.DebugInfo(document, startLine,
+                                                   startCol, endLine, endCol))
+        body.append(AnalyzeExpr(e, scope))
+    return body
 
 ### Returns a call to the import runtime helper function.
 ###
+def AnalyzeLiteralExpr (expr, scope):
+    return Exprs.Expression.Constant(expr.Value)
+
 def AnalyzeImportExpr (expr, scope):
     debugprint("analyze import ...")
-    if type(expr) is not parser.SymplImportExpr:
+    if not isinstance(expr, parser.SymplImportExpr):
         raise Exception("Internal: need import expr to analyze.")
     if not scope.IsModule():
         raise Exception("Import expression must be a top level expression.")
     return runtime.MakeSymplImportCall(scope.RuntimeExpr, scope.ModuleExpr,
                                        expr.NamespaceExpr, expr.MemberNames,
-                                       expr.Renames)
+                                       expr.Renames, scope.GetRuntime())
 
 def AnalyzeDefunExpr (expr, scope):
     debugprint("analyze defun ...", expr.Name.Name)
-    if type(expr) is not parser.SymplDefunExpr:
+    if not isinstance(expr, parser.SymplDefunExpr):
         raise Exception("Internal: need defun to analyze.")
     if not scope.IsModule():
         raise Exception("Use Defmethod or Lambda when not defining " +
                         "top-level function.")
-    return Exprs.Expression.Dynamic(
-               scope.GetRuntime().GetSetMemberBinder(expr.Name.Name), 
-               object,
-               [scope.ModuleExpr, 
-                AnalyzeLambdaDef(expr, scope, "defun " + expr.Name.Name)])
+    fun = _addTailEntry(AnalyzeLambdaDef(expr, scope, "defun " + expr.Name.Name),
+                        scope)
+    if scope.DefunCompiler is not None:
+        fun = scope.DefunCompiler.Add(fun, scope)
+    return _setGlobal(expr.Name.Name, fun, scope)
 
 def AnalyzeLambdaExpr (expr, scope):
     debugprint("analyze lambda ...")
-    if type(expr) is not parser.SymplLambdaExpr:
+    if not isinstance(expr, parser.SymplLambdaExpr):
         raise Exception("Internal: need lambda to analyze.")
-    return AnalyzeLambdaDef(expr, scope, "lambda")
-
+    return _addTailEntry(AnalyzeLambdaDef(expr, scope, "lambda"), scope)
+
+### AnalyzeLambdaDef returns a LambdaExpr for a defun or lambda.  Unless the
+### runtime's TailCalls is "none", it first finds the calls in tail position
+### (see _findTailCalls) for AnalyzeFunCallExpr.  If a defun has tail calls to
+### itself, the body runs in a block of its own variables after a label, and
+### the tail calls set the parameters and jump to the label instead of calling
+### (see _analyzeSelfTailCall).  The block gives each time around fresh
+### variables so that closures made in one call do not see the next call's
+### arguments.
+###
 def AnalyzeLambdaDef (expr, scope, description):
     funscope = AnalysisScope(scope, description)
     funscope.IsLambda = True  # needed for return support.
-    paramsInOrder = []
-    for p in expr.Params:
-        var = Exprs.Expression.Parameter(object, p.Name)
-        paramsInOrder.append(var)
+    paramsInOrder = [Exprs.Expression.Parameter(object, p.Name)
+                     for p in expr.Params]
+    varsInOrder = paramsInOrder
+    if scope.GetRuntime().TailCalls != "none":
+        funscope.TailCalls = _findTailCalls(expr.Body)
+        if isinstance(expr, parser.SymplDefunExpr):
+            funscope.SelfName = expr.Name.Name.lower()
+            funscope.TailParams = paramsInOrder
+            if [c for c in funscope.TailCalls
+                if _isSelfCall(c, funscope, None)]:
+                funscope.TailLoop = Exprs.Expression.Label("self tail call")
+                varsInOrder = [Exprs.Expression.Parameter(object, p.Name)
+                               for p in expr.Params]
+    for p, var in zip(expr.Params, varsInOrder):
         funscope.Names[p.Name.lower()] = var
     ## No need to add fun name to module scope since recursive call just looks
     ## up global name late bound.  For lambdas,to get the effect of flet to
     ## support recursion, bind a variable to nil and then set it to a lambda.
     ## Then the lambda's body can refer to the let bound var in its def.
-    body = []
-    for e in expr.Body:
-        body.append(AnalyzeExpr(e, funscope))
+    body = AnalyzeBody(expr.Body, funscope)
+    if funscope.TailLoop is not None:
+        inits = [Exprs.Expression.Assign(var, param)
+                 for var, param in zip(varsInOrder, paramsInOrder)]
+        body = [Exprs.Expression.Label(funscope.TailLoop),
+                Exprs.Expression.Block(object, varsInOrder, inits + body)]
     return Exprs.Expression.Lambda(
                Exprs.Expression.GetFuncType(
                    System.Array[System.Type](
@@ -131,14 +166,77 @@ def AnalyzeLambdaDef (expr, scope, description):
                Exprs.Expression.Block.Overloads[IEnumerable[Exprs.Expression]](body),
                paramsInOrder)
 
+### _findTailCalls returns the set of SymplFunCallExprs in tail position in the
+### body, that is, whose value is the value of the body.  These are calls that
+### are the last expr of the body, or the branches of an if, the second
+### operand of an and, or the last expr of a let* or block, in tail position.
+### The operands of or are not since etgen binds them to variables to test.
+###
+def _findTailCalls (body):
+    calls = set()
+    while body:
+        expr = body[-1]
+        body = None
+        exprtype = type(expr)
+        if exprtype is parser.SymplFunCallExpr:
+            calls.add(expr)
+        elif exprtype is parser.SymplIfExpr:
+            calls.update(_findTailCalls([expr.Consequent]))
+            if expr.Alternative is not None:
+                body = [expr.Alternative]
+        elif (exprtype is parser.SymplBinaryExpr and
+              expr.Op == Exprs.ExpressionType.And):
+            body = [expr.Right]
+        elif (exprtype is parser.SymplLetStarExpr or
+              exprtype is parser.SymplBlockExpr):
+            body = expr.Body
+    return calls
+
+
+### _addTailEntry returns fun, a LambdaExpr for a defun or lambda, when the
+### runtime's TailCalls is not "trampoline".  Otherwise fun's tail calls
+### return runtime.TailCalls, so this returns an Expression for a function
+### that calls fun and runs the TailCalls it returns (see _runTailCalls).
+### Since the function never returns a TailCall, callers do not need to know
+### about trampolining.  It records fun as its inner entry for tail calls to
+### use (see _makeTailCall).
+###
+def _addTailEntry (fun, scope):
+    if scope.GetRuntime().TailCalls != "trampoline":
+        return fun
+    entry = Exprs.Expression.Parameter(fun.Type, "tailEntry")
+    params = [Exprs.Expression.Parameter(object, p.Name)
+              for p in fun.Parameters]
+    wrapper = Exprs.Expression.Lambda(
+                  fun.Type,
+                  _runTailCalls(Exprs.Expression.Invoke(entry, params)),
+                  params)
+    return Exprs.Expression.Block(object, [entry], [
+               Exprs.Expression.Assign(entry, fun),
+               Exprs.Expression.Dynamic(
+                   runtime.GetRunHelpersInvokeBinder(scope.GetRuntime(), 2),
+                   object,
+                   Exprs.Expression.Constant(
+                       runtime.RuntimeHelpers.AddTailEntry),
+                   wrapper, entry)])
 
 ### Returns a dynamic InvokeMember or Invoke expression, depending on the
-### Function expression.
+### Function expression.  Tail calls a defun makes to itself jump back to the
+### top of the defun (see AnalyzeLambdaDef).  When the runtime's TailCalls is
+### "trampoline", other tail calls to a function value return a
+### runtime.TailCall that calls the function's inner entry (see _makeTailCall
+### and _addTailEntry).  Tail calls to members are plain calls since their
+### functions are fetched by the InvokeMember binder.
 ###
 def AnalyzeFunCallExpr (expr, scope):
     debugprint("analyze function ...", expr.Function)
-    if type(expr) is not parser.SymplFunCallExpr:
+    if not isinstance(expr, parser.SymplFunCallExpr):
         raise Exception("Internal: need function call to analyze.")
+    funscope = _findFirstLambda(scope)
+    isTail = (funscope is not None and funscope.TailCalls is not None and
+              expr in funscope.TailCalls)
+    if isTail and _isSelfCall(expr, funscope, scope):
+        return _analyzeSelfTailCall(expr, funscope, scope)
     if type(expr.Function) is parser.SymplDottedExpr:
         if len(expr.Function.Exprs) > 1:
             objExpr = AnalyzeDottedExpr(
@@ -148,30 +246,116 @@ def AnalyzeFunCallExpr (expr, scope):
         else:
             objExpr = AnalyzeExpr(expr.Function.ObjectExpr, scope)
         args = [AnalyzeExpr(a, scope) for a in expr.Arguments]
-        return Exprs.Expression.Dynamic(
-                   scope.GetRuntime().GetInvokeMemberBinder(
-                      runtime.InvokeMemberBinderKey(
+        binder = scope.GetRuntime().GetInvokeMemberBinder(
+                     runtime.InvokeMemberBinderKey(
                          ## Last must be ID.
                          expr.Function.Exprs[-1].IdToken.Name,
-                         CallInfo(len(args)))),
-                   object,
-                   [objExpr] + args)
+                         CallInfo(len(args))))
+        args = [objExpr] + args
     else:
         fun = AnalyzeExpr(expr.Function, scope)
         args = [AnalyzeExpr(a, scope) for a in expr.Arguments]
         ## Use DynExpr so that I don't always have to have a delegate to call,
         ## such as what happens with IPy interop.
-        return Exprs.Expression.Dynamic(
-                 scope.GetRuntime().GetInvokeBinder(CallInfo(len(args))),
-                 object,
-                 [fun] + args)
+        binder = scope.GetRuntime().GetInvokeBinder(CallInfo(len(args)))
+        args = [fun] + args
+    if (isTail and scope.GetRuntime().TailCalls == "trampoline" and
+        type(expr.Function) is not parser.SymplDottedExpr):
+        return _makeTailCall(binder, args, scope)
+    return Exprs.Expression.Dynamic(binder, object, args)
+
+### _isSelfCall returns whether the call is to the defun funscope is for, with
+### the right number of arguments.  If scope is not None, the call is in scope,
+### and the function's name must not be a local variable there.
+###
+def _isSelfCall (expr, funscope, scope):
+    fun = expr.Function
+    return (funscope.SelfName is not None and
+            type(fun) is parser.SymplIdExpr and
+            not fun.IdToken.IsKeywordToken and
+            fun.IdToken.Name.lower() == funscope.SelfName and
+            len(expr.Arguments) == len(funscope.TailParams) and
+            (scope is None or _findIdDef(fun.IdToken.Name, scope) is None))
+
+### _analyzeSelfTailCall returns an Expression that sets the defun's parameters
+### to the call's arguments and jumps to the top of the defun.  It can set each
+### parameter as soon as it has the argument since the body's code refers to
+### variables that hold the parameters' values, not the parameters.
+###
+def _analyzeSelfTailCall (expr, funscope, scope):
+    body = [Exprs.Expression.Assign(
+                param,
+                Exprs.Expression.Convert(AnalyzeExpr(a, scope), object))
+            for param, a in zip(funscope.TailParams, expr.Arguments)]
+    body.append(Exprs.Expression.Goto(funscope.TailLoop, object))
+    return Exprs.Expression.Block.Overloads[IEnumerable[Exprs.Expression]](body)
+
+### _makeTailCall returns an Expression that evaluates the dynamic Invoke's
+### args and returns a runtime.TailCall with a thunk that makes the call, so
+### the caller's frame is gone when the call happens.  The thunk calls the
+### function's inner entry if it has one so that the function returns its own
+### tail calls to the trampoline running the thunk.
+###
+def _makeTailCall (binder, args, scope):
+    temps = [Exprs.Expression.Parameter(object, "tailCallArg") for a in args]
+    body = [Exprs.Expression.Assign(t, Exprs.Expression.Convert(a, object))
+            for t, a in zip(temps, args)]
+    fun = Exprs.Expression.Dynamic(
+              runtime.GetRunHelpersInvokeBinder(scope.GetRuntime(), 1),
+              object,
+              Exprs.Expression.Constant(runtime.RuntimeHelpers.GetTailEntry),
+              temps[0])
+    thunk = Exprs.Expression.Lambda(
+                Exprs.Expression.GetFuncType(
+                    System.Array[System.Type]([object])),
+                Exprs.Expression.Dynamic(binder, object, [fun] + temps[1:]),
+                [])
+    tailCallType = clr.GetClrType(runtime.TailCall)
+    body.append(Exprs.Expression.New(
+                    tailCallType.GetConstructor(
+                        System.Array[System.Type]([thunk.Type])),
+                    thunk))
+    return Exprs.Expression.Block(object, temps, body)
+
+### _runTailCalls returns an Expression for the value of call, running the
+### thunks of any runtime.TailCalls it produces.
+###
+def _runTailCalls (call):
+    tailCallType = clr.GetClrType(runtime.TailCall)
+    result = Exprs.Expression.Parameter(object, "callResult")
+    done = Exprs.Expression.Label(object, "tail calls done")
+    return Exprs.Expression.Block(object, [result], [
+               Exprs.Expression.Assign(result, call),
+               Exprs.Expression.Loop(
+                   Exprs.Expression.IfThenElse(
+                       Exprs.Expression.TypeIs(result, tailCallType),
+                       Exprs.Expression.Assign(
+                           result,
+                           Exprs.Expression.Invoke(
+                               Exprs.Expression.Field(
+                                   Exprs.Expression.Convert(result,
+                                                            tailCallType),
+                                   "Value"))),
+                       Exprs.Expression.Break(done, result)),
+                   done)])
+
+### _findFirstLambda returns the innermost lambda AnalysisScope or None.
+###
+def _findFirstLambda (scope):
+    curscope = scope
+    while curscope is not None:
+        if curscope.IsLambda:
+            return curscope
+        else:
+            curscope = curscope.Parent
+    return None
 
 ### Returns a chain of GetMember and InvokeMember dynamic expressions for
 ### the dotted expr.
 ###
 def AnalyzeDottedExpr (expr, scope):
     debugprint("analyze dotted ...", expr.ObjectExpr)
-    if type(expr) is not parser.SymplDottedExpr:
+    if not isinstance(expr, parser.SymplDottedExpr):
         raise Exception("Internal: need dotted expr to analyze.")
     curExpr = AnalyzeExpr(expr.ObjectExpr, scope)
     for e in expr.Exprs:
@@ -210,17 +394,7 @@ def AnalyzeAssignExpr (expr, scope):
                        lhs,
                        Exprs.Expression.Convert(val, param.Type))
         else:
-            tmp = Exprs.Expression.Parameter(object, "assignTmpForRes")
-            return Exprs.Expression.Block([tmp], [
-                       Exprs.Expression.Assign(
-                           tmp,
-                           Exprs.Expression.Convert(val, object)),
-                       Exprs.Expression.Dynamic(
-                           scope.GetRuntime().GetSetMemberBinder(
-                               expr.Location.IdToken.Name), 
-                           object,
-                           [scope.GetModuleExpr(), tmp]),
-                       tmp])
+            return _setGlobal(expr.Location.IdToken.Name, val, scope)
     elif loctype is parser.SymplEltExpr:
         obj = AnalyzeExpr(expr.Location.ObjectExpr, scope)
         args = [AnalyzeExpr(x, scope) for x in expr.Location.Indexes]
@@ -252,7 +426,7 @@ def AnalyzeAssignExpr (expr, scope):
 ###
 def AnalyzeIdExpr (expr, scope):
     debugprint("analyze ID ...", expr.IdToken.Name)
-    if type(expr) is not parser.SymplIdExpr:
+    if not isinstance(expr, parser.SymplIdExpr):
         raise Exception("Internal: need ID Expr to analyze.")
     if expr.IdToken.IsKeywordToken:
         if expr.IdToken is parser.lexer.KeywordToken.Nil:
@@ -268,10 +442,75 @@ def AnalyzeIdExpr (expr, scope):
         if param is not None:
             return param
         else:
-            return Exprs.Expression.Dynamic(
-               scope.GetRuntime().GetGetMemberBinder(expr.IdToken.Name), 
-               object,
-               scope.GetModuleExpr())
+            return _getGlobal(expr.IdToken.Name, scope)
+
+### _getGlobal returns an Expression for fetching the module global name.
+### Without GlobalSlots, it is a dynamic member lookup on the module object.
+### With them, it reads the name's slot, and only when the slot does not know
+### the value (see runtime.ModuleGlobals), it looks up the member and stores it
+### in the slot.
+###
+def _getGlobal (name, scope):
+    getter = Exprs.Expression.Dynamic(
+                 scope.GetRuntime().GetGetMemberBinder(name), 
+                 object,
+                 scope.GetModuleExpr())
+    slots = scope.GetGlobalSlots()
+    if slots is None:
+        return getter
+    value = Exprs.Expression.Field(slots.GetSlot(name), "Value")
+    tmp = Exprs.Expression.Parameter(object, "globalTmp")
+    return Exprs.Expression.Block([tmp], [
+               Exprs.Expression.Assign(tmp, value),
+               Exprs.Expression.Condition(
+                   Exprs.Expression.ReferenceEqual(
+                       tmp,
+                       Exprs.Expression.Constant(
+                           runtime.DynamicObjectHelpers.Sentinel)),
+                   Exprs.Expression.Assign(value, getter),
+                   tmp)])
+
+### _setGlobal returns an Expression that sets the module global name to the
+### value of val and returns the value.  It always sets the module member, so
+### hosts see the change, and then with GlobalSlots it also sets the slot.
+###
+def _setGlobal (name, val, scope):
+    tmp = Exprs.Expression.Parameter(object, "assignTmpForRes")
+    body = [Exprs.Expression.Assign(tmp,
+                                    Exprs.Expression.Convert(val, object)),
+            Exprs.Expression.Dynamic(
+                scope.GetRuntime().GetSetMemberBinder(name), 
+                object,
+                [scope.GetModuleExpr(), tmp])]
+    slots = scope.GetGlobalSlots()
+    if slots is not None:
+        body.append(Exprs.Expression.Assign(
+                        Exprs.Expression.Field(slots.GetSlot(name), "Value"),
+                        tmp))
+    body.append(tmp)
+    return Exprs.Expression.Block([tmp], body)
+
+### AddGlobalSlots returns the module body exprs with the code that fetches the
+### module's slots for scope's GlobalSlots wrapped around them, or returns body
+### as is if scope has no GlobalSlots.
+###
+def AddGlobalSlots (body, scope):
+    slots = scope.GlobalSlots
+    if slots is None:
+        return body
+    fetch = Exprs.Expression.Assign(
+                slots.Expr,
+                Exprs.Expression.Convert(
+                    Exprs.Expression.Dynamic(
+                        runtime.GetRunHelpersInvokeBinder(scope.GetRuntime(),
+                                                          2),
+                        object,
+                        Exprs.Expression.Constant(
+                            runtime.RuntimeHelpers.GetModuleSlots),
+                        scope.ModuleExpr,
+                        Exprs.Expression.Constant(slots.Names)),
+                    slots.Expr.Type))
+    return [Exprs.Expression.Block([slots.Expr], [fetch] + list(body))]
 
 ### _findIdDef returns the ParameterExpr for the name by searching the scopes,
 ### or it returns None.
@@ -294,7 +533,7 @@ def _findIdDef (name, scope):
 ###
 def AnalyzeLetStarExpr (expr, scope):
     debugprint("analyze let* ...")
-    if type(expr) is not parser.SymplLetStarExpr:
+    if not isinstance(expr, parser.SymplLetStarExpr):
         raise Exception("Internal: need Let* Expr to analyze.")
     letscope = AnalysisScope(scope, "let*")
     ## Analyze bindings.
@@ -311,9 +550,7 @@ def AnalyzeLetStarExpr (expr, scope):
         ## Add var to scope after analyzing init value so that init value
         ## references to the same ID do not bind to his uninitialized var.
         letscope.Names[b[0].Name.lower()] = var
-    body = []
-    for e in expr.Body:
-        body.append(AnalyzeExpr(e, letscope))
+    body = AnalyzeBody(expr.Body, letscope)
     ## Order of vars to BlockExpr don't matter semantically, but may as well
     ## keep them in the order the programmer specified in case they look at the
     ## Expr Trees in the debugger or for meta-programming.
@@ -323,11 +560,9 @@ def AnalyzeLetStarExpr (expr, scope):
 ###
 def AnalyzeBlockExpr (expr, scope):
     debugprint("analyze block ...")
-    if type(expr) is not parser.SymplBlockExpr:
+    if not isinstance(expr, parser.SymplBlockExpr):
         raise Exception("Internal: need Block Expr to analyze.")
-    body = []
-    for e in expr.Body:
-        body.append(AnalyzeExpr(e, scope))
+    body = AnalyzeBody(expr.Body, scope)
     ## Due to .NET 4.0 co/contra-variance, IPy's binding isn't picking the overload
     ## with Type and IEnumerable<Expr>, so pick it explicitly.
     return Exprs.Expression.Block.Overloads[
@@ -338,7 +573,7 @@ def AnalyzeBlockExpr (expr, scope):
 ###
 def AnalyzeQuoteExpr (expr, scope):
     debugprint("analyze quote ...")
-    if type(expr) is not parser.SymplQuoteExpr:
+    if not isinstance(expr, parser.SymplQuoteExpr):
         raise Exception("Internal: need Quote Expr to analyze.")
     return Exprs.Expression.Constant(
                MakeQuoteConstant(expr.Expr, scope.GetRuntime()))
@@ -359,28 +594,31 @@ def MakeQuoteConstant (expr, symplRuntime):
 
 def AnalyzeEqExpr (expr, scope):
     debugprint("analyze eq ...")
-    if type(expr) is not parser.SymplEqExpr:
+    if not isinstance(expr, parser.SymplEqExpr):
         raise Exception("Internal: need eq expr to analyze.")
     return runtime.MakeSymplEqCall(AnalyzeExpr(expr.Left, scope),
-                                   AnalyzeExpr(expr.Right, scope))
+                                   AnalyzeExpr(expr.Right, scope),
+                                   scope.GetRuntime())
     
 def AnalyzeConsExpr (expr, scope):
     debugprint("analyze cons ...")
-    if type(expr) is not parser.SymplConsExpr:
+    if not isinstance(expr, parser.SymplConsExpr):
         raise Exception("Internal: need cons expr to analyze.")
     return runtime.MakeSymplConsCall(AnalyzeExpr(expr.Left, scope),
-                                     AnalyzeExpr(expr.Right, scope))
+                                     AnalyzeExpr(expr.Right, scope),
+                                     scope.GetRuntime())
     
 def AnalyzeListCallExpr (expr, scope):
     debugprint("analyze List call ...")
-    if type(expr) is not parser.SymplListCallExpr:
+    if not isinstance(expr, parser.SymplListCallExpr):
         raise Exception("Internal: need import expr to analyze.")
     return runtime.MakeSymplListCall([AnalyzeExpr(x, scope)
-                                      for x in expr.Elements])
+                                      for x in expr.Elements],
+                                     scope.GetRuntime())
 
 
 def AnalyzeIfExpr (expr, scope):
-    if type(expr) is not parser.SymplIfExpr:
+    if not isinstance(expr, parser.SymplIfExpr):
         raise Exception("Internal: need IF expr to analyze.")
     if expr.Alternative is not None:
         alt = AnalyzeExpr(expr.Alternative, scope)
@@ -405,14 +643,12 @@ def WrapBooleanTest (expr):
 
 def AnalyzeLoopExpr (expr, scope):
     debugprint("analyze loop ...")
-    if type(expr) is not parser.SymplLoopExpr:
+    if not isinstance(expr, parser.SymplLoopExpr):
         raise Exception("Internal: need loop to analyze.")
     loopscope = AnalysisScope(scope, "loop ")
     loopscope.IsLoop = True  # needed for break and continue
     loopscope.LoopBreak = Exprs.Expression.Label(object, "loop break")
-    body = []
-    for e in expr.Body:
-        body.append(AnalyzeExpr(e, loopscope))
+    body = AnalyzeBody(expr.Body, loopscope)
     ## Due to .NET 4.0 co/contra-variance, IPy's binding isn't picking the overload
     ## with Type and IEnumerable<Expr>, so pick it explicitly.
     return Exprs.Expression.Loop(Exprs.Expression.Block.Overloads
@@ -422,7 +658,7 @@ def AnalyzeLoopExpr (expr, scope):
 
 def AnalyzeBreakExpr (expr, scope):
     debugprint("analyze break ..." + repr(expr.Value))
-    if type(expr) is not parser.SymplBreakExpr:
+    if not isinstance(expr, parser.SymplBreakExpr):
         raise Exception("Internal: need break to analyze.")
     loopscope = _findFirstLoop(scope)
     if loopscope is None:
@@ -450,7 +686,7 @@ def _findFirstLoop (scope):
 
 def AnalyzeNewExpr (expr, scope):
     debugprint("analyze new ...", expr.Typ)
-    if type(expr) is not parser.SymplNewExpr:
+    if not isinstance(expr, parser.SymplNewExpr):
         raise Exception("Internal: need New call to analyze.")
     typ = AnalyzeExpr(expr.Typ, scope)
     args = [AnalyzeExpr(a, scope) for a in expr.Arguments]
@@ -466,7 +702,7 @@ def AnalyzeNewExpr (expr, scope):
 ###
 def AnalyzeEltExpr (expr, scope):
     debugprint("analyze elt ...", expr.ObjectExpr)
-    if type(expr) is not parser.SymplEltExpr:
+    if not isinstance(expr, parser.SymplEltExpr):
         raise Exception("Internal: need Elt call to analyze.")
     obj = AnalyzeExpr(expr.ObjectExpr, scope)
     args = [AnalyzeExpr(a, scope) for a in expr.Indexes]
@@ -478,7 +714,7 @@ def AnalyzeEltExpr (expr, scope):
 
 
 def AnalyzeBinaryExpr (expr, scope):
-    if type(expr) is not parser.SymplBinaryExpr:
+    if not isinstance(expr, parser.SymplBinaryExpr):
         raise Exception("Internal: need binary op to analyze.")
     if expr.Op == Exprs.ExpressionType.And:
         ## (and x y) is (if x y)
@@ -512,7 +748,7 @@ def AnalyzeBinaryExpr (expr, scope):
         
 
 def AnalyzeUnaryExpr (expr, scope):
-    if type(expr) is not parser.SymplUnaryExpr:
+    if not isinstance(expr, parser.SymplUnaryExpr):
         raise Exception("Internal: need Unary op to analyze.")
     if expr.Op == Exprs.ExpressionType.Not:
         ## Sympl has specific semantics for what is true vs. false and would
@@ -529,21 +765,66 @@ def AnalyzeUnaryExpr (expr, scope):
 
 
 
+### _registerAnalyzers sets up AnalyzeExpr's table for Sympl's expressions.
+###
+def _registerAnalyzers ():
+    for exprtype, analyzer in [
+        (parser.SymplImportExpr, AnalyzeImportExpr),
+        (parser.SymplFunCallExpr, AnalyzeFunCallExpr),
+        (parser.SymplDefunExpr, AnalyzeDefunExpr),
+        (parser.SymplLambdaExpr, AnalyzeLambdaExpr),
+        (parser.SymplIdExpr, AnalyzeIdExpr),
+        (parser.SymplQuoteExpr, AnalyzeQuoteExpr),
+        (parser.SymplLiteralExpr, AnalyzeLiteralExpr),
+        (parser.SymplAssignExpr, AnalyzeAssignExpr),
+        (parser.SymplLetStarExpr, AnalyzeLetStarExpr),
+        (parser.SymplBlockExpr, AnalyzeBlockExpr),
+        (parser.SymplEqExpr, AnalyzeEqExpr),
+        (parser.SymplConsExpr, AnalyzeConsExpr),
+        (parser.SymplListCallExpr, AnalyzeListCallExpr),
+        (parser.SymplIfExpr, AnalyzeIfExpr),
+        (parser.SymplDottedExpr, AnalyzeDottedExpr),
+        (parser.SymplLoopExpr, AnalyzeLoopExpr),
+        (parser.SymplBreakExpr, AnalyzeBreakExpr),
+        (parser.SymplEltExpr, AnalyzeEltExpr),
+        (parser.SymplNewExpr, AnalyzeNewExpr),
+        (parser.SymplBinaryExpr, AnalyzeBinaryExpr),
+        (parser.SymplUnaryExpr, AnalyzeUnaryExpr)]:
+        RegisterAnalyzer(exprtype, analyzer)
+
+_registerAnalyzers()
+
+
+
 ### AnalysisScope holds identifier information so that we can do name binding
 ### during analysis.  It manages a map from names to ParameterExprs so ET
 ### definition locations and reference locations can alias the same variable.
 ###
 ### These chain from inner most BlockExprs, through LambdaExprs, to the root
 ### which models a file or top-level expression.  The root has non-None
-### ModuleExpr and RuntimeExpr, which are ParameterExprs.
+### ModuleExpr and RuntimeExpr, which are ParameterExprs.  The root can also
+### have a Document (a SymbolDocumentInfo) and a Source (lexer.SourceIndex) for
+### emitting DebugInfo expressions, and a DefunCompiler that AnalyzeDefunExpr
+### hands defun lambdas to so that they compile on their own (see
+### sympl.DefunCompiler).  The root has GlobalSlots when the module's globals
+### should resolve to slots rather than dynamic lookups (see GlobalSlots).
+###
+### Lambda scopes have TailCalls, the set of SymplFunCallExprs in tail position
+### in their bodies, when the runtime does anything with tail calls.  A defun's
+### scope has its lowercased SelfName, and TailParams, the lambda parameters.
+### TailLoop is the label at the top of the defun if it has self tail calls.
 ###
 class AnalysisScope (object):
     def __init__ (self, parent, nam = "", runtime = None, runtimeParam = None,
-                   moduleParam = None):
+                   moduleParam = None, document = None, source = None):
         self.ModuleExpr = moduleParam
         self.RuntimeExpr = runtimeParam
         ## Need runtime for interning Symbol constants at code gen time.
         self.Runtime = runtime
+        self.Document = document
+        self.Source = source
+        self.DefunCompiler = None
+        self.GlobalSlots = None
         self.Name = nam
         self.Parent = parent
         self.Names = {}
@@ -552,6 +833,10 @@ class AnalysisScope (object):
         self.IsLoop = False
         self.LoopBreak = None
         self.LoopContinue = None
+        self.TailCalls = None
+        self.SelfName = None
+        self.TailParams = None
+        self.TailLoop = None
     
     def IsModule (self):
         return self.ModuleExpr is not None
@@ -568,6 +853,52 @@ class AnalysisScope (object):
             curscope = curscope.Parent
         return curscope.Runtime
 
+    def GetDocument (self):
+        curscope = self
+        while not curscope.IsModule():
+            curscope = curscope.Parent
+        return curscope.Document
+
+    def GetSource (self):
+        curscope = self
+        while not curscope.IsModule():
+            curscope = curscope.Parent
+        return curscope.Source
+
+    def GetGlobalSlots (self):
+        curscope = self
+        while not curscope.IsModule():
+            curscope = curscope.Parent
+        return curscope.GlobalSlots
+
+
+### GlobalSlots numbers the module globals that a file or snippet's code refers
+### to, so the code can reach them through an array of StrongBoxes, Expr,
+### instead of looking them up on the module ExpandoObject.  Names holds the
+### lowercased names in slot order.  AddGlobalSlots wraps the module body in
+### code that gets the array for the running module from runtime.ModuleGlobals,
+### so compiled code is still good for any module.
+###
+class GlobalSlots (object):
+    def __init__ (self):
+        self.Expr = Exprs.Expression.Parameter(
+                        clr.GetClrType(StrongBox[object]).MakeArrayType(),
+                        "globalSlots")
+        self.Names = []
+        self._indexes = dict()
+
+    ### GetSlot returns an Expression for name's StrongBox.
+    ###
+    def GetSlot (self, name):
+        name = name.lower()
+        i = self._indexes.get(name)
+        if i is None:
+            i = len(self.Names)
+            self.Names.append(name)
+            self._indexes[name] = i
+        return Exprs.Expression.ArrayIndex(self.Expr,
+                                           Exprs.Expression.Constant(i))
+
 
 
 ##################
@@ -1,12 +1,28 @@
 
 
+import re
+import bisect
+
+### Lexer tracks source locations as char offsets into the input.
+### TokenStart and TokenEnd are the span of the last token the lexer read.
+### Since GetToken returns a put back token before reading another, they are
+### the span of the token GetToken last returned, or of the token just put
+### back.  Source is a SourceIndex that maps offsets to line and column
+### numbers.  Depth is how many forms the parser is in the middle of parsing
+### by recursion.
+###
 class Lexer (object):
-    def __init__ (self, reader):
+    def __init__ (self, reader, source = None):
         self.Reader = reader
         self._putToken = None
+        self.Source = source or SourceIndex()
+        self.TokenStart = 0
+        self.TokenEnd = 0
+        self._pos = 0
+        self.Depth = 0
 
     def PutToken (self, token):
-        debugprint("puttoken: " + str(token))
+        if _debug: debugprint("puttoken: " + str(token))
         if self._putToken is not None:
             error("Internal Error: putting token when there is one?")
         self._putToken = token
@@ -16,28 +32,35 @@ class Lexer (object):
     ### GetToken is one of two main entry points to Lexer.
     ###
     def GetToken (self):
-        token = self._getToken()
-        debugprint("getoken: " + str(token))
+        token = self._putToken
+        if token is not None:
+            self._putToken = None
+        else:
+            token = self._getToken()
+            self.TokenEnd = self._pos
+        if _debug: debugprint("getoken: " + str(token))
         return token
 
-    ### Returns any saved _putToken, else skips whitespace and returns next
-    ### token from input stream.
+    ### FormatLocation returns a description of where offset is in the input
+    ### for error messages.
+    ###
+    def FormatLocation (self, offset):
+        line, column = self.Source.GetLineColumn(offset)
+        return "line " + str(line) + ", column " + str(column)
+
+    ### Skips whitespace and returns next token from input stream, setting
+    ### TokenStart.  GetToken sets TokenEnd from _pos afterwards.
     ###
     ### If returning token directly based on char, need to gobble char, but if
     ### calling helper function to read more, then they gobble as needed.
     ###
-    ### Need to maintain src loc info and store in token.
-    ###
     def _getToken (self):
-        if self._putToken is not None:
-            tmp = self._putToken
-            self._putToken = None
-            debugprint("returning put token" + str(tmp))
-            return tmp
         self._skipWhitespace()
+        self.TokenStart = self._pos
         ch = self._peekChar()
-        debugprint("gettoken: peek char is " + 
-                   ((ch is SyntaxToken.EOF and "EOF") or ch))
+        if _debug:
+            debugprint("gettoken: peek char is " + 
+                       ((ch is SyntaxToken.EOF and "EOF") or ch))
         if ch is SyntaxToken.EOF:
             return ch
         elif ch == '(':
@@ -75,7 +98,7 @@ class Lexer (object):
             token = self._getNumber()
             token.Value = - token.Value
             return token
-        elif not self._isIdTerminator(ch):
+        elif ch is not SyntaxToken.EOF and not self._isIdTerminator(ch):
             return self._getIdOrKeyword("-")
         else:
             return self._makeIdOrKeywordToken("-")
@@ -121,7 +144,7 @@ class Lexer (object):
         else:
             if name.lower() == "let":
                 print "\nWARNING: using 'let'?  You probaby meant let*.\n"
-            return IdOrKeywordToken(name, False)
+            return IdOrKeywordToken(name, False, self.TokenStart, self._pos)
     
     ### Must not be called on SyntaxToken.EOF
     def _startsId (self, c):
@@ -152,7 +175,7 @@ class Lexer (object):
             res = (res * 10) + (ord(c) - ord('0'))
             self._getChar()
             c = self._peekChar()
-        return NumberToken(res)
+        return NumberToken(res, self.TokenStart, self._pos)
 
     def _getString (self):
         c = self._getChar()
@@ -171,7 +194,7 @@ class Lexer (object):
                 escape = True
             elif c == '"' and not escape:
                 self._getChar()
-                return StringToken(res)
+                return StringToken(res, self.TokenStart, self._pos)
             elif escape:
                 escape = False
                 self._getChar()
@@ -180,7 +203,7 @@ class Lexer (object):
                 elif c == 't':
                     res = res + "\t"
                 elif c == 'r':
-                    res = res = "\r"
+                    res = res + "\r"
                 elif c == '"':
                     res = res + c
                 elif c == '\\':
@@ -195,7 +218,7 @@ class Lexer (object):
     def _skipWhitespace (self):
         ch = self._peekChar()
         while ch in self._whitespaceChars:
-            debugprint("gobble: " + ch)
+            if _debug: debugprint("gobble: " + ch)
             if ch == ';':
                 self._getChar()
                 ch = self._peekChar()
@@ -211,6 +234,9 @@ class Lexer (object):
     def _getChar (self):
         c = self.Reader.Read()
         if c == -1: return SyntaxToken.EOF
+        self._pos = self._pos + 1
+        if c == 10: # '\n'
+            self.Source.AddLineStart(self._pos)
         #debugprint("_getChar: " + chr(c))
         return chr(c)
 
@@ -221,23 +247,226 @@ class Lexer (object):
         return chr(c)
 
 
+### BufferedLexer returns the same tokens as Lexer, but it reads the whole
+### stream into a string when it is created and scans that with index
+### arithmetic, compiled regexps, and a character class table.  Lexer calls
+### Reader.Peek and Reader.Read for every character, crossing into .NET each
+### time, and it builds IDs and strings one char at a time, which dominates
+### load time for large files.
+###
+### Since BufferedLexer has all the text, its SourceIndex finds line starts
+### only when something asks for a line number.
+###
+class BufferedLexer (Lexer):
+    def __init__ (self, reader, source = None):
+        Lexer.__init__(self, reader, source)
+        self._text = reader.ReadToEnd()
+        self.Source.SetText(self._text)
+
+    def _getToken (self):
+        text = self._text
+        pos = _whitespaceRe.match(text, self._pos).end()
+        self.TokenStart = pos
+        if pos >= len(text):
+            self._pos = pos
+            return SyntaxToken.EOF
+        ch = text[pos]
+        if ch < '\x80':
+            kind = _charKinds[ord(ch)]
+        else:
+            kind = _ID
+        if kind is _PAREN:
+            self._pos = pos + 1
+            return SyntaxToken.Paren
+        elif kind is _CLOSE_PAREN:
+            self._pos = pos + 1
+            return SyntaxToken.CloseParen
+        elif kind is _ID:
+            return self._getIdOrKeyword(pos)
+        elif kind is _DIGIT:
+            m = _digitsRe.match(text, pos)
+            end = m.end()
+            self._pos = end
+            return NumberToken(int(m.group()), pos, end)
+        elif kind is _STRING:
+            return self._getString(pos)
+        elif kind is _QUOTE:
+            self._pos = pos + 1
+            return SyntaxToken.Quote
+        elif kind is _HYPHEN:
+            return self._getIdOrNumber(pos)
+        elif kind is _DOT:
+            self._pos = pos + 1
+            return SyntaxToken.Dot
+        raise Exception("Internal: couldn't get token? -- char[" +
+                        str(ch) + "]")
+
+    ### _getIdOrNumber handles a token starting with a hyphen at pos, which
+    ### is a negative number, an ID starting with a hyphen, or the keyword
+    ### minus.
+    ###
+    def _getIdOrNumber (self, pos):
+        text = self._text
+        pos = pos + 1
+        m = _digitsRe.match(text, pos)
+        if m is not None:
+            end = m.end()
+            self._pos = end
+            return NumberToken(- int(m.group()), pos - 1, end)
+        end = _idCharsRe.match(text, pos).end()
+        self._pos = end
+        return self._makeIdOrKeywordToken(text[pos - 1:end])
+
+    ### _getIdOrKeyword handles a token starting at pos that can start an ID.
+    ### A leading backslash quotes the ID, and the char after it is always
+    ### part of the name.
+    ###
+    def _getIdOrKeyword (self, pos):
+        text = self._text
+        if text[pos] == '\\':
+            pos = pos + 1
+            if pos >= len(text):
+                raise Exception("Unexpected EOF when getting Id.")
+            end = _idCharsRe.match(text, pos + 1).end()
+            self._pos = end
+            return self._makeIdOrKeywordToken(text[pos:end], True)
+        end = _idCharsRe.match(text, pos).end()
+        self._pos = end
+        return self._makeIdOrKeywordToken(text[pos:end])
+
+    ### _getString scans runs of plain string chars with a regexp, only
+    ### stopping at the closing double quote, escapes, and errors.
+    ###
+    def _getString (self, pos):
+        text = self._text
+        textlen = len(text)
+        pos = pos + 1
+        res = []
+        while True:
+            end = _stringCharsRe.match(text, pos).end()
+            if end != pos:
+                res.append(text[pos:end])
+                pos = end
+            if pos >= textlen:
+                raise Exception("Hit EOF in string literal.")
+            c = text[pos]
+            if c == '"':
+                self._pos = pos + 1
+                return StringToken("".join(res), self.TokenStart, pos + 1)
+            elif c == '\\':
+                pos = pos + 1
+                if pos >= textlen:
+                    raise Exception("Hit EOF in string literal.")
+                c = text[pos]
+                if c == '\n' or c == '\r':
+                    raise Exception("Hit newline in string literal")
+                ## Unknown escapes drop the char, as Lexer does.
+                res.append(_stringEscapes.get(c, ""))
+                pos = pos + 1
+            else:
+                raise Exception("Hit newline in string literal")
+
+## Character classes BufferedLexer uses to dispatch on the first char of a
+## token.  These must agree with Lexer._getToken, Lexer._isIdTerminator, and
+## Lexer._whitespaceChars.  Chars above the table's range are ID chars.
+_PAREN = "paren"
+_CLOSE_PAREN = "close paren"
+_DIGIT = "digit"
+_STRING = "string"
+_QUOTE = "quote"
+_HYPHEN = "hyphen"
+_DOT = "dot"
+_ID = "id"
+_BAD = "bad"
+
+def _makeCharKinds ():
+    kinds = []
+    for x in xrange(128):
+        c = chr(x)
+        if c in Lexer._id_terminators or x < 33:
+            kinds.append(_BAD)
+        else:
+            kinds.append(_ID)
+    for c in Lexer._numChars:
+        kinds[ord(c)] = _DIGIT
+    kinds[ord('(')] = _PAREN
+    kinds[ord(')')] = _CLOSE_PAREN
+    kinds[ord('"')] = _STRING
+    kinds[ord("'")] = _QUOTE
+    kinds[ord('-')] = _HYPHEN
+    kinds[ord('.')] = _DOT
+    return kinds
+
+_charKinds = _makeCharKinds()
+
+_whitespaceRe = re.compile(r"(?:[ \t\r\n]+|;[^\r\n]*)*")
+_digitsRe = re.compile(r"[0-9]+")
+_idCharsRe = re.compile(r"""[^()";,@'.\x00-\x20]*""")
+_stringCharsRe = re.compile(r'[^"\\\r\n]*')
+_stringEscapes = {'n' : "\n", 't' : "\t", 'r' : "\r", '"' : '"', '\\' : '\\'}
+
+
+### SourceIndex maps char offsets in a lexer's input to one-based line and
+### column numbers.  Tokens and SymplExprs only store offsets, so they stay
+### small, and we only pay to find lines when someone needs a line number.
+### Lexer adds line starts as it reads newlines, and BufferedLexer hands over
+### its text so that we can find them on demand.
+###
+class SourceIndex (object):
+    def __init__ (self):
+        self._lineStarts = [0]
+        self._text = None
+
+    def AddLineStart (self, offset):
+        self._lineStarts.append(offset)
+
+    def SetText (self, text):
+        self._text = text
+
+    ### GetLineColumn returns (0, 0) for -1, the offset of things with no
+    ### location, such as keyword tokens.
+    ###
+    def GetLineColumn (self, offset):
+        if offset < 0:
+            return (0, 0)
+        if self._text is not None:
+            self._lineStarts = [0] + [m.end() for m in
+                                      _newlineRe.finditer(self._text)]
+            self._text = None
+        line = bisect.bisect_right(self._lineStarts, offset)
+        return (line, offset - self._lineStarts[line - 1] + 1)
+
+_newlineRe = re.compile("\n")
+
+
+### Tokens record their span as Start and End char offsets, which a
+### SourceIndex maps to lines and columns.  Keyword and syntax tokens are
+### shared singletons, so their spans are always -1, and the parser gets their
+### locations from the Lexer instead.  The lexer makes a token object for
+### every literal and ID it reads, so tokens use __slots__, and token
+### constructors set all the fields themselves rather than chaining to base
+### class constructors.
+###
 class Token (object):
-    def __init__ (self, srcloc):
-        self.SrcLoc = srcloc
-    pass
+    __slots__ = ['Start', 'End']
+
+    def __init__ (self, start, end):
+        self.Start = start
+        self.End = end
 
 class LiteralToken (Token):
-    def __init__ (self, val, srcloc = (0, 0)):
-        Token.__init__(self, srcloc)
+    __slots__ = ['Value']
+
+    def __init__ (self, val, start = -1, end = -1):
         self.Value = val
+        self.Start = start
+        self.End = end
 
 class NumberToken (LiteralToken):
-    def __init__ (self, num, srcloc = (0, 0)):
-        LiteralToken.__init__(self, num, srcloc)
+    __slots__ = []
 
 class StringToken (LiteralToken):
-    def __init__ (self, string, srcloc = (0, 0)):
-        LiteralToken.__init__(self, string, srcloc)
+    __slots__ = []
 
 ### IdOrKeywordToken represents identifier.  A subtype, KeywordToken, reps
 ### keywords.  The parser handles when keywords can be used like identifiers,
@@ -246,8 +475,11 @@ class StringToken (LiteralToken):
 ### literals before they get converted to runtime Symbol types by etgen.
 ###
 class IdOrKeywordToken (Token):
-    def __init__ (self, name, kwd, srcloc = (0, 0)):
-        Token.__init__(self, srcloc)
+    __slots__ = ['Name', 'IsKeywordToken']
+
+    def __init__ (self, name, kwd, start = -1, end = -1):
+        self.Start = start
+        self.End = end
         self.Name = name
         self.IsKeywordToken = kwd
     def __repr__ (self):
@@ -258,8 +490,10 @@ class IdOrKeywordToken (Token):
 
 
 class KeywordToken (IdOrKeywordToken):
-    def __init__ (self, name, srcloc = (0, 0)):
-        IdOrKeywordToken.__init__(self, name, True, srcloc)
+    __slots__ = []
+
+    def __init__ (self, name):
+        IdOrKeywordToken.__init__(self, name, True)
         self.Name = name
         KeywordToken._keywords[name.lower()] = self
     
@@ -309,8 +543,12 @@ KeywordToken.Not = KeywordToken('Not')
 
 
 class SyntaxToken (Token):
+    __slots__ = ['Name']
+
     def __init__ (self, name):
         self.Name = name
+        self.Start = -1
+        self.End = -1
     def __str__ (self): return self.Name
     def __repr__ (self): return "<SyntaxToken " + self.Name + ">"
 SyntaxToken.Paren = SyntaxToken('Paren')
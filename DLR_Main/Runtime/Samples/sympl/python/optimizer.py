@@ -0,0 +1,350 @@
+import parser
+import lexer
+
+import clr
+if clr.use35:
+    clr.AddReference("Microsoft.Scripting.Core")
+    from Microsoft.Scripting.Ast import ExpressionType
+else:
+    clr.AddReference("System.Core")
+    from System.Linq.Expressions import ExpressionType
+
+### Optimize returns the list of top-level SymplExprs with constants folded and
+### unreachable branches pruned, for etgen to analyze in place of exprs.  It
+### runs between the parser and etgen when Sympl.Optimize is on.  Parsed ASTs
+### may be shared (see Sympl.ParsedModules), so Optimize never modifies exprs.
+### It copies any node whose children change and leaves the rest shared.
+### If stats is not None, Optimize adds what it did to stats.
+###
+### Optimize only folds what it can prove has the same result at run time:
+###    * Add, Subtract, Multiply, and Divide on int literals when the result
+###      fits an Int32 (larger results become BigIntegers at run time), and
+###      comparisons and eq on int literals.
+###    * Not, If, And, and Or whose test is a literal or nil, true, or false,
+###      using Sympl's rule that only nil and false are false.  (and x y) and
+###      an if without an else produce false, not nil, when the test fails, and
+###      (or x y) produces false when both are false.
+###    * Literals and nil, true, and false in bodies other than as the last
+###      expression, which do nothing.
+###
+def Optimize (exprs, stats = None):
+    if stats is None:
+        stats = OptimizerStats()
+    return _optimizeBody(exprs, stats)
+
+### OptimizeExpr is Optimize for a single expression.
+###
+def OptimizeExpr (expr, stats = None):
+    if stats is None:
+        stats = OptimizerStats()
+    return _optimize(expr, stats)
+
+### OptimizerStats counts what Optimize did.  SitesRemoved estimates the
+### dynamic call sites etgen no longer makes: one for each fold of an op that
+### would have been a site, and the sites in each pruned branch (see
+### CountSites).
+###
+class OptimizerStats (object):
+    def __init__ (self):
+        self.Folded = 0
+        self.Pruned = 0
+        self.Dropped = 0
+        self.SitesRemoved = 0
+
+    def Report (self):
+        return ("%d folded, %d branches pruned, %d statements dropped, " +
+                "%d dynamic sites removed") % (self.Folded, self.Pruned,
+                                               self.Dropped, self.SitesRemoved)
+
+
+### CountSites returns the number of dynamic call sites etgen makes for expr,
+### not counting references to and sets of module globals, which depend on
+### scopes.
+###
+def CountSites (expr):
+    if expr is None or isinstance(expr, lexer.Token):
+        return 0
+    if isinstance(expr, list):
+        return sum([CountSites(e) for e in expr])
+    if isinstance(expr, tuple):
+        return CountSites(expr[1])
+    sites = 0
+    if isinstance(expr, parser.SymplBinaryExpr):
+        if expr.Op not in _logicOps:
+            sites = 1
+    elif isinstance(expr, parser.SymplUnaryExpr):
+        if expr.Op != ExpressionType.Not:
+            sites = 1
+    elif isinstance(expr, parser.SymplDottedExpr):
+        ## A GetMember per member, and calls count themselves below.
+        sites = len([e for e in expr.Exprs
+                     if not isinstance(e, parser.SymplFunCallExpr)])
+    elif isinstance(expr, parser.SymplFunCallExpr):
+        ## Calling a dotted expr invokes its last member instead of getting it.
+        if isinstance(expr.Function, parser.SymplDottedExpr):
+            sites = 0
+        else:
+            sites = 1
+    elif type(expr) in _siteExprs:
+        sites = 1
+    for name, kind in _children.get(type(expr), []):
+        sites += CountSites(getattr(expr, name))
+    return sites
+
+
+###
+### Optimizing nodes
+###
+
+def _optimize (expr, stats):
+    children = _children.get(type(expr))
+    if children is None:
+        return expr
+    changes = {}
+    for name, kind in children:
+        old = getattr(expr, name)
+        if kind == "expr":
+            new = _optimize(old, stats)
+        elif kind == "optexpr":
+            new = old
+            if old is not None:
+                new = _optimize(old, stats)
+        elif kind == "list":
+            new = [_optimize(e, stats) for e in old]
+        elif kind == "body":
+            new = _optimizeBody(old, stats)
+        elif kind == "bindings":
+            new = [(var, _optimize(e, stats)) for var, e in old]
+        if _changed(old, new):
+            changes[name] = new
+    if changes:
+        expr = _copy(expr, changes)
+    fold = _folders.get(type(expr))
+    if fold is not None:
+        expr = fold(expr, stats)
+    return expr
+
+def _changed (old, new):
+    if isinstance(old, list):
+        if len(old) != len(new):
+            return True
+        for o, n in zip(old, new):
+            if _changed(o, n):
+                return True
+        return False
+    if isinstance(old, tuple):
+        return old[1] is not new[1]
+    return old is not new
+
+### _optimizeBody optimizes the exprs of a body, dropping constants that are
+### not the last expr since their values go nowhere.  A loop's body has no
+### last expr whose value matters, but we keep it to keep the body non-empty.
+###
+def _optimizeBody (exprs, stats):
+    res = []
+    for i, e in enumerate(exprs):
+        e = _optimize(e, stats)
+        if i < len(exprs) - 1 and _isConstant(e):
+            stats.Dropped += 1
+            continue
+        res.append(e)
+    return res
+
+### _copy returns a copy of expr with the changes to its attributes, keeping
+### expr's Start and End.
+###
+def _copy (expr, changes):
+    new = object.__new__(type(expr))
+    new.__dict__.update(expr.__dict__)
+    new.__dict__.update(changes)
+    return new
+
+### _replace returns new positioned at old's source location, so debug info
+### for top-level exprs still points at the code that was folded.
+###
+def _replace (old, new):
+    if new.Start < 0 and old.Start >= 0:
+        new = _copy(new, {"Start" : old.Start, "End" : old.End})
+    return new
+
+def _keyword (value, old):
+    if value:
+        token = lexer.KeywordToken.True
+    else:
+        token = lexer.KeywordToken.False
+    return _replace(old, parser.SymplIdExpr(token))
+
+def _isConstant (expr):
+    return _truth(expr) is not None
+
+### _truth returns whether Sympl treats the constant expr as true, or None if
+### expr is not a constant.
+###
+def _truth (expr):
+    if type(expr) is parser.SymplLiteralExpr:
+        return True
+    if type(expr) is parser.SymplIdExpr and expr.IdToken.IsKeywordToken:
+        if expr.IdToken is lexer.KeywordToken.True:
+            return True
+        if (expr.IdToken is lexer.KeywordToken.False or
+            expr.IdToken is lexer.KeywordToken.Nil):
+            return False
+    return None
+
+def _intValue (expr):
+    if type(expr) is parser.SymplLiteralExpr and type(expr.Value) is int:
+        return _int32(expr.Value)
+    return None
+
+
+###
+### Folding
+###
+
+def _foldBinary (expr, stats):
+    if expr.Op == ExpressionType.And:
+        return _foldAnd(expr, stats)
+    if expr.Op == ExpressionType.Or:
+        return _foldOr(expr, stats)
+    left = _intValue(expr.Left)
+    right = _intValue(expr.Right)
+    if left is None or right is None:
+        return expr
+    fold = _intFolders.get(expr.Op)
+    if fold is None:
+        return expr
+    value = fold(left, right)
+    if value is None:
+        return expr
+    stats.Folded += 1
+    stats.SitesRemoved += 1
+    if type(value) is bool:
+        return _keyword(value, expr)
+    return _replace(expr, parser.SymplLiteralExpr(value))
+
+def _foldAnd (expr, stats):
+    ## (and x y) is (if x y).
+    truth = _truth(expr.Left)
+    if truth is None:
+        return expr
+    stats.Folded += 1
+    if truth:
+        return _replace(expr, expr.Right)
+    _prune(expr.Right, stats)
+    return _keyword(False, expr)
+
+def _foldOr (expr, stats):
+    ## (or x y) is x when x is true, else y when y is true, else false.
+    truth = _truth(expr.Left)
+    if truth is None:
+        return expr
+    if truth:
+        stats.Folded += 1
+        _prune(expr.Right, stats)
+        return _replace(expr, expr.Left)
+    truth = _truth(expr.Right)
+    if truth is None:
+        return expr
+    stats.Folded += 1
+    if truth:
+        return _replace(expr, expr.Right)
+    return _keyword(False, expr)
+
+def _foldUnary (expr, stats):
+    if expr.Op != ExpressionType.Not:
+        return expr
+    truth = _truth(expr.Operand)
+    if truth is None:
+        return expr
+    stats.Folded += 1
+    return _keyword(not truth, expr)
+
+def _foldIf (expr, stats):
+    truth = _truth(expr.Test)
+    if truth is None:
+        return expr
+    stats.Folded += 1
+    if truth:
+        _prune(expr.Alternative, stats)
+        return _replace(expr, expr.Consequent)
+    _prune(expr.Consequent, stats)
+    if expr.Alternative is None:
+        return _keyword(False, expr)
+    return _replace(expr, expr.Alternative)
+
+def _foldEq (expr, stats):
+    left = _intValue(expr.Left)
+    right = _intValue(expr.Right)
+    if left is None or right is None:
+        return expr
+    stats.Folded += 1
+    stats.SitesRemoved += 1
+    return _keyword(left == right, expr)
+
+def _prune (expr, stats):
+    if expr is not None:
+        stats.Pruned += 1
+        stats.SitesRemoved += CountSites(expr)
+
+def _int32 (value):
+    if -2**31 <= value < 2**31:
+        return value
+    return None
+
+### _divide truncates toward zero like the Int64 division Sympl does at run
+### time.  We leave division by zero to throw at run time.
+###
+def _divide (left, right):
+    if right == 0:
+        return None
+    quotient = abs(left) // abs(right)
+    if (left < 0) != (right < 0):
+        quotient = -quotient
+    return _int32(quotient)
+
+_intFolders = {
+    ExpressionType.Add : lambda l, r: _int32(l + r),
+    ExpressionType.Subtract : lambda l, r: _int32(l - r),
+    ExpressionType.Multiply : lambda l, r: _int32(l * r),
+    ExpressionType.Divide : _divide,
+    ExpressionType.Equal : lambda l, r: l == r,
+    ExpressionType.NotEqual : lambda l, r: l != r,
+    ExpressionType.LessThan : lambda l, r: l < r,
+    ExpressionType.GreaterThan : lambda l, r: l > r}
+
+_logicOps = [ExpressionType.And, ExpressionType.Or]
+
+_folders = {
+    parser.SymplBinaryExpr : _foldBinary,
+    parser.SymplUnaryExpr : _foldUnary,
+    parser.SymplIfExpr : _foldIf,
+    parser.SymplEqExpr : _foldEq}
+
+## Kinds of nodes that are one dynamic site each (see CountSites).
+_siteExprs = [parser.SymplEltExpr, parser.SymplNewExpr, parser.SymplEqExpr,
+              parser.SymplConsExpr, parser.SymplListCallExpr,
+              parser.SymplImportExpr]
+
+## The child attributes of each kind of node that hold SymplExprs.  Kinds are
+## "expr", "optexpr" (may be None), "list" of exprs, "body" (a list of exprs
+## that we can drop constants from), and "bindings" of let*.  Quoted exprs
+## have no entry since they are data.
+_children = {
+    parser.SymplFunCallExpr : [("Function", "expr"), ("Arguments", "list")],
+    parser.SymplDefunExpr : [("Body", "body")],
+    parser.SymplLambdaExpr : [("Body", "body")],
+    parser.SymplDottedExpr : [("ObjectExpr", "expr"), ("Exprs", "list")],
+    parser.SymplAssignExpr : [("Location", "expr"), ("Value", "expr")],
+    parser.SymplLetStarExpr : [("Bindings", "bindings"), ("Body", "body")],
+    parser.SymplBlockExpr : [("Body", "body")],
+    parser.SymplEltExpr : [("ObjectExpr", "expr"), ("Indexes", "list")],
+    parser.SymplEqExpr : [("Left", "expr"), ("Right", "expr")],
+    parser.SymplConsExpr : [("Left", "expr"), ("Right", "expr")],
+    parser.SymplListCallExpr : [("Elements", "list")],
+    parser.SymplIfExpr : [("Test", "expr"), ("Consequent", "expr"),
+                          ("Alternative", "optexpr")],
+    parser.SymplLoopExpr : [("Body", "body")],
+    parser.SymplBreakExpr : [("Value", "optexpr")],
+    parser.SymplNewExpr : [("Typ", "expr"), ("Arguments", "list")],
+    parser.SymplBinaryExpr : [("Left", "expr"), ("Right", "expr")],
+    parser.SymplUnaryExpr : [("Operand", "expr")]}
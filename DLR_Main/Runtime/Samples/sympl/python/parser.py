@@ -1,5 +1,7 @@
 
+import re
 import lexer
+from collections import deque
 
 ### Only needed for _getOpKind
 import clr
@@ -10,41 +12,307 @@ else:
     clr.AddReference("System.Core")
     from System.Linq.Expressions import ExpressionType
 
+from System.IO import StringReader
+
 class Parser (object):
     pass
 
 ### ParseFile returns a list of top-level expressions parsed in the
-### StreamReader.
+### StreamReader.  Buffered selects lexer.BufferedLexer, which reads all of
+### reader before scanning, instead of lexer.Lexer, which reads one char at a
+### time.  Both produce the same tokens.
+###
+### SymplExprs record their span as char offsets (see SymplExpr).  Pass a
+### lexer.SourceIndex as source to be able to map them to lines and columns.
 ###
-def ParseFile (reader):
+### The parser is recursive descent, and forms nested deeper than
+### MaxRecursiveDepth continue on an explicit stack (see _runParse), so
+### nesting is not limited by the Python stack.  Iterative runs everything on
+### the explicit stack, which is slower.  Both produce the same SymplExprs.
+###
+def ParseFile (reader, buffered = True, source = None, iterative = False):
     body = []
-    lex = lexer.Lexer(reader)
+    lex = _makeLexer(reader, buffered, source)
+    parse = _getParseFunction(iterative)
     token = lex.GetToken()
     while token is not lexer.SyntaxToken.EOF:
         lex.PutToken(token)
-        body.append(_parseExpr(lex))
+        body.append(parse(lex))
         token = lex.GetToken()
     return body
 
 ### Parse returns a single expression parsed from the StreamReader.
 ###
-def ParseExpr (reader):
-    return _parseExpr(lexer.Lexer(reader))
+def ParseExpr (reader, buffered = True, source = None, iterative = False):
+    return _getParseFunction(iterative)(_makeLexer(reader, buffered, source))
+
+def _getParseFunction (iterative):
+    if iterative:
+        return _parseExprIterative
+    else:
+        return _parseExpr
+
+### MaxRecursiveDepth is how deep _parseForm recurses before it switches to
+### the explicit stack.  Each form takes a few Python frames.
+###
+MaxRecursiveDepth = 100
+
+def _makeLexer (reader, buffered, source):
+    if buffered:
+        return lexer.BufferedLexer(reader, source)
+    else:
+        return lexer.Lexer(reader, source)
+
+### IncrementalParser parses top-level expressions from text that arrives in
+### chunks, such as lines a REPL reads or blocks read from a pipe.  Feed scans
+### only the new chunk, keeping where it is in strings, comments, and nested
+### parens between chunks, so it looks at each char once however many chunks
+### an expression spans.  Feed returns the Status after the chunk:
+###    * "complete" when there are expressions and none is still open.
+###    * "incomplete" when an expression has started but is not finished,
+###      for example, it has unclosed parens.
+###    * "empty" when there has been nothing but whitespace and comments.
+###    * "error" when the text cannot be Sympl, and Error is the Exception.
+###      ErrorOffset is where in the input the scanner found the error.
+###
+### GetExprs generates the finished expressions, parsing each only when the
+### caller asks for it, so the caller can run one before the next is parsed.
+### It drops each expression's text once it is parsed, so if parsing one
+### raises, the ones after it are still queued for the next call.  After the
+### complete expressions before an error, GetExprs raises Error.  An
+### expression at the end may not be finished even if it looks complete, since
+### a following dot could continue it (as in "(f x).Foo"), so GetExprs only
+### returns it when final is true, meaning there is no more input or the
+### caller treats the end of the chunk as the end of the expression.  The
+### exprs' spans are offsets into their own text.  Reset drops all text and
+### any error.
+###
+class IncrementalParser (object):
+    def __init__ (self):
+        self.Reset()
+
+    def Reset (self):
+        self.Error = None
+        self.ErrorOffset = -1
+        ## Text fed but not yet returned as exprs, starting at offset _base.
+        self._chunks = []
+        self._base = 0
+        self._size = 0
+        ## Spans of exprs that are finished, in order.
+        self._spans = deque()
+        ## Scanner state: _mode is "code", "string", or "comment".  At top
+        ## level, _state is "idle" between exprs, "atom" in an id or number,
+        ## "after" when the expr from _start to _end is complete but a dot
+        ## could continue it, or "open" when it must continue.
+        self._mode = "code"
+        self._escape = False
+        self._depth = 0
+        self._state = "idle"
+        self._start = -1
+        self._end = -1
+
+    def Feed (self, text):
+        if self.Error is None:
+            self._chunks.append(text)
+            self._scan(text, self._size)
+            self._size = self._size + len(text)
+        return self.Status()
+
+    def Status (self):
+        if self.Error is not None:
+            return "error"
+        if (self._depth > 0 or self._mode == "string" or
+            self._state == "open"):
+            return "incomplete"
+        if self._spans or self._state != "idle":
+            return "complete"
+        return "empty"
+
+    def GetExprs (self, final = False):
+        if final and self.Status() == "complete":
+            if self._state == "atom":
+                self._finishPrimary(self._size)
+            if self._state == "after":
+                self._spans.append((self._start, self._end))
+                self._state = "idle"
+        while self._spans:
+            if len(self._chunks) > 1:
+                self._chunks = ["".join(self._chunks)]
+            text = self._chunks[0]
+            start, end = self._spans.popleft()
+            yield ParseExpr(StringReader(text[start - self._base:
+                                              end - self._base]))
+        if self.Error is not None:
+            raise self.Error
+        if final and self.Status() == "incomplete":
+            raise Exception("Unexpected EOF encountered while parsing " +
+                            "expression.")
+        ## Keep the text of the expr in progress, if any.
+        if self._state == "idle":
+            keep = self._size
+        else:
+            keep = self._start
+        self._chunks = ["".join(self._chunks)[keep - self._base:]]
+        self._base = keep
+
+    ### _scan updates the scanner state for text, which starts at offset in
+    ### the whole input.  Inside strings, comments, and parens it searches for
+    ### the next char that matters, and at top level it looks at each char.
+    ###
+    def _scan (self, text, offset):
+        i = 0
+        n = len(text)
+        while i < n:
+            if self._mode == "comment":
+                m = _commentEnd.search(text, i)
+                if m is None:
+                    return
+                self._mode = "code"
+                i = m.end()
+            elif self._mode == "string":
+                if self._escape:
+                    self._escape = False
+                    i = i + 1
+                    continue
+                m = _stringChars.search(text, i)
+                if m is None:
+                    return
+                i = m.end()
+                c = m.group()
+                if c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._mode = "code"
+                    if self._depth == 0:
+                        self._finishPrimary(offset + i)
+                else:
+                    self._fail("Hit newline in string literal", offset + i)
+                    return
+            elif self._depth > 0:
+                m = _formChars.search(text, i)
+                if m is None:
+                    return
+                i = m.end()
+                c = m.group()
+                if c == "(":
+                    self._depth = self._depth + 1
+                elif c == ")":
+                    self._depth = self._depth - 1
+                    if self._depth == 0:
+                        self._finishPrimary(offset + i)
+                elif c == '"':
+                    self._mode = "string"
+                else:
+                    self._mode = "comment"
+            else:
+                if not self._scanTopLevel(text[i], offset + i):
+                    return
+                i = i + 1
+
+    ### _scanTopLevel updates the top-level state for char c at offset, and
+    ### returns False if c is an error.
+    ###
+    def _scanTopLevel (self, c, offset):
+        if self._state == "atom":
+            if _isAtomChar(c):
+                return True
+            self._finishPrimary(offset)
+        if ord(c) < 33:
+            return True
+        if c == ";":
+            self._mode = "comment"
+            return True
+        if c == ")":
+            self._fail("Unexpected ')'", offset)
+            return False
+        if c == ".":
+            if self._state != "after":
+                self._fail("Unexpected '.'", offset)
+                return False
+            self._state = "open"
+            return True
+        ## c starts an expr, or the next part of a dotted or quoted one.
+        if self._state == "after":
+            self._spans.append((self._start, self._end))
+            self._state = "idle"
+        if self._state == "idle":
+            self._start = offset
+        if c == "(":
+            self._depth = 1
+            self._state = "open"
+        elif c == '"':
+            self._mode = "string"
+            self._state = "open"
+        elif c == "'":
+            self._state = "open"
+        else:
+            self._state = "atom"
+        return True
+
+    def _finishPrimary (self, end):
+        self._state = "after"
+        self._end = end
+
+    ### _fail records the error at offset.  An expr that was complete up to
+    ### there is finished, since the error cannot continue it.
+    ###
+    def _fail (self, msg, offset):
+        if self._state == "after":
+            self._spans.append((self._start, self._end))
+            self._state = "idle"
+        self.Error = Exception(msg + " -- at offset " + str(offset))
+        self.ErrorOffset = offset
+
+_commentEnd = re.compile(r"[\r\n]")
+_stringChars = re.compile(r'["\\\r\n]')
+_formChars = re.compile(r'[()";]')
+
+def _isAtomChar (c):
+    return ord(c) >= 33 and c not in "()\";'."
+
+### _setSpan records the char offsets of expr's source text and returns expr.
+###
+def _setSpan (expr, start, end):
+    expr.Start = start
+    expr.End = end
+    return expr
+
+### _syntaxError returns an Exception for msg that reports where the last
+### token lexr returned is.
+###
+def _syntaxError (lexr, msg):
+    return Exception(msg + " -- at " + lexr.FormatLocation(lexr.TokenStart))
 
 ### _parseExpr parses an expression from the Lexer passed in.
 ###
 def _parseExpr (lexr):
     token = lexr.GetToken()
-    debugprint("_parseExpr: token= " + str(token))
-    res = None
+    start = lexr.TokenStart
+    if _debug: debugprint("_parseExpr: token= " + str(token))
+    if token is lexer.SyntaxToken.Paren:
+        lexr.PutToken(token)
+        res = _parseForm(lexr)
+    else:
+        res = _parseAtom(lexr, token)
+    ## Check for dotted expr.
+    _setSpan(res, start, lexr.TokenEnd)
+    next = lexr.GetToken()
+    lexr.PutToken(next)
+    if next is lexer.SyntaxToken.Dot:
+        return _parseDottedExpr(lexr, res)
+    else:
+        return res
+
+### _parseAtom parses expressions that do not start with a paren, given their
+### first token.
+###
+def _parseAtom (lexr, token):
     if token is lexer.SyntaxToken.EOF:
-        raise Exception("Unexpected EOF encountered while parsing expression.")
+        raise _syntaxError(lexr,
+                           "Unexpected EOF encountered while parsing expression.")
     if token is lexer.SyntaxToken.Quote:
         lexr.PutToken(token)
-        res = _parseQuoteExpr(lexr)
-    elif token is lexer.SyntaxToken.Paren:
-        lexr.PutToken(token)
-        res = _parseForm(lexr)
+        return _parseQuoteExpr(lexr)
     elif isinstance(token, lexer.IdOrKeywordToken):
         ## If we encounter literal kwd constants, they get turned into ID
         ## Exprs.  Code that accepts Id Exprs, needs to check if the token is
@@ -52,25 +320,14 @@ def _parseExpr (lexr):
         if (token.IsKeywordToken and
             token not in [lexer.KeywordToken.Nil, lexer.KeywordToken.True,
                           lexer.KeywordToken.False]):
-            raise Exception("Keyword cannot be an expression: " + 
-                            token.Name)
+            raise _syntaxError(lexr, "Keyword cannot be an expression: " + 
+                               token.Name)
         else:
-            res = SymplIdExpr(token)
+            return SymplIdExpr(token)
     elif isinstance(token, lexer.LiteralToken):
-        res = SymplLiteralExpr(token.Value)
-    ## Check for dotted expr.
-    if res is not None:
-        next = lexr.GetToken()
-        lexr.PutToken(next)
-        if next is lexer.SyntaxToken.Dot:
-            return _parseDottedExpr(lexr, res)
-        else:
-            return res
-    raise Exception("Unexpected token when expecting "+ 
-                    "beginning of expression -- " + str(token) + " ... " +
-                    repr([lexr.GetToken(), lexr.GetToken(),
-                          lexr.GetToken(), lexr.GetToken(),
-                          lexr.GetToken(), lexr.GetToken()]))
+        return SymplLiteralExpr(token.Value)
+    raise _syntaxError(lexr, "Unexpected token when expecting "+ 
+                       "beginning of expression -- " + str(token))
 
 ### _parseForm parses a parenthetic form.  If the first token after the paren
 ### is a keyword, then it something like defun, loop, if, try, etc.  If the
@@ -79,29 +336,35 @@ def _parseExpr (lexr):
 ###
 def _parseForm (lexr):
     debugprint("IN parseform:")
+    if lexr.Depth >= MaxRecursiveDepth:
+        return _runParse(_parseFormGen(lexr))
+    lexr.Depth += 1
     token = lexr.GetToken()
     if token is not lexer.SyntaxToken.Paren:
-        raise Exception("List expression must start with '('.")
+        raise _syntaxError(lexr, "List expression must start with '('.")
+    start = lexr.TokenStart
     token = lexr.GetToken()
-    debugprint("first form token: " + str(token))
+    if _debug: debugprint("first form token: " + str(token))
     if isinstance(token, lexer.IdOrKeywordToken):
         lexr.PutToken(token)
-        debugprint("parseform: " + str(token))
+        if _debug: debugprint("parseform: " + str(token))
         if token.IsKeywordToken:
             # Defun, Let, Set, Import, ...
-            return _parseKeywordForm(lexr)
+            res = _parseKeywordForm(lexr)
         else:
-            return _parseFunctionCall(lexr)
+            res = _parseFunctionCall(lexr)
     #elif token is lexer.SyntaxToken.Paren:
     #    lexr.PutToken(token)
     #    return _parseFunctionCall(lexr)
     else:
         lexr.PutToken(token)
-        return _parseFunctionCall(lexr)
+        res = _parseFunctionCall(lexr)
         
         ## What else could start a function call?  Any Expr?
         #raise Exception("Sympl form must have ID or keyword as first element." +
         #                "  Got " + str(token))
+    lexr.Depth -= 1
+    return _setSpan(res, start, lexr.TokenEnd)
 
 ### _parseKeywordForm parses parenthetic built in forms such as defun, if, loop,
 ### etc.
@@ -157,7 +420,8 @@ def _parseDefun (lexr):
         raise Exception("Internal: parsing Defun?")
     name = lexr.GetToken()
     if not isinstance(name, lexer.IdOrKeywordToken) or name.IsKeywordToken:
-        raise Exception("Defun must have an ID for name -- " + str(token))
+        raise _syntaxError(lexr,
+                           "Defun must have an ID for name -- " + str(token))
     params = _parseParams(lexr, "Defun")
     body = _parseBody(lexr, "Hit EOF in function body -- " + name.Name)
     return SymplDefunExpr(name, params, body)
@@ -176,7 +440,8 @@ def _parseLambda (lexr):
 def _parseParams (lexr, definer):
     token = lexr.GetToken()
     if token is not lexer.SyntaxToken.Paren:
-        raise Exception(definer + " must have param list following keyword.")
+        raise _syntaxError(lexr,
+                           definer + " must have param list following keyword.")
     lexr.PutToken(token)
     return _ensureListOfIds(_parseList(lexr, "param list.").Elements, False,
                             definer + " params must be valid IDs.")
@@ -194,7 +459,7 @@ def _parseBody (lexr, errmsg):
         body.append(_parseExpr(lexr))
         token = lexr.GetToken()
     if token is lexer.SyntaxToken.EOF:
-        raise Exception(errmsg)
+        raise _syntaxError(lexr, errmsg)
     return body
 
 
@@ -208,9 +473,10 @@ def _parseImport (lexr):
     members = _parseImportNames(lexr, "member names", True)
     as_names = _parseImportNames(lexr, "renames", False)
     if lexr.GetToken() is not lexer.SyntaxToken.CloseParen:
-        raise Exception("Expected close paren for Import call.")
+        raise _syntaxError(lexr, "Expected close paren for Import call.")
     if (len(members) != len(as_names)) and (len(as_names) != 0):
-        raise Exception("Import as-names must be same form as member names.")
+        raise _syntaxError(lexr,
+                           "Import as-names must be same form as member names.")
     return SymplImportExpr(ns_or_module, members, as_names)
 
 ### Parses dotted namespaces or Sympl.Globals members to import.
@@ -218,16 +484,19 @@ def _parseImport (lexr):
 def _parseImportNameOrModule (lexr):
     token = lexr.GetToken()
     if not isinstance(token, lexer.IdOrKeywordToken): # Keywords are ok here.
-        raise Exception("Id must follow Import symbol.")
+        raise _syntaxError(lexr, "Id must follow Import symbol.")
+    start = lexr.TokenStart
+    end = lexr.TokenEnd
     dot = lexr.GetToken()
     if dot is lexer.SyntaxToken.Dot:
         lexr.PutToken(dot)
-        tmp = _parseDottedExpr(lexr, SymplIdExpr(token))
+        tmp = _parseDottedExpr(lexr, _setSpan(SymplIdExpr(token), start, end))
         ns_or_module = []
         for e in [tmp.ObjectExpr] + tmp.Exprs:
             if not isinstance(e, SymplIdExpr): # Keywords are ok here too.
-                raise Exception("Import targets must be dotted identifiers " +
-                                "only -- " + str(e) + str(ns_or_module))
+                raise _syntaxError(lexr,
+                                   "Import targets must be dotted identifiers " +
+                                   "only -- " + str(e) + str(ns_or_module))
             ns_or_module.append(e.IdToken)
         token = lexr.GetToken()
     else:
@@ -255,7 +524,8 @@ def _parseImportNames (lexr, nameKinds, allowKeywords):
         names = []
         lexr.PutToken(token)
     else:
-        raise Exception("Import takes dotted names, then member vars.")
+        raise _syntaxError(lexr,
+                           "Import takes dotted names, then member vars.")
     return names
 
 def _ensureListOfIds (lst, allowKeywords, error_str):
@@ -279,22 +549,25 @@ def _parseDottedExpr (lexr, expr):
     if token is not lexer.SyntaxToken.Dot:
         raise Exception("Internal error: parsing dotted expressions?")
     exprs = []
+    end = obj_expr.End
     token = lexr.GetToken()
     is_paren = token is lexer.SyntaxToken.Paren
     is_id = isinstance(token, lexer.IdOrKeywordToken) # Keywords ok as members.
     while (is_id or is_paren):
         ## Need to be fun call or IDs
         if is_id:
-            expr = SymplIdExpr(token)
+            expr = _setSpan(SymplIdExpr(token), lexr.TokenStart, lexr.TokenEnd)
         else:
             lexr.PutToken(token)
             expr = _parseForm(lexr)
             if ((not isinstance(expr, SymplFunCallExpr)) or
                 (not isinstance(expr.Function, SymplIdExpr))):
-                raise Exception("Dotted expressions must be identifiers or " +
-                                "function calls with identiers as the function " +
-                                "value --" + str(expr))
+                raise _syntaxError(lexr,
+                                   "Dotted expressions must be identifiers or " +
+                                   "function calls with identiers as the function " +
+                                   "value --" + str(expr))
         exprs.append(expr)
+        end = expr.End
         token = lexr.GetToken()
         if token is not lexer.SyntaxToken.Dot:
             break
@@ -302,7 +575,7 @@ def _parseDottedExpr (lexr, expr):
         is_paren = token is lexer.SyntaxToken.Paren
         is_id = isinstance(token, lexer.IdOrKeywordToken)
     lexr.PutToken(token)
-    return SymplDottedExpr(obj_expr, exprs)
+    return _setSpan(SymplDottedExpr(obj_expr, exprs), obj_expr.Start, end)
 
 ### _parseSet parses a LHS expression and value expression.  All analysis on
 ### the LHS is in etgen.py.
@@ -313,7 +586,7 @@ def _parseSet (lexr):
     lhs = _parseExpr(lexr)
     val = _parseExpr(lexr)
     if lexr.GetToken() is not lexer.SyntaxToken.CloseParen:
-        raise Exception("Expected close paren for Set expression.")
+        raise _syntaxError(lexr, "Expected close paren for Set expression.")
     return SymplAssignExpr(lhs, val)
 
 ### _parseLetStar parses (let* ((<var> <expr>)*) <body>).
@@ -323,24 +596,25 @@ def _parseLetStar (lexr):
         raise Exception("Internal error: parsing Let?")
     token = lexr.GetToken()
     if token is not lexer.SyntaxToken.Paren:
-        raise Exception("Let expression has no bindings?  Missing '('.")
+        raise _syntaxError(lexr,
+                           "Let expression has no bindings?  Missing '('.")
     ## Get bindings
     bindings = []
     token = lexr.GetToken()
     while token is lexer.SyntaxToken.Paren:
         var = _parseExpr(lexr)
         if not isinstance(var, SymplIdExpr) or var.IdToken.IsKeywordToken:
-            raise Exception("Let* binding must be (<ID> <expr>) -- " +
-                            str(var))
+            raise _syntaxError(lexr, "Let* binding must be (<ID> <expr>) -- " +
+                               str(var))
         init = _parseExpr(lexr)
         bindings.append((var.IdToken, init))
         token = lexr.GetToken()
         if token is not lexer.SyntaxToken.CloseParen:
-            raise Exception("Let binding missing close paren -- " +
-                            str(token))
+            raise _syntaxError(lexr, "Let binding missing close paren -- " +
+                               str(token))
         token = lexr.GetToken()
     if token is not lexer.SyntaxToken.CloseParen:
-        raise Exception("Let* bindings missing close paren.")
+        raise _syntaxError(lexr, "Let* bindings missing close paren.")
     body = _parseBody(lexr, "Unexpected EOF in Let.")
     return SymplLetStarExpr(bindings, body)
 
@@ -368,9 +642,10 @@ def _parseFunctionCall (lexr):
     fun = _parseExpr(lexr)
     if ((type(fun) is SymplDottedExpr) and
         (not isinstance(fun.Exprs[-1], SymplIdExpr))): #Keywords ok as members.
-        raise Exception("Function call with dotted expression for function " +
-                        "must end with ID Expr, not member invoke. " +
-                        str(fun.Exprs[-1]))
+        raise _syntaxError(lexr,
+                           "Function call with dotted expression for function " +
+                           "must end with ID Expr, not member invoke. " +
+                           str(fun.Exprs[-1]))
     ## Tail exprs are args.
     args = _parseBody(lexr, "Unexpected EOF in arg list for " + str(fun))
     return SymplFunCallExpr(fun, args)
@@ -389,8 +664,9 @@ def _parseQuoteExpr (lexr):
           isinstance(token, lexer.LiteralToken)):
         expr = token
     else:
-        raise Exception("Quoted expression can only be list, ID/Symbol, or " +
-                        "literal.")
+        raise _syntaxError(lexr,
+                           "Quoted expression can only be list, ID/Symbol, or " +
+                           "literal.")
     return SymplQuoteExpr(expr)
 
 def _parseEq (lexr):
@@ -414,7 +690,8 @@ def _parseBinaryRuntimeCall (lexr):
     left = _parseExpr(lexr)
     right = _parseExpr(lexr)
     if lexr.GetToken() is not lexer.SyntaxToken.CloseParen:
-        raise Exception("Expected close paren for binary op or eq call.")
+        raise _syntaxError(lexr,
+                           "Expected close paren for binary op or eq call.")
     return (left, right)
 
 ### _parseListCall parses a call to the List built-in keyword form that takes
@@ -438,7 +715,8 @@ def _parseIf (lexr):
     elif argslen == 3:
         return SymplIfExpr(args[0], args[1], args[2])
     else:
-        raise Exception("IF must be (if <test> <consequent> [<alternative>]).")
+        raise _syntaxError(lexr,
+                           "IF must be (if <test> <consequent> [<alternative>]).")
     
 ### _parseLoop parses a loop expression, a sequence of exprs to
 ### execute in order, forever.  See Break for returning expression's value.
@@ -463,7 +741,7 @@ def _parseBreak (lexr):
         value = _parseExpr(lexr)
         token = lexr.GetToken()
         if token != lexer.SyntaxToken.CloseParen:
-            raise Exception("Break expression missing close paren.")
+            raise _syntaxError(lexr, "Break expression missing close paren.")
     return SymplBreakExpr(value)
 
 ### Parse a New form for creating instances of types.  Second sub expr (one
@@ -516,7 +794,7 @@ def _parseExprTreeUnaryOp (lexr):
         raise Exception("Internal: unrecognized unary op")
     operand = _parseExpr(lexr)
     if lexr.GetToken() is not lexer.SyntaxToken.CloseParen:
-        raise Exception("Expected close paren for unary op call.")
+        raise _syntaxError(lexr, "Expected close paren for unary op call.")
     return SymplUnaryExpr(_getOpKind(token), operand)
 
 def _getOpKind (token):
@@ -550,34 +828,437 @@ def _getOpKind (token):
 ### day.  This is used for Import name parsing, Defun/Lambda params, and quoted
 ### lists.
 ###
+### This keeps the lists it is in the middle of on a stack rather than
+### recursing for sub lists so that it handles any depth of nesting.
+###
 def _parseList (lexr, errStr):
     debugprint("IN parse list")
     token = lexr.GetToken()
     if token is not lexer.SyntaxToken.Paren:
-        raise Exception("List expression must start with '('.")
-    token = lexr.GetToken()
+        raise _syntaxError(lexr, "List expression must start with '('.")
+    start = lexr.TokenStart
     res = []
-    while ((token != lexer.SyntaxToken.EOF) and
-           (token != lexer.SyntaxToken.CloseParen)):
-        lexr.PutToken(token)
-        elt = None
+    outer = [] # (start, res) for each list we're inside of
+    token = lexr.GetToken()
+    while True:
         if token is lexer.SyntaxToken.Paren:
-            elt = _parseList(lexr, errStr)
+            outer.append((start, res))
+            start = lexr.TokenStart
+            res = []
         elif (isinstance(token, lexer.IdOrKeywordToken) or
               isinstance(token, lexer.LiteralToken)):
-            elt = token
-            lexr.GetToken()
-        elif  token is lexer.SyntaxToken.Dot:
-            raise Exception("Can't have dotted syntax in " + errStr)
+            res.append(token)
+        elif token is lexer.SyntaxToken.CloseParen:
+            lst = _setSpan(SymplListExpr(res), start, lexr.TokenEnd)
+            if not outer:
+                return lst
+            start, res = outer.pop()
+            res.append(lst)
+        elif token is lexer.SyntaxToken.EOF:
+            raise _syntaxError(lexr,
+                               "Unexpected EOF encountered while parsing list.")
+        elif token is lexer.SyntaxToken.Dot:
+            raise _syntaxError(lexr, "Can't have dotted syntax in " + errStr)
+        else:
+            raise _syntaxError(lexr,
+                               "Unexpected token in list -- " + repr(token))
+        token = lexr.GetToken()
+
+
+
+#########################
+### Explicit Stack Parsing
+#########################
+
+### The functions below parse the same grammar as the recursive descent
+### functions above, but the ones that need sub expressions are generators.
+### Instead of calling the function for a sub expression, they yield the
+### generator for it and get its result back from the yield, as in
+###    lhs = yield _parseExprGen(lexr)
+### and they yield their own result last.  _runParse keeps the generators it
+### is in the middle of on a stack, so they handle any depth of nesting.
+### Making and resuming generators costs more than calling functions, so
+### _parseForm only uses them for forms nested deeper than
+### MaxRecursiveDepth.  test.py checks that both parse the same.
+###
+def _parseExprIterative (lexr):
+    return _runParse(_parseExprGen(lexr))
+
+def _runParse (parse):
+    stack = []
+    value = None
+    while True:
+        res = parse.send(value)
+        if type(res) is _generatorType:
+            stack.append(parse)
+            parse = res
+            value = None
+        elif stack:
+            parse = stack.pop()
+            value = res
         else:
-            raise Exception("Unexpected token in list -- " + repr(token))
-        if elt is None:
-            raise Exception("Internal: no next element in list?")
-        res.append(elt)
+            return res
+
+def _generatorFunction ():
+    yield None
+
+_generatorType = type(_generatorFunction())
+
+def _parseExprGen (lexr):
+    token = lexr.GetToken()
+    start = lexr.TokenStart
+    if _debug: debugprint("_parseExprGen: token= " + str(token))
+    if token is lexer.SyntaxToken.Paren:
+        lexr.PutToken(token)
+        res = yield _parseFormGen(lexr)
+    else:
+        res = _parseAtom(lexr, token)
+    ## Check for dotted expr.
+    _setSpan(res, start, lexr.TokenEnd)
+    next = lexr.GetToken()
+    lexr.PutToken(next)
+    if next is lexer.SyntaxToken.Dot:
+        res = yield _parseDottedExprGen(lexr, res)
+    yield res
+
+def _parseFormGen (lexr):
+    debugprint("IN parseform:")
+    token = lexr.GetToken()
+    if token is not lexer.SyntaxToken.Paren:
+        raise _syntaxError(lexr, "List expression must start with '('.")
+    start = lexr.TokenStart
+    token = lexr.GetToken()
+    if _debug: debugprint("first form token: " + str(token))
+    if isinstance(token, lexer.IdOrKeywordToken):
+        lexr.PutToken(token)
+        if _debug: debugprint("parseform: " + str(token))
+        if token.IsKeywordToken:
+            # Defun, Let, Set, Import, ...
+            res = yield _parseKeywordFormGen(lexr)
+        else:
+            res = yield _parseFunctionCallGen(lexr)
+    #elif token is lexer.SyntaxToken.Paren:
+    #    lexr.PutToken(token)
+    #    return _parseFunctionCallGen(lexr)
+    else:
+        lexr.PutToken(token)
+        res = yield _parseFunctionCallGen(lexr)
+        
+        ## What else could start a function call?  Any Expr?
+        #raise Exception("Sympl form must have ID or keyword as first element." +
+        #                "  Got " + str(token))
+    yield _setSpan(res, start, lexr.TokenEnd)
+
+def _parseKeywordFormGen (lexr):
+    debugprint("IN parse kwd form:")
+    name = lexr.GetToken()
+    if not isinstance(name, lexer.KeywordToken):
+        raise Exception("Internal error: parsing keyword form?")
+    lexr.PutToken(name)
+    if name is lexer.KeywordToken.Import:
+        return _parseImportGen(lexr)
+    elif name is lexer.KeywordToken.Defun:
+        return _parseDefunGen(lexr)
+    elif name is lexer.KeywordToken.Lambda:
+        return _parseLambdaGen(lexr)
+    elif name is lexer.KeywordToken.Set:
+        return _parseSetGen(lexr)
+    elif name is lexer.KeywordToken.LetStar:
+        return _parseLetStarGen(lexr)
+    elif name is lexer.KeywordToken.Block:
+        return _parseBlockGen(lexr)
+    elif name is lexer.KeywordToken.Eq:
+        return _parseEqGen(lexr)
+    elif name is lexer.KeywordToken.Cons:
+        return _parseConsGen(lexr)
+    elif name is lexer.KeywordToken.List:
+        return _parseListCallGen(lexr)
+    elif name is lexer.KeywordToken.If:
+        return _parseIfGen(lexr)
+    elif name is lexer.KeywordToken.Loop:
+        return _parseLoopGen(lexr)
+    elif name is lexer.KeywordToken.Break:
+        return _parseBreakGen(lexr)
+    elif name is lexer.KeywordToken.New:
+        return _parseNewGen(lexr)
+    elif name is lexer.KeywordToken.Elt:
+        return _parseEltGen(lexr)
+    elif (name is lexer.KeywordToken.Add or name is lexer.KeywordToken.Subtract or
+          name is lexer.KeywordToken.Multiply or name is lexer.KeywordToken.Divide or
+          name is lexer.KeywordToken.Equal or name is lexer.KeywordToken.NotEqual or
+          name is lexer.KeywordToken.GreaterThan or 
+          name is lexer.KeywordToken.LessThan or
+          name is lexer.KeywordToken.And or name is lexer.KeywordToken.Or):
+        return _parseExprTreeBinaryOpGen(lexr)
+    elif name is lexer.KeywordToken.Not:
+        return _parseExprTreeUnaryOpGen(lexr)
+    raise Exception("Internal: unrecognized keyword form?")
+
+def _parseDefunGen (lexr):
+    token = lexr.GetToken()
+    if token is not lexer.KeywordToken.Defun:
+        raise Exception("Internal: parsing Defun?")
+    name = lexr.GetToken()
+    if not isinstance(name, lexer.IdOrKeywordToken) or name.IsKeywordToken:
+        raise _syntaxError(lexr,
+                           "Defun must have an ID for name -- " + str(token))
+    params = _parseParams(lexr, "Defun")
+    body = yield _parseBodyGen(lexr, "Hit EOF in function body -- " + name.Name)
+    yield SymplDefunExpr(name, params, body)
+
+def _parseLambdaGen (lexr):
+    token = lexr.GetToken()
+    if token is not lexer.KeywordToken.Lambda:
+        raise Exception("Internal: parsing Lambda?")
+    params = _parseParams(lexr, "Lambda")
+    body = yield _parseBodyGen(lexr, "Hit EOF in function body -- ")
+    yield SymplLambdaExpr(params, body)
+
+def _parseBodyGen (lexr, errmsg):
+    body = []
+    token = lexr.GetToken()
+    while (token is not lexer.SyntaxToken.EOF and
+           token is not lexer.SyntaxToken.CloseParen):
+        lexr.PutToken(token)
+        body.append((yield _parseExprGen(lexr)))
         token = lexr.GetToken()
     if token is lexer.SyntaxToken.EOF:
-        raise Exception("Unexpected EOF encountered while parsing list.")
-    return SymplListExpr(res)
+        raise _syntaxError(lexr, errmsg)
+    yield body
+
+def _parseImportGen (lexr):
+    if lexr.GetToken() is not lexer.KeywordToken.Import:
+        raise Exception("Internal error: parsing Import call?")
+    ns_or_module = yield _parseImportNameOrModuleGen(lexr)
+    members = _parseImportNames(lexr, "member names", True)
+    as_names = _parseImportNames(lexr, "renames", False)
+    if lexr.GetToken() is not lexer.SyntaxToken.CloseParen:
+        raise _syntaxError(lexr, "Expected close paren for Import call.")
+    if (len(members) != len(as_names)) and (len(as_names) != 0):
+        raise _syntaxError(lexr,
+                           "Import as-names must be same form as member names.")
+    yield SymplImportExpr(ns_or_module, members, as_names)
+
+def _parseImportNameOrModuleGen (lexr):
+    token = lexr.GetToken()
+    if not isinstance(token, lexer.IdOrKeywordToken): # Keywords are ok here.
+        raise _syntaxError(lexr, "Id must follow Import symbol.")
+    start = lexr.TokenStart
+    end = lexr.TokenEnd
+    dot = lexr.GetToken()
+    if dot is lexer.SyntaxToken.Dot:
+        lexr.PutToken(dot)
+        tmp = yield _parseDottedExprGen(lexr, _setSpan(SymplIdExpr(token),
+                                                    start, end))
+        ns_or_module = []
+        for e in [tmp.ObjectExpr] + tmp.Exprs:
+            if not isinstance(e, SymplIdExpr): # Keywords are ok here too.
+                raise _syntaxError(lexr,
+                                   "Import targets must be dotted identifiers " +
+                                   "only -- " + str(e) + str(ns_or_module))
+            ns_or_module.append(e.IdToken)
+        token = lexr.GetToken()
+    else:
+        ns_or_module = [token]
+        token = dot
+    lexr.PutToken(token)
+    yield ns_or_module
+
+def _parseDottedExprGen (lexr, expr):
+    debugprint("IN parse dotted:")
+    obj_expr = expr
+    token = lexr.GetToken()
+    debugprint("parse dotted: " + str(token))
+    if token is not lexer.SyntaxToken.Dot:
+        raise Exception("Internal error: parsing dotted expressions?")
+    exprs = []
+    end = obj_expr.End
+    token = lexr.GetToken()
+    is_paren = token is lexer.SyntaxToken.Paren
+    is_id = isinstance(token, lexer.IdOrKeywordToken) # Keywords ok as members.
+    while (is_id or is_paren):
+        ## Need to be fun call or IDs
+        if is_id:
+            expr = _setSpan(SymplIdExpr(token), lexr.TokenStart, lexr.TokenEnd)
+        else:
+            lexr.PutToken(token)
+            expr = yield _parseFormGen(lexr)
+            if ((not isinstance(expr, SymplFunCallExpr)) or
+                (not isinstance(expr.Function, SymplIdExpr))):
+                raise _syntaxError(lexr,
+                                   "Dotted expressions must be identifiers or " +
+                                   "function calls with identiers as the function " +
+                                   "value --" + str(expr))
+        exprs.append(expr)
+        end = expr.End
+        token = lexr.GetToken()
+        if token is not lexer.SyntaxToken.Dot:
+            break
+        token = lexr.GetToken()
+        is_paren = token is lexer.SyntaxToken.Paren
+        is_id = isinstance(token, lexer.IdOrKeywordToken)
+    lexr.PutToken(token)
+    yield _setSpan(SymplDottedExpr(obj_expr, exprs), obj_expr.Start, end)
+
+def _parseSetGen (lexr):
+    if lexr.GetToken() is not lexer.KeywordToken.Set:
+        raise Exception("Internal error: parsing Set?")
+    lhs = yield _parseExprGen(lexr)
+    val = yield _parseExprGen(lexr)
+    if lexr.GetToken() is not lexer.SyntaxToken.CloseParen:
+        raise _syntaxError(lexr, "Expected close paren for Set expression.")
+    yield SymplAssignExpr(lhs, val)
+
+def _parseLetStarGen (lexr):
+    if lexr.GetToken() is not lexer.KeywordToken.LetStar:
+        raise Exception("Internal error: parsing Let?")
+    token = lexr.GetToken()
+    if token is not lexer.SyntaxToken.Paren:
+        raise _syntaxError(lexr,
+                           "Let expression has no bindings?  Missing '('.")
+    ## Get bindings
+    bindings = []
+    token = lexr.GetToken()
+    while token is lexer.SyntaxToken.Paren:
+        var = yield _parseExprGen(lexr)
+        if not isinstance(var, SymplIdExpr) or var.IdToken.IsKeywordToken:
+            raise _syntaxError(lexr, "Let* binding must be (<ID> <expr>) -- " +
+                               str(var))
+        init = yield _parseExprGen(lexr)
+        bindings.append((var.IdToken, init))
+        token = lexr.GetToken()
+        if token is not lexer.SyntaxToken.CloseParen:
+            raise _syntaxError(lexr, "Let binding missing close paren -- " +
+                               str(token))
+        token = lexr.GetToken()
+    if token is not lexer.SyntaxToken.CloseParen:
+        raise _syntaxError(lexr, "Let* bindings missing close paren.")
+    body = yield _parseBodyGen(lexr, "Unexpected EOF in Let.")
+    yield SymplLetStarExpr(bindings, body)
+
+def _parseBlockGen (lexr):
+    if lexr.GetToken() is not lexer.KeywordToken.Block:
+        raise Exception("Internal error: parsing Block?")
+    body = yield _parseBodyGen(lexr, "Unexpected EOF in Block.")
+    yield SymplBlockExpr(body)
+
+def _parseFunctionCallGen (lexr):  
+    debugprint("IN parse fun call:")
+    ## First sub expr is callable object or invoke member expr.
+    fun = yield _parseExprGen(lexr)
+    if ((type(fun) is SymplDottedExpr) and
+        (not isinstance(fun.Exprs[-1], SymplIdExpr))): #Keywords ok as members.
+        raise _syntaxError(lexr,
+                           "Function call with dotted expression for function " +
+                           "must end with ID Expr, not member invoke. " +
+                           str(fun.Exprs[-1]))
+    ## Tail exprs are args.
+    args = yield _parseBodyGen(lexr, "Unexpected EOF in arg list for " + str(fun))
+    yield SymplFunCallExpr(fun, args)
+
+def _parseEqGen (lexr):
+    token = lexr.GetToken()
+    if token is not lexer.KeywordToken.Eq:
+        raise Exception("Internal: parsing Eq?")
+    left, right = yield _parseBinaryRuntimeCallGen(lexr)
+    yield SymplEqExpr(left, right)
+
+def _parseConsGen (lexr):
+    token = lexr.GetToken()
+    if token is not lexer.KeywordToken.Cons:
+        raise Exception("Internal: parsing Cons?")
+    left, right = yield _parseBinaryRuntimeCallGen(lexr)
+    yield SymplConsExpr(left, right)
+
+def _parseBinaryRuntimeCallGen (lexr):
+    left = yield _parseExprGen(lexr)
+    right = yield _parseExprGen(lexr)
+    if lexr.GetToken() is not lexer.SyntaxToken.CloseParen:
+        raise _syntaxError(lexr,
+                           "Expected close paren for binary op or eq call.")
+    yield (left, right)
+
+def _parseListCallGen (lexr):
+    token = lexr.GetToken()
+    if token is not lexer.KeywordToken.List:
+        raise Exception("Internal: parsing List call?")
+    args = yield _parseBodyGen(lexr, "Unexpected EOF in arg list for call to List.")
+    yield SymplListCallExpr (args)
+
+def _parseIfGen (lexr):
+    token = lexr.GetToken()
+    if token is not lexer.KeywordToken.If:
+        raise Exception("Internal: parsing If?")
+    args = yield _parseBodyGen(lexr, "Unexpected EOF in If form.")
+    argslen = len(args)
+    if argslen == 2:
+        yield SymplIfExpr(args[0], args[1], None)
+    elif argslen == 3:
+        yield SymplIfExpr(args[0], args[1], args[2])
+    else:
+        raise _syntaxError(lexr,
+                           "IF must be (if <test> <consequent> [<alternative>]).")
+
+def _parseLoopGen (lexr):
+    if lexr.GetToken() is not lexer.KeywordToken.Loop:
+        raise Exception("Internal error: parsing Loop?")
+    body = yield _parseBodyGen(lexr, "Unexpected EOF in Loop.")
+    yield SymplLoopExpr(body)
+
+def _parseBreakGen (lexr):
+    if lexr.GetToken() is not lexer.KeywordToken.Break:
+        raise Exception("Internal error: parsing Break?")
+    token = lexr.GetToken()
+    if token == lexer.SyntaxToken.CloseParen:
+        value = None
+    else:
+        lexr.PutToken(token)
+        value = yield _parseExprGen(lexr)
+        token = lexr.GetToken()
+        if token != lexer.SyntaxToken.CloseParen:
+            raise _syntaxError(lexr, "Break expression missing close paren.")
+    yield SymplBreakExpr(value)
+
+def _parseNewGen (lexr):  
+    debugprint("IN new call:")
+    token = lexr.GetToken()
+    if token is not lexer.KeywordToken.New:
+        raise Exception("Internal: parsing New?")
+    typ = yield _parseExprGen(lexr)
+    args = yield _parseBodyGen(lexr, "Unexpected EOF in arg list for New" + str(typ))
+    yield SymplNewExpr(typ, args)
+
+def _parseEltGen (lexr):
+    token = lexr.GetToken()
+    if token is not lexer.KeywordToken.Elt:
+        raise Exception("Internal: parsing Elt?")
+    obj = yield _parseExprGen(lexr)
+    indexes = yield _parseBodyGen(lexr,
+                                  "Unexpected EOF in arg list for call to Elt.")
+    yield SymplEltExpr(obj, indexes)
+
+def _parseExprTreeBinaryOpGen (lexr):
+    token = lexr.GetToken()
+    if (token is lexer.KeywordToken.Add or token is lexer.KeywordToken.Subtract or
+        token is lexer.KeywordToken.Multiply or token is lexer.KeywordToken.Divide or
+        token is lexer.KeywordToken.Equal or token is lexer.KeywordToken.NotEqual or
+        token is lexer.KeywordToken.GreaterThan or 
+        token is lexer.KeywordToken.LessThan or
+        token is lexer.KeywordToken.And or token is lexer.KeywordToken.Or):
+        pass
+    else:
+        raise Exception("Internal: parsing Binary?")
+    left, right = yield _parseBinaryRuntimeCallGen(lexr)
+    yield SymplBinaryExpr(_getOpKind(token), left, right)
+
+def _parseExprTreeUnaryOpGen (lexr):
+    token = lexr.GetToken()
+    if token is not lexer.KeywordToken.Not:
+        raise Exception("Internal: unrecognized unary op")
+    operand = yield _parseExprGen(lexr)
+    if lexr.GetToken() is not lexer.SyntaxToken.CloseParen:
+        raise _syntaxError(lexr, "Expected close paren for unary op call.")
+    yield SymplUnaryExpr(_getOpKind(token), operand)
 
 
 
@@ -585,8 +1266,14 @@ def _parseList (lexr, errStr):
 ### SymplExpr Classes
 #####################
 
+### SymplExprs from the parser have Start and End char offsets for the source
+### text they came from, and a lexer.SourceIndex maps these to lines and
+### columns.  Exprs that etgen makes up, for example, to rewrite And and Or,
+### use the class defaults of -1.
+###
 class SymplExpr (object):
-    pass
+    Start = -1
+    End = -1
 
 ### SymplIdExpr represents identifiers, but the IdToken can be a keyword
 ### sometimes.  For example, in quoted lists, import expressions, and as
@@ -1,5 +1,8 @@
 
 import clr
+import bisect
+import sys
+import thread
 
 if clr.use35:
     clr.AddReference("Microsoft.Scripting")
@@ -9,32 +12,51 @@ if clr.use35:
     import Microsoft.Scripting.Ast as Exprs
     from Microsoft.Scripting.ComInterop import ComBinder
     from Microsoft.Scripting.Utils import (Action, Func)
+    from Microsoft.Scripting.Math import BigInteger
 else:
     clr.AddReference("System.Core")
     clr.AddReference("Microsoft.Dynamic")
     
+    clr.AddReference("System.Numerics")
+
     import System.Linq.Expressions as Exprs
     from Microsoft.Scripting.ComInterop import ComBinder
     from System import (Action, Func)
+    from System.Numerics import BigInteger
 
-from System.Runtime.CompilerServices import CallSite
+from System.Runtime.CompilerServices import CallSite, StrongBox
 from System.Dynamic import (ExpandoObject, InvokeBinder, DynamicMetaObject,
                             GetMemberBinder, SetMemberBinder, CallInfo,
                             BindingRestrictions, IDynamicMetaObjectProvider,
                             InvokeMemberBinder, CreateInstanceBinder,
                             GetIndexBinder, SetIndexBinder, 
-                            BinaryOperationBinder, UnaryOperationBinder)
+                            BinaryOperationBinder, UnaryOperationBinder,
+                            DynamicMetaObjectBinder)
 
 from System import (MissingMemberException,
                     InvalidOperationException, Boolean, MissingMemberException,
-                    Type, Array, Delegate, Void)
+                    Type, Array, Delegate, Void, Int32, Int64, Double)
 
 import System.Reflection as refl
+from System.Diagnostics import Stopwatch
 
 from System.IO import Path, File
 
 
 
+### TailCall is the type of what a tail call returns instead of calling its
+### function when Sympl.TailCalls is "trampoline": a StrongBox holding a thunk
+### that makes the call.  Each function then has two entries.  The inner one
+### returns TailCalls, and only the thunks of tail calls call it (see
+### GetTailEntry).  The function value that Sympl code, hosts and .NET code
+### get runs the inner one and then the thunk of each TailCall it gets back
+### until it gets a value, so they never see a TailCall.  We use a .NET type
+### rather than a Python class so that compiled code can test
+### results with TypeIs, which would match Sympl's Cons and Symbol objects too
+### if TailCall were a Python class.
+###
+TailCall = StrongBox[Func[object]]
+
 ### RuntimeHelpers is a collection of functions that perform operations at
 ### runtime of Sympl code, such as performing an import or fetching a global
 ### variable's value (depending on global look up semantics).
@@ -76,7 +98,15 @@ class RuntimeHelpers (object):
             setattr(module, what[-1], value)
         else:
             for n, m in zip(names, renames or names):
-                setattr(module, m, getattr(value, n))
+                ## Namespaces are IDOs whose members Python can't see.
+                if isinstance(value, NamespaceModel):
+                    member = helpers.GetMember(value, n)
+                    if member is helpers.Sentinel:
+                        raise Exception("Import: can't find name in " +
+                                        value.Contents.Name + " -- " + n)
+                    setattr(module, m, member)
+                else:
+                    setattr(module, m, getattr(value, n))
         return None
 
     @staticmethod
@@ -94,25 +124,70 @@ class RuntimeHelpers (object):
     def MakeCons (x, y):
         return Cons(x, y)
 
+    ### GetConsElt and SetConsElt index straight into the items of lists made
+    ### with Cons._List (see VectorCons), and they walk other lists.
+    ###
     @staticmethod
     def GetConsElt (lst, i):
+        if type(lst) is VectorCons and i >= 0:
+            vector = lst._vector
+            if vector.Reaches(lst._index, lst._index + i):
+                return vector.Items[lst._index + i]
         return RuntimeHelpers._nthcdr(lst, i).First
         
     @staticmethod
     def SetConsElt (lst, i, value):
+        if type(lst) is VectorCons and i >= 0:
+            vector = lst._vector
+            if vector.Reaches(lst._index, lst._index + i):
+                vector.Items[lst._index + i] = value
+                return value
         lst = RuntimeHelpers._nthcdr(lst, i)
         lst.First = value
         return value
 
     @staticmethod
     def _nthcdr (lst, i):
-        while i > 0 and lst is not None:
-            lst = lst.Rest
-            i = i - 1
-        if i == 0 and lst is not None:
+        n = i
+        while n > 0 and lst is not None:
+            if type(lst) is VectorCons:
+                lst, n = lst._vector.Skip(lst._index, n)
+            else:
+                lst = lst.Rest
+                n = n - 1
+        if n == 0 and lst is not None:
             return lst
         else:
-            raise Exception("List doesn't have " + repr(i) + " elements.")
+            raise Exception("List doesn't have " + repr(i + 1) + " elements.")
+
+    ### GetModuleSlots returns the array of StrongBoxes for the names (already
+    ### lowercased) in module, for code compiled with etgen.GlobalSlots.
+    ###
+    @staticmethod
+    def GetModuleSlots (module, names):
+        return ModuleGlobals.Get(module).GetBoxes(names)
+
+    ### AddTailEntry records that entry is the inner entry, which returns
+    ### TailCalls, of the function fun compiled with trampolining, and returns
+    ### fun.
+    ###
+    @staticmethod
+    def AddTailEntry (fun, entry):
+        _tailEntries[fun] = entry
+        return fun
+
+    ### GetTailEntry returns fun's inner entry if fun is a Sympl function
+    ### compiled with trampolining, and otherwise fun.  Tail calls call the
+    ### inner entry so that the callee returns its own tail calls to the
+    ### running trampoline instead of running them in a new frame.
+    ###
+    @staticmethod
+    def GetTailEntry (fun):
+        if isinstance(fun, Delegate):
+            entry = _tailEntries.get(fun)
+            if entry is not None:
+                return entry
+        return fun
 
 
     ### Don't need this in C# because can create an Property MemberExpr.  This
@@ -156,11 +231,14 @@ class RunHelpersInvokeBinder (InvokeBinder):
 ### are ParamExprs from the outer lambda wrapping a file's top-level exprs.
 ### What, names, and renames are lists (possibly empty) of IdTokens.
 ###
-def MakeSymplImportCall (runtime, module, what, names, renames):
+### SymplRuntime is the Sympl instance whose canonical binders to use, if any.
+###
+def MakeSymplImportCall (runtime, module, what, names, renames,
+                         symplRuntime = None):
     if not isinstance(names, list):
         raise Exception("Internal: name is not list?")
     return Exprs.Expression.Dynamic(
-            RunHelpersInvokeBinder(CallInfo(5)),
+            GetRunHelpersInvokeBinder(symplRuntime, 5),
             object, #ret type
             Exprs.Expression.Constant(RuntimeHelpers.SymplImport),
             runtime, module,
@@ -168,29 +246,57 @@ def MakeSymplImportCall (runtime, module, what, names, renames):
             Exprs.Expression.Constant([x.Name for x in names]),
             Exprs.Expression.Constant([x.Name for x in renames]))
 
-def MakeSymplEqCall (left, right):
+def MakeSymplEqCall (left, right, runtime = None):
     return Exprs.Expression.Convert(
               Exprs.Expression.Dynamic(
-                 RunHelpersInvokeBinder(CallInfo(2)),
+                 GetRunHelpersInvokeBinder(runtime, 2),
                  object, #ret type
                  Exprs.Expression.Constant(RuntimeHelpers.SymplEq),
                  left, right),
               bool) #clr.GetClrType(Boolean))
 
-def MakeSymplConsCall (left, right):
+def MakeSymplConsCall (left, right, runtime = None):
     return Exprs.Expression.Dynamic(
-            RunHelpersInvokeBinder(CallInfo(2)),
+            GetRunHelpersInvokeBinder(runtime, 2),
             object, #ret type
             Exprs.Expression.Constant(RuntimeHelpers.MakeCons),
             left, right)
 
-def MakeSymplListCall (args):
+def MakeSymplListCall (args, runtime = None):
     return Exprs.Expression.Dynamic(
-            RunHelpersInvokeBinder(CallInfo(len(args))),
+            GetRunHelpersInvokeBinder(runtime, len(args)),
             object, #ret type
             Exprs.Expression.Constant(Cons._List),
             *args)
 
+### These return the binders for the call sites the runtime itself builds,
+### taking them from the Sympl instance runtime so that the sites share L2
+### caches with each other and with Sympl code's sites.  Runtime is None for
+### binders made outside any Sympl instance's tables, and then we make a fresh
+### binder whose sites share nothing, as Sympl used to for all these sites.
+###
+def GetRunHelpersInvokeBinder (runtime, count):
+    if runtime is None:
+        return RunHelpersInvokeBinder(CallInfo(count))
+    return runtime.GetRunHelpersInvokeBinder(CallInfo(count))
+
+def GetReflTypeBinder (runtime):
+    if runtime is None:
+        return SymplGetMemberBinder("ReflType")
+    return runtime.GetGetMemberBinder("ReflType")
+
+def GetInvokeBinder (runtime, count):
+    if runtime is None:
+        return SymplInvokeBinder(CallInfo(count))
+    return runtime.GetInvokeBinder(CallInfo(count))
+
+### GetBinderRuntime returns the Sympl instance binder came from, or None if
+### it is not a Sympl binder or was not made by a Sympl instance.  TypeModel
+### meta-objects see IronPython's binders too.
+###
+def GetBinderRuntime (binder):
+    return getattr(binder, "Runtime", None)
+
 
 
 ###############################
@@ -233,6 +339,104 @@ def GetTargetArgsRestrictions (targetMO, argMOs, targetInst):
         restrictions = restrictions.Merge(r)
     return restrictions
 
+### MemberCache caches the reflection lookups binders make when a call site
+### misses its rules, so that sites that see many types do not reflect over the
+### same type again.  Entries are keyed on the type, member name, argument
+### count, and binding flags, and they hold tuples of members, or of (member,
+### ParameterInfos) pairs already filtered by argument count.  GetOverload
+### also remembers which candidate SelectOverload picked for each tuple of
+### argument types.  Members is the cache the binders share.
+###
+### Like Sympl's BinderTable, reads do not lock, so Hits and Misses may miss a
+### few counts when threads race.
+###
+class MemberCache (object):
+    def __init__ (self):
+        self.Hits = 0
+        self.Misses = 0
+        self._lock = thread.allocate_lock()
+        self._entries = dict()
+
+    ### GetMembers returns typ.GetMember(name, flags) as a tuple.
+    ###
+    def GetMembers (self, typ, name, flags):
+        return self._get("members", typ, name, -1, flags,
+                         lambda: tuple(typ.GetMember(name, flags)))
+
+    ### GetMethods returns (MethodInfo, ParameterInfos) pairs for the methods
+    ### from GetMembers that take count parameters.
+    ###
+    def GetMethods (self, typ, name, flags, count):
+        return self._get("methods", typ, name, count, flags,
+                         lambda: _withParams(
+                                     [x for x in typ.GetMember(name, flags)
+                                      if isinstance(x, refl.MethodInfo)],
+                                     count))
+
+    ### GetConstructors returns (ConstructorInfo, ParameterInfos) pairs for
+    ### typ's public constructors that take count parameters.
+    ###
+    def GetConstructors (self, typ, count):
+        return self._get("constructors", typ, None, count, None,
+                         lambda: _withParams(typ.GetConstructors(), count))
+
+    ### GetIndexers returns (PropertyInfo, ParameterInfos) pairs for typ's
+    ### public properties that take count index parameters.
+    ###
+    def GetIndexers (self, typ, count):
+        return self._get("indexers", typ, None, count, None,
+                         lambda: tuple([(p, tuple(p.GetIndexParameters()))
+                                        for p in typ.GetProperties()
+                                        if len(p.GetIndexParameters()) ==
+                                           count]))
+
+    ### GetOverload returns SelectOverload(candidates, args), where candidates
+    ### came from this cache's kind lookup of name on typ.  The choice only
+    ### depends on the args' LimitTypes (and whether they are TypeModels),
+    ### which is what binders restrict on, so we remember it per tuple of
+    ### those.
+    ###
+    def GetOverload (self, kind, typ, name, flags, candidates, args):
+        argTypes = tuple([(a.LimitType, type(a.Value) is TypeModel)
+                          for a in args])
+        return self._get(kind + " overload", typ, name, argTypes, flags,
+                         lambda: SelectOverload(candidates, args))
+
+    def Clear (self):
+        with self._lock:
+            self._entries.clear()
+
+    ### shape is the argument count, or the argument types for overloads.
+    ###
+    def _get (self, kind, typ, name, shape, flags, find):
+        if (name is not None and
+            (flags & refl.BindingFlags.IgnoreCase) ==
+                refl.BindingFlags.IgnoreCase):
+            name = name.lower()
+        key = (kind, typ, name, shape, flags)
+        entry = self._entries.get(key, _noEntry)
+        if entry is not _noEntry:
+            self.Hits += 1
+            return entry
+        self.Misses += 1
+        entry = find()
+        with self._lock:
+            self._entries[key] = entry
+        return entry
+
+_noEntry = object()
+
+def _withParams (members, count):
+    res = []
+    for m in members:
+        params = tuple(m.GetParameters())
+        if len(params) == count:
+            res.append((m, params))
+    return tuple(res)
+
+Members = MemberCache()
+
+
 ### ParamsMatchArgs returns whether the args are assignable to the parameters.
 ### We specially check for our TypeModel that wraps .NET's RuntimeType, and
 ### elsewhere we detect the same situation to convert the TypeModel for calls.
@@ -257,20 +461,52 @@ def ParamsMatchArgs (params, args):
             return False
     return True
 
+### SelectOverload returns the (member, ParameterInfos) pair from candidates
+### whose parameters best fit args, or None if none applies.  Of the
+### candidates that ParamsMatchArgs, we keep those that no other is more
+### specific than (see _moreSpecific), and then prefer the one with the most
+### parameters exactly matching the args' LimitTypes, and then reflection
+### order.  This picks Console.WriteLine(Int32) over WriteLine(Object) for an
+### int, where binders used to take whichever applicable method came first.
+###
+def SelectOverload (candidates, args):
+    applicable = [c for c in candidates if ParamsMatchArgs(c[1], args)]
+    best = None
+    bestExact = -1
+    for c in applicable:
+        if any(_moreSpecific(o[1], c[1]) for o in applicable if o is not c):
+            continue
+        exact = len([p for p, a in zip(c[1], args)
+                     if p.ParameterType == a.LimitType])
+        if exact > bestExact:
+            best = c
+            bestExact = exact
+    return best
+
+### _moreSpecific returns whether every parameter type in params1 converts to
+### the one in params2, and they are not the same types.
+###
+def _moreSpecific (params1, params2):
+    same = True
+    for p1, p2 in zip(params1, params2):
+        if p1.ParameterType != p2.ParameterType:
+            if not p2.ParameterType.IsAssignableFrom(p1.ParameterType):
+                return False
+            same = False
+    return not same
+
 ### Returns a DynamicMetaObject with an expression that fishes the .NET
-### RuntimeType object from the TypeModel MO.
+### RuntimeType object from the TypeModel MO.  Runtime is the Sympl instance
+### whose GetMember binder to use (see GetReflTypeBinder).
 ###
-def GetRuntimeTypeMoFromModel (typeMO):
+def GetRuntimeTypeMoFromModel (typeMO, runtime = None):
     if type(typeMO) is not TypeModelMetaObject:
         raise Exception("Internal: Need TMMO to fish out ReflType.")
     return DynamicMetaObject(
                ## In C# can use Expression.Call on methodinfo.
                Exprs.Expression.Convert(
                    Exprs.Expression.Dynamic(
-                       ## This call site doesn't share any L2 caching
-                       ## since we don't call GetGetMemberBinder from Sympl.
-                       ## We aren't plumbed to get the runtime instance here.
-                       SymplGetMemberBinder("ReflType"),
+                       GetReflTypeBinder(runtime),
                        object,
                        typeMO.Expression),
                    Type),
@@ -300,26 +536,33 @@ def GetRuntimeTypeMoFromModel (typeMO):
 ### NOTE, if using this function, then need to use GetTargetArgsRestrictions
 ### and make sure you're performing the same conversions as restrictions.
 ###
-def ConvertArguments (argMOs, pinfos):
+### Runtime is passed on to GetRuntimeTypeMoFromModel.  We leave out the
+### Convert when the arg expr already has the param type, so that, say, object
+### args pass straight to object params.
+###
+def ConvertArguments (argMOs, pinfos, runtime = None):
     res = []
     for p,a in zip(pinfos, argMOs):
         argExpr = a.Expression
         if type(a.Value) is TypeModel and p.ParameterType is clr.GetClrType(Type):
-            argExpr = GetRuntimeTypeMoFromModel(a).Expression
-        res.append(Exprs.Expression.Convert(argExpr, p.ParameterType))
+            argExpr = GetRuntimeTypeMoFromModel(a, runtime).Expression
+        if argExpr.Type != p.ParameterType:
+            argExpr = Exprs.Expression.Convert(argExpr, p.ParameterType)
+        res.append(argExpr)
     return res
 
 ###
 ### Note, callers must ensure the DynamicMetaObject that uses this expression
 ### has consistent restrictions for the conversion done on args and the target.
+### Runtime is the Sympl instance whose binders to use for nested sites.
 ###
-def GetIndexExpression (targetMO, indexMOs):
+def GetIndexExpression (targetMO, indexMOs, runtime = None):
     indexExprs = [Exprs.Expression.Convert(x.Expression, x.LimitType)
                   for x in indexMOs]
-    if type(targetMO.Value) is Cons:  #Don't look at LimitType to compare py type objs.
+    if isinstance(targetMO.Value, ConsCell):  #Don't look at LimitType to compare py type objs.
         ## In C# can use Expression.Call on methodinfo.
         return Exprs.Expression.Dynamic(
-                  RunHelpersInvokeBinder(CallInfo(2)),
+                  GetRunHelpersInvokeBinder(runtime, 2),
                   object,
                   Exprs.Expression.Constant(RuntimeHelpers.GetConsElt),
                   Exprs.Expression.Convert(targetMO.Expression,
@@ -332,13 +575,10 @@ def GetIndexExpression (targetMO, indexMOs):
                    indexExprs)
     else:
         ## Check for Item indexer.
-        props = targetMO.LimitType.GetProperties()
-        props = [x for x in props if len(x.GetIndexParameters()) == len(indexMOs)]
-        res = []
-        for p in props:
-            if ParamsMatchArgs(p.GetIndexParameters(), indexMOs):
-                res.append(p)
-        if len(res) == 0:
+        props = Members.GetIndexers(targetMO.LimitType, len(indexMOs))
+        best = Members.GetOverload("indexers", targetMO.LimitType, None, None,
+                                   props, indexMOs)
+        if best is None:
             return Exprs.Expression.Throw(
                       Exprs.Expression.New(
                           MissingMemberException.GetConstructor(
@@ -348,7 +588,7 @@ def GetIndexExpression (targetMO, indexMOs):
         return Exprs.Expression.MakeIndex(
                   Exprs.Expression.Convert(targetMO.Expression, 
                                            targetMO.LimitType),
-                  res[0], indexExprs)
+                  best[0], ConvertArguments(indexMOs, best[1], runtime))
 
 ## CreateThrow takes arguments like fallback and bind methods, dynamic meta
 ## objects.  It also takes restrictions to constrain when the throw rule is
@@ -462,7 +702,7 @@ class TypeModelMetaObject (DynamicMetaObject):
                  refl.BindingFlags.Public)
         ## consider BindingFlags.Instance if want to return wrapper for
         ## inst members that is callable.
-        members = self.ReflType.GetMember(binder.Name, flags)
+        members = Members.GetMembers(self.ReflType, binder.Name, flags)
         if len(members) == 1:
             return DynamicMetaObject(
                       ## We always access static members for type model
@@ -493,7 +733,7 @@ class TypeModelMetaObject (DynamicMetaObject):
         debugprint("tmmo: bindinvokemember ...", binder.Name)
         flags = (refl.BindingFlags.IgnoreCase | refl.BindingFlags.Static |
                  refl.BindingFlags.Public)
-        members = self.ReflType.GetMember(binder.Name, flags)
+        members = Members.GetMembers(self.ReflType, binder.Name, flags)
         if (len(members) == 1 and
             (isinstance(members[0], refl.PropertyInfo) or
              isinstance(members[0], refl.FieldInfo))):
@@ -511,35 +751,35 @@ class TypeModelMetaObject (DynamicMetaObject):
         else:
             ## Get MethodInfos with right arg count.
             debugprint("tmmo bind invoke mem ... searching ...", len(members))
-            mi_mems = [x for x in members if isinstance(x, refl.MethodInfo) and
-                       len(x.GetParameters()) == len(args)]
+            mi_mems = Members.GetMethods(self.ReflType, binder.Name, flags,
+                                         len(args))
             debugprint("methodinfo members with same arg count: ", len(mi_mems))
             debugprint(mi_mems)
-            res = []
-            for mem in mi_mems:
-                if ParamsMatchArgs(mem.GetParameters(), args):
-                    res.append(mem)
-            if len(res) == 0:
+            best = Members.GetOverload("methods", self.ReflType, binder.Name,
+                                       flags, mi_mems, args)
+            if best is None:
                 ## Sometimes when binding members on TypeModels the member
                 ## is an intance member since the Type is an instance of Type.
                 ## We fallback to the binder with the Type instance to see if
                 ## it binds.  The SymplInvokeMemberBinder does handle this.
-                refltypeMO = GetRuntimeTypeMoFromModel(self)
+                refltypeMO = GetRuntimeTypeMoFromModel(
+                                 self, GetBinderRuntime(binder))
                 return binder.FallbackInvokeMember(refltypeMO, args, None)
             ## True means generate an instance restriction on the MO.
             ## We are only looking at the members defined in this Type instance.
             restrictions = GetTargetArgsRestrictions(self, args, True)
             ## restrictions and conversion must be done consistently.
-            callArgs = ConvertArguments(args, res[0].GetParameters())
+            callArgs = ConvertArguments(args, best[1],
+                                        GetBinderRuntime(binder))
             ## Fix expr to satisfy object type required by CallSite.
             return DynamicMetaObject(
-                       EnsureObjectResult(Exprs.Expression.Call(res[0],
+                       EnsureObjectResult(Exprs.Expression.Call(best[0],
                                                                 callArgs)),
                        restrictions)
             ## Could try just letting Expr.Call factory do the work, but if
             ## there is more than one applicable method using just
             ## assignablefrom, Expr.Call flames out.  It does not pick a "most
-            ## applicable" method.
+            ## applicable" method, so SelectOverload does.
             
             ## Defer to IPy binding to invoke TypeModel instance members.  IPy
             ## will fallback to the binder as appropriate.
@@ -547,25 +787,22 @@ class TypeModelMetaObject (DynamicMetaObject):
             ##return self.BaseIDOMO.BindInvokeMember(binder, args)
     
     def BindCreateInstance (self, binder, args):
-        ctors = self.ReflType.GetConstructors()
         ## Get constructors with right arg count.
-        ctors = [x for x in ctors 
-                   if len(x.GetParameters()) == len(args)]
-        res = []
-        for mem in ctors:
-            if ParamsMatchArgs(mem.GetParameters(), args):
-                res.append(mem)
-        if len(res) == 0:
-            refltypeMO = GetRuntimeTypeMoFromModel(self)
+        ctors = Members.GetConstructors(self.ReflType, len(args))
+        best = Members.GetOverload("constructors", self.ReflType, None, None,
+                                   ctors, args)
+        if best is None:
+            refltypeMO = GetRuntimeTypeMoFromModel(self,
+                                                   GetBinderRuntime(binder))
             return binder.FallbackCreateInstance(refltypeMO, args)
         ## True means generate an instance restriction on the MO.
         ## We only have a rule to create this exact type.
         restrictions = GetTargetArgsRestrictions(self, args, True)
         ## restrictions and conversion must be done consistently.
-        callArgs = ConvertArguments(args, res[0].GetParameters())
+        callArgs = ConvertArguments(args, best[1], GetBinderRuntime(binder))
         return DynamicMetaObject(
                    ## Creating an object, so don't need EnsureObjectResult.
-                   Exprs.Expression.New(res[0], callArgs),
+                   Exprs.Expression.New(best[0], callArgs),
                    restrictions)
 
     ###
@@ -600,6 +837,119 @@ class TypeModelMetaObject (DynamicMetaObject):
         return self.BaseIDOMO.BindBinaryOperation (binder, arg)
 
 
+### NamespaceModel represents a .NET namespace in Sympl.Globals, with nested
+### NamespaceModels and TypeModels as members.  Sympl.Globals only holds the
+### top-level namespaces, and each namespace sorts out its members and makes
+### TypeModels only when code first looks up a member, so that making a
+### runtime does not reflect over every type in every assembly.
+###
+### As with TypeModel, NamespaceModelMetaObject cannot access NamespaceModel
+### members without going through GetMetaObject again, so the namespace keeps
+### its state in a NamespaceContents that GetMetaObject hands to the MO.
+###
+class NamespaceModel (object, IDynamicMetaObjectProvider):
+    def __init__ (self, name, types):
+        self.Contents = NamespaceContents(name, types)
+
+    def GetMetaObject (self, objParam):
+        baseIdoMo = IDynamicMetaObjectProvider.GetMetaObject(self, objParam)
+        if hasattr(self, "Contents"):
+            return NamespaceModelMetaObject(objParam, self, self.Contents,
+                                            baseIdoMo)
+        return baseIdoMo
+
+
+### NamespaceContents takes the namespace's full name and a list of
+### (name, assembly) pairs for the types in it and the namespaces below it,
+### with names relative to the namespace (for example, "IO.File" in System).
+### GetMember looks up a member by name, returning None if there is none.
+###
+class NamespaceContents (object):
+    def __init__ (self, name, types):
+        self.Name = name
+        self._types = types
+        ## Map lowered name to [name, member], where member is a (full name,
+        ## assembly) pair until code fetches the type.
+        self._members = None
+        self._lock = thread.allocate_lock()
+
+    def GetMember (self, name, ignoreCase):
+        members = self._members
+        if members is None:
+            members = self._sortMembers()
+        entry = members.get(name.lower())
+        if entry is None or (not ignoreCase and entry[0] != name):
+            return None
+        member = entry[1]
+        if type(member) is tuple:
+            with self._lock:
+                member = entry[1]
+                if type(member) is tuple:
+                    fullname, assm = member
+                    member = TypeModel(assm.GetType(fullname))
+                    entry[1] = member
+        return member
+
+    def GetMemberNames (self):
+        members = self._members
+        if members is None:
+            members = self._sortMembers()
+        return [entry[0] for entry in members.values()]
+
+    def _sortMembers (self):
+        with self._lock:
+            if self._members is not None:
+                return self._members
+            prefix = self.Name and self.Name + "."
+            members = {}
+            namespaces = {}
+            for name, assm in self._types:
+                dot = name.find(".")
+                if dot < 0:
+                    members[name.lower()] = [name, (prefix + name, assm)]
+                else:
+                    ns = name[:dot]
+                    if ns not in namespaces:
+                        namespaces[ns] = []
+                    namespaces[ns].append((name[dot + 1:], assm))
+            ## Namespaces win over types of the same name.
+            for ns, types in namespaces.iteritems():
+                members[ns.lower()] = [ns, NamespaceModel(prefix + ns, types)]
+            self._types = None
+            self._members = members
+            return members
+
+
+class NamespaceModelMetaObject (DynamicMetaObject):
+    def __new__ (self, objParam, nsModel, contents, baseIdoMo):
+        mo = super(NamespaceModelMetaObject, self).__new__(
+                 NamespaceModelMetaObject, objParam, BindingRestrictions.Empty,
+                 nsModel)
+        mo.Contents = contents
+        mo.BaseIDOMO = baseIdoMo
+        return mo
+
+    ### Namespace members never change, so the rule returns the member as a
+    ### constant for this namespace instance.
+    ###
+    def BindGetMember (self, binder):
+        member = self.Contents.GetMember(binder.Name, binder.IgnoreCase)
+        if member is None:
+            ## Defer to IPy binding to access NamespaceModel instance members.
+            ## IPy will fallback to the binder as appropriate.
+            return self.BaseIDOMO.BindGetMember(binder)
+        return DynamicMetaObject(
+                   Exprs.Expression.Constant(member, object),
+                   BindingRestrictions.GetInstanceRestriction(self.Expression,
+                                                              self.Value))
+
+    def GetDynamicMemberNames (self):
+        return self.Contents.GetMemberNames()
+
+    def BindSetMember (self, binder, valueMO):
+        return self.BaseIDOMO.BindSetMember(binder, valueMO)
+
+
 
 #######################################################
 ### Dynamic Helpers for HasMember, GetMember, SetMember
@@ -729,14 +1079,101 @@ class DOHelpersSetMemberBinder (SetMemberBinder):
 
 
 
+### ModuleGlobals holds the StrongBoxes that code compiled with
+### etgen.GlobalSlots reads module globals from, one box per name in a module.
+### The module ExpandoObject stays the real storage, so hosts and imports see
+### and set members as always.  A box holds DynamicObjectHelpers.Sentinel
+### when we don't know its value: etgen's code then gets the member from the
+### module and stores it in the box.  Sympl code sets the module member and
+### then its box, and whenever anything else sets or removes a module member,
+### the module's PropertyChanged event resets the box to Sentinel.
+###
+class ModuleGlobals (object):
+    def __init__ (self, module):
+        self.Module = module
+        self._lock = thread.allocate_lock()
+        self._boxes = dict()
+        module.PropertyChanged += self._changed
+
+    ### Get returns module's ModuleGlobals, making it the first time.
+    ###
+    @staticmethod
+    def Get (module):
+        globals = _moduleGlobals.get(module)
+        if globals is None:
+            with _moduleGlobalsLock:
+                globals = _moduleGlobals.get(module)
+                if globals is None:
+                    globals = ModuleGlobals(module)
+                    _moduleGlobals[module] = globals
+        return globals
+
+    def GetBoxes (self, names):
+        with self._lock:
+            boxes = []
+            for name in names:
+                box = self._boxes.get(name)
+                if box is None:
+                    box = StrongBox[object](DynamicObjectHelpers.Sentinel)
+                    self._boxes[name] = box
+                boxes.append(box)
+        return Array[StrongBox[object]](boxes)
+
+    def _changed (self, sender, e):
+        box = self._boxes.get(e.PropertyName.lower())
+        if box is not None:
+            box.Value = DynamicObjectHelpers.Sentinel
+
+## Maps module ExpandoObjects to their ModuleGlobals, and trampolined
+## functions to their inner entries (see RuntimeHelpers.AddTailEntry).  These
+## are ConditionalWeakTables so that modules and functions can still be
+## collected.  .NET 3.5 has none, so Sympl does not allow ResolveGlobals or
+## trampolining there (see Sympl._checkOptions).
+if clr.use35:
+    _moduleGlobals = None
+    _tailEntries = None
+else:
+    from System.Runtime.CompilerServices import ConditionalWeakTable
+
+    class _WeakTable (object):
+        def __init__ (self, keyType):
+            self._table = ConditionalWeakTable[keyType, object]()
+
+        def get (self, key):
+            found, value = self._table.TryGetValue(key)
+            if found:
+                return value
+            return None
+
+        def __setitem__ (self, key, value):
+            self._table.Add(key, value)
+
+    _moduleGlobals = _WeakTable(ExpandoObject)
+    _tailEntries = _WeakTable(Delegate)
+_moduleGlobalsLock = thread.allocate_lock()
+
+
+
 ###########################
 ### General Runtime Binders
 ###########################
 
+### Each Sympl binder has the Sympl instance whose binder table made it as its
+### Runtime, so that the sites it builds while binding can use that instance's
+### canonical binders too (see GetRunHelpersInvokeBinder).  Runtime is None
+### for binders made directly.  Rules counts the times the binder's Fallback
+### methods have run, which happens only when a site misses both its own rules
+### and the binder's L2 cache (IDOs that bind operations themselves do not fall
+### back).  It may miss counts when threads race.
+###
+
 ### SymplGetMemberBinder is used for general dotted expressions for fetching
 ### members.
 ###
 class SymplGetMemberBinder (GetMemberBinder):
+    Runtime = None
+    Rules = 0
+
     #def __init__ (self, name, ignoreCase):
     #    ## super(...) always works, even with multiple inheritance but
     #    ## GetMemberBinder.__init__(self, name, True) would work in this case.
@@ -746,6 +1183,7 @@ class SymplGetMemberBinder (GetMemberBinder):
         return GetMemberBinder.__new__(cls, name, True) # True = IgnoreCase
 
     def FallbackGetMember(self, targetMO, errorSuggestionMO):
+        self.Rules += 1
         ## Defer if any object has no value so that we evaulate their
         ## Expressions and nest a CallSite for the GetMember.
         if not targetMO.HasValue:
@@ -759,7 +1197,7 @@ class SymplGetMemberBinder (GetMemberBinder):
         flags = (refl.BindingFlags.IgnoreCase | refl.BindingFlags.Static |
                  refl.BindingFlags.Instance | refl.BindingFlags.Public)
         ## bindingflags.flattenhierarchy?  public and protected static members
-        members = targetMO.LimitType.GetMember(self.Name, flags)
+        members = Members.GetMembers(targetMO.LimitType, self.Name, flags)
         if len(members) == 1:
             return DynamicMetaObject(
                        EnsureObjectResult(
@@ -788,6 +1226,9 @@ class SymplGetMemberBinder (GetMemberBinder):
 ### members.
 ###
 class SymplSetMemberBinder (SetMemberBinder):
+    Runtime = None
+    Rules = 0
+
     #def __init__ (self, name, ignoreCase):
     #    ## super(...) always works, even with multiple inheritance but
     #    ## GetMemberBinder.__init__(self, name, True) would work in this case.
@@ -797,6 +1238,7 @@ class SymplSetMemberBinder (SetMemberBinder):
         return SetMemberBinder.__new__(cls, name, True) # True = IgnoreCase
 
     def FallbackSetMember(self, targetMO, valueMO, errorSuggestionMO):
+        self.Rules += 1
         debugprint("symplsetmember fallback ...", targetMO.Expression, self.Name,
                    " ..name now expr..", valueMO.Expression)
         ## Defer if any object has no value so that we evaulate their
@@ -810,7 +1252,7 @@ class SymplSetMemberBinder (SetMemberBinder):
         ## Find our own binding.
         flags = (refl.BindingFlags.IgnoreCase | refl.BindingFlags.Static |
                  refl.BindingFlags.Instance | refl.BindingFlags.Public)
-        members = targetMO.LimitType.GetMember(self.Name, flags)
+        members = Members.GetMembers(targetMO.LimitType, self.Name, flags)
         if len(members) == 1:
             mem = members[0]
             val = None
@@ -861,10 +1303,14 @@ class SymplSetMemberBinder (SetMemberBinder):
 ### calls for invoking members.
 ###
 class SymplInvokeMemberBinder (InvokeMemberBinder):
+    Runtime = None
+    Rules = 0
+
     def __new__ (cls, name, callinfo):
         return InvokeMemberBinder.__new__(cls, name, True, callinfo)
 
     def FallbackInvokeMember (self, targetMO, argMOs, errorSuggestionMO):
+        self.Rules += 1
         ## Defer if any object has no value so that we evaulate their
         ## Expressions and nest a CallSite for the InvokeMember.
         if not targetMO.HasValue or not all(map(lambda x: x.HasValue, argMOs)):
@@ -876,7 +1322,7 @@ class SymplInvokeMemberBinder (InvokeMemberBinder):
         ## Find our own binding.
         flags = (refl.BindingFlags.IgnoreCase | refl.BindingFlags.Instance |
                  refl.BindingFlags.Public)
-        members = targetMO.LimitType.GetMember(self.Name, flags)
+        members = Members.GetMembers(targetMO.LimitType, self.Name, flags)
         if (len(members) == 1 and
             (isinstance(members[0], refl.PropertyInfo) or
              isinstance(members[0], refl.FieldInfo))):
@@ -894,44 +1340,40 @@ class SymplInvokeMemberBinder (InvokeMemberBinder):
         else:
             ## Get MethodInfos with right arg count.
             debugprint("tmmo bind invoke mem ... searching ...", len(members))
-            mi_mems = [x for x in members if isinstance(x, refl.MethodInfo) and
-                       len(x.GetParameters()) == len(argMOs)]
+            mi_mems = Members.GetMethods(targetMO.LimitType, self.Name, flags,
+                                         len(argMOs))
             debugprint("methodinfo members with same arg count: ", len(mi_mems))
             debugprint(mi_mems)
-            res = []
-            for mem in mi_mems:
-                if ParamsMatchArgs(mem.GetParameters(), argMOs):
-                    res.append(mem)
+            best = Members.GetOverload("methods", targetMO.LimitType,
+                                       self.Name, flags, mi_mems, argMOs)
             ## False below means generate a type restriction on the MO.
             ## We are looking at the members targetMO's Type.
             restrictions = GetTargetArgsRestrictions(targetMO, argMOs, False)
             ## See if we have a result and return an error MO.
-            if len(res) == 0:
+            if best is None:
                 return (errorSuggestionMO or
                          CreateThrow(
                            targetMO, argMOs, restrictions,
                            MissingMemberException,
                            "Cannot bind member invoke -- " + repr(argMOs)))
             ## restrictions and conversion must be done consistently.
-            callArgs = ConvertArguments(argMOs, res[0].GetParameters())
+            callArgs = ConvertArguments(argMOs, best[1], self.Runtime)
             return DynamicMetaObject(
                        EnsureObjectResult(
                           Exprs.Expression.Call(
                               Exprs.Expression.Convert(targetMO.Expression,
                                                        targetMO.LimitType),
-                              res[0], callArgs)),
+                              best[0], callArgs)),
                        restrictions)
 
     def FallbackInvoke (self, targetMO, argMOs, errorSuggestionMO):
+        self.Rules += 1
         ## Just "defer" since we have code in SymplInvokeBinder that knows
         ## what to do, and typically this fallback is from a language like Python
         ## that passes a DynamicMetaObject with HasValue == false.
         return DynamicMetaObject(
                    Exprs.Expression.Dynamic(
-                      ## This call site doesn't share any L2 caching
-                      ## since we don't call GetInvokeBinder from Sympl.
-                      ## We aren't plumbed to get the runtime instance here.
-                      SymplInvokeBinder(CallInfo(len(argMOs))),
+                      GetInvokeBinder(self.Runtime, len(argMOs)),
                        object, #ret type
                        [targetMO.Expression] +
                           [x.Expression for x in argMOs]),
@@ -965,8 +1407,11 @@ class InvokeMemberBinderKey (object):
 ### really get handled by their MOs.
 ###
 class SymplInvokeBinder (InvokeBinder):
+    Runtime = None
+    Rules = 0
 
     def FallbackInvoke (self, targetMO, argMOs, errorSuggestionMO):
+        self.Rules += 1
         debugprint("symplinvokebinder fallback...", targetMO.Expression, "...",
                    [x.Expression for x in argMOs])
         ## Defer if any object has no value so that we evaulate their
@@ -989,7 +1434,7 @@ class SymplInvokeBinder (InvokeBinder):
                 expression = Exprs.Expression.Invoke(
                                Exprs.Expression.Convert(targetMO.Expression,
                                                         targetMO.LimitType),
-                               ConvertArguments(argMOs, params))
+                               ConvertArguments(argMOs, params, self.Runtime))
                 return DynamicMetaObject(
                            EnsureObjectResult(expression),
                            BindingRestrictions.GetTypeRestriction(
@@ -1008,10 +1453,14 @@ class SymplInvokeBinder (InvokeBinder):
 ### really do the work.
 ###
 class SymplCreateInstanceBinder (CreateInstanceBinder):
+    Runtime = None
+    Rules = 0
+
     def __new__ (cls, callinfo):
         return CreateInstanceBinder.__new__(cls, callinfo)
 
     def FallbackCreateInstance (self, targetMO, argMOs, errorSuggestionMO):
+        self.Rules += 1
         ## Defer if any object has no value so that we evaulate their
         ## Expressions and nest a CallSite for the CreateInstance.
         if not targetMO.HasValue or not all(map(lambda x: x.HasValue, argMOs)):
@@ -1025,38 +1474,39 @@ class SymplCreateInstanceBinder (CreateInstanceBinder):
                        ("Type object must be used when creating instance -- " +
                         repr(targetMO))))
         ## Get constructors with right arg count.
-        ctors = [x for x in targetMO.Value.GetConstructors() 
-                   if len(x.GetParameters()) == len(argMOs)]
+        ctors = Members.GetConstructors(targetMO.Value, len(argMOs))
         ## Get ctors with param types that work for args.  This works
         ## for except for value args that need to pass to reftype params. 
         ## We could detect that to be smarter and then explicitly StrongBox
         ## the args.
-        res = []
-        for mem in ctors:
-            if ParamsMatchArgs(mem.GetParameters(), argMOs):
-                res.append(mem)
+        best = Members.GetOverload("constructors", targetMO.Value, None, None,
+                                   ctors, argMOs)
         ## True means generate an instance restriction on the MO.
         ## We are only looking at the members defined in this Type instance.
         restrictions = GetTargetArgsRestrictions(targetMO, argMOs, True)
-        if len(res) == 0:
+        if best is None:
             return (errorSuggestionMO or
                      CreateThrow(
                        targetMO, argMOs, restrictions,
                        MissingMemberException,
                        "Can't bind create instance -- " + repr(targetMO)))
         ## restrictions and conversion must be done consistently.
-        callArgs = ConvertArguments(argMOs, res[0].GetParameters())
+        callArgs = ConvertArguments(argMOs, best[1], self.Runtime)
         return DynamicMetaObject(
                    ## Creating an object, so don't need EnsureObjectResult.
-                   Exprs.Expression.New(res[0], callArgs),
+                   Exprs.Expression.New(best[0], callArgs),
                    restrictions)
 
 
 class SymplGetIndexBinder (GetIndexBinder):
+    Runtime = None
+    Rules = 0
+
     #def __new__ (cls, callinfo):
     #    return GetIndexBinder.__new__(cls, callinfo)
 
     def FallbackGetIndex (self, targetMO, argMOs, errorSuggestionMO):
+        self.Rules += 1
         ## Defer if any object has no value so that we evaulate their
         ## Expressions and nest a CallSite for the InvokeMember.
         if not targetMO.HasValue or not all(map(lambda x: x.HasValue, argMOs)):
@@ -1066,7 +1516,7 @@ class SymplGetIndexBinder (GetIndexBinder):
         if isCom:
             return com
         ## Give a good error for Cons.
-        if type(targetMO.Value) is Cons:
+        if isinstance(targetMO.Value, ConsCell):
             if len(argMOs) != 1:
                 return (errorSuggestionMO or
                         CreateThrow(
@@ -1078,16 +1528,21 @@ class SymplGetIndexBinder (GetIndexBinder):
         ## Conversions created in GetIndexExpression must be consistent with
         ## restrictions made in GetTargetArgsRestrictions.
         return DynamicMetaObject(
-                  EnsureObjectResult(GetIndexExpression(targetMO, argMOs)),
+                  EnsureObjectResult(GetIndexExpression(targetMO, argMOs,
+                                                        self.Runtime)),
                   ## False means make type restriction on targetMO.LimitType
                   GetTargetArgsRestrictions(targetMO, argMOs, False))
 
 
 class SymplSetIndexBinder (SetIndexBinder):
+    Runtime = None
+    Rules = 0
+
     #def __new__ (cls, callinfo):
     #    return SetIndexBinder.__new__(cls, callinfo)
 
     def FallbackSetIndex (self, targetMO, argMOs, valueMO, errorSuggestionMO):
+        self.Rules += 1
         ## Defer if any object has no value so that we evaulate their
         ## Expressions and nest a CallSite for the SetIndex.
         if (not targetMO.HasValue or not all(map(lambda x: x.HasValue, argMOs)) or
@@ -1101,9 +1556,10 @@ class SymplSetIndexBinder (SetIndexBinder):
         valueExpr = valueMO.Expression
         if type(valueMO.Value) is TypeModel:  
             ## Don't use LimitType to compare py type objs, use the value.
-            valueExpr = GetRuntimeTypeMoFromModel(valueMO).Expression
+            valueExpr = GetRuntimeTypeMoFromModel(valueMO,
+                                                  self.Runtime).Expression
         ## Check Cons vs. normal
-        if type(targetMO.Value) is Cons:  
+        if isinstance(targetMO.Value, ConsCell):
             ## Don't use LimitType to compare py type objs, use the value.
             if len(argMOs) != 1:
                 return (errorSuggestionMO or
@@ -1114,7 +1570,7 @@ class SymplSetIndexBinder (SetIndexBinder):
             setIndexExpr = (
                 ## In C# can use Expression.Call on methodinfo.
                 Exprs.Expression.Dynamic(
-                    RunHelpersInvokeBinder(CallInfo(3)),
+                    GetRunHelpersInvokeBinder(self.Runtime, 3),
                     object,
                     Exprs.Expression.Constant(RuntimeHelpers.SetConsElt),
                     Exprs.Expression.Convert(targetMO.Expression,
@@ -1125,7 +1581,7 @@ class SymplSetIndexBinder (SetIndexBinder):
                     ## conversions, and it is unnecessarily boxing in python.
                     valueExpr))
         else:
-            indexExpr = GetIndexExpression(targetMO, argMOs)
+            indexExpr = GetIndexExpression(targetMO, argMOs, self.Runtime)
             setIndexExpr = EnsureObjectResult(
                                Exprs.Expression.Assign(indexExpr, valueExpr))
         ## False means make type restriction on targetMO.LimitType
@@ -1133,18 +1589,126 @@ class SymplSetIndexBinder (SetIndexBinder):
         return DynamicMetaObject(setIndexExpr, restrictions)
         
 
+##############
+### Arithmetic
+##############
+
+### BindArithmetic returns an expression computing the op on the values of
+### leftMO and rightMO when they are ints, doubles, or BigIntegers, or None so
+### that the binder falls back to MakeBinary on the LimitTypes.  The expression
+### already has type object, and the caller restricts on both LimitTypes, which
+### is all the expression depends on, so each binder builds one rule per op and
+### pair of types that every site using the binder shares.
+###
+### Int arithmetic works in Int64 and overflows to BigInteger instead of
+### wrapping.  Ints mix with BigIntegers as BigIntegers, and any number mixes
+### with doubles as doubles.  Results come back already boxed; comparisons use
+### two constant boxed bools, and ints from SmallIntMin to SmallIntMax come
+### from a table of boxed ints, so most loop counters do not allocate.
+###
+SmallIntMin = -128
+SmallIntMax = 1023
+
+_smallInts = Array[object](range(SmallIntMin, SmallIntMax + 1))
+
+_arithmeticOps = [Exprs.ExpressionType.Add, Exprs.ExpressionType.Subtract,
+                  Exprs.ExpressionType.Multiply, Exprs.ExpressionType.Divide]
+
+_comparisonOps = [Exprs.ExpressionType.Equal, Exprs.ExpressionType.NotEqual,
+                  Exprs.ExpressionType.LessThan,
+                  Exprs.ExpressionType.LessThanOrEqual,
+                  Exprs.ExpressionType.GreaterThan,
+                  Exprs.ExpressionType.GreaterThanOrEqual]
+
+## Numeric types in the order they widen to.
+_numericTypes = [clr.GetClrType(Int32), clr.GetClrType(BigInteger),
+                 clr.GetClrType(Double)]
+
+def BindArithmetic (op, leftMO, rightMO):
+    if op not in _arithmeticOps and op not in _comparisonOps:
+        return None
+    if (leftMO.LimitType not in _numericTypes or
+        rightMO.LimitType not in _numericTypes):
+        return None
+    typ = _numericTypes[max(_numericTypes.index(leftMO.LimitType),
+                            _numericTypes.index(rightMO.LimitType))]
+    left = _convertNumber(leftMO, typ)
+    right = _convertNumber(rightMO, typ)
+    if op in _comparisonOps:
+        return Exprs.Expression.Condition(
+                   Exprs.Expression.MakeBinary(op, left, right),
+                   Exprs.Expression.Constant(True, object),
+                   Exprs.Expression.Constant(False, object))
+    if typ != clr.GetClrType(Int32):
+        return Exprs.Expression.Convert(
+                   Exprs.Expression.MakeBinary(op, left, right), object)
+    ## Int32 ops cannot overflow Int64, including MinValue / -1.
+    int64 = clr.GetClrType(Int64)
+    return _boxInt64(Exprs.Expression.MakeBinary(
+                         op,
+                         Exprs.Expression.Convert(left, int64),
+                         Exprs.Expression.Convert(right, int64)))
+
+def _convertNumber (mo, typ):
+    expr = Exprs.Expression.Convert(mo.Expression, mo.LimitType)
+    if mo.LimitType != typ:
+        expr = Exprs.Expression.Convert(expr, typ)
+    return expr
+
+### _boxInt64 returns an expression that boxes the Int64 value of expr as an
+### int, using _smallInts when it can, or as a BigInteger when it does not fit.
+###
+def _boxInt64 (expr):
+    int64 = clr.GetClrType(Int64)
+    tmp = Exprs.Expression.Variable(int64, "res")
+    def between (lo, hi):
+        return Exprs.Expression.AndAlso(
+                   Exprs.Expression.GreaterThanOrEqual(
+                       tmp, Exprs.Expression.Constant(Int64(lo))),
+                   Exprs.Expression.LessThanOrEqual(
+                       tmp, Exprs.Expression.Constant(Int64(hi))))
+    return Exprs.Expression.Block(
+               object,
+               [tmp],
+               Exprs.Expression.Assign(tmp, expr),
+               Exprs.Expression.Condition(
+                   between(SmallIntMin, SmallIntMax),
+                   Exprs.Expression.ArrayIndex(
+                       Exprs.Expression.Constant(_smallInts),
+                       Exprs.Expression.Convert(
+                           Exprs.Expression.Subtract(
+                               tmp,
+                               Exprs.Expression.Constant(Int64(SmallIntMin))),
+                           clr.GetClrType(Int32))),
+                   Exprs.Expression.Condition(
+                       between(Int32.MinValue, Int32.MaxValue),
+                       Exprs.Expression.Convert(
+                           Exprs.Expression.Convert(tmp,
+                                                    clr.GetClrType(Int32)),
+                           object),
+                       Exprs.Expression.Convert(
+                           Exprs.Expression.Convert(
+                               tmp, clr.GetClrType(BigInteger)),
+                           object))))
+
 class SymplBinaryOperationBinder (BinaryOperationBinder):
+    Runtime = None
+    Rules = 0
 
     def FallbackBinaryOperation (self, leftMO, rightMO, errorSuggestionMO):
+        self.Rules += 1
         ## Defer if any object has no value so that we evaulate their
         ## Expressions and nest a CallSite for the SetIndex.
         if not leftMO.HasValue or not rightMO.HasValue:
-            self.Defer(leftMO, rightMO)
+            return self.Defer(leftMO, rightMO)
         restrictions = (leftMO.Restrictions.Merge(rightMO.Restrictions)
             .Merge(BindingRestrictions.GetTypeRestriction(
                 leftMO.Expression, leftMO.LimitType))
             .Merge(BindingRestrictions.GetTypeRestriction(
                 rightMO.Expression, rightMO.LimitType)))
+        expr = BindArithmetic(self.Operation, leftMO, rightMO)
+        if expr is not None:
+            return DynamicMetaObject(expr, restrictions)
         return DynamicMetaObject(
             EnsureObjectResult(
               Exprs.Expression.MakeBinary(
@@ -1159,12 +1723,15 @@ class SymplBinaryOperationBinder (BinaryOperationBinder):
 ### without a dynamic node since everything that is not nil or false is true.
 ###
 class SymplUnaryOperationBinder (UnaryOperationBinder):
+    Runtime = None
+    Rules = 0
 
     def FallbackUnaryOperation (self, operandMO, errorSuggestionMO):
+        self.Rules += 1
         ## Defer if any object has no value so that we evaulate their
         ## Expressions and nest a CallSite for the SetIndex.
         if not operandMO.HasValue:
-            self.Defer(operandMO)
+            return self.Defer(operandMO)
         return DynamicMetaObject(
             EnsureObjectResult(
               Exprs.Expression.MakeUnary(
@@ -1179,21 +1746,224 @@ class SymplUnaryOperationBinder (UnaryOperationBinder):
 
 
 
+###################
+### Instrumentation
+###################
+
+### BinderInstrumentation records how Sympl's binders are doing: for each
+### binder, how many times it fell back to bind a rule, the time spent in those
+### Fallback calls, how many of them called Defer, and the distinct tuples of
+### operand LimitTypes it bound rules for (its polymorphism degree).  Since
+### Sympl shares one binder across every site with the same operation and
+### metadata, these are per binder rather than per site; a binder's rules are
+### the rules its sites produced together.
+###
+### A runtime records its binders when its Instrumentation is set to a
+### BinderInstrumentation, and other runtimes are not affected, for example:
+###     s.Instrumentation = runtime.BinderInstrumentation()
+###     ... run Sympl code ...
+###     s.Instrumentation.Report()
+### The Instrumentation must be set before the runtime makes its first
+### binder, since the runtime's binder tables then make binders of
+### instrumented subclasses (see InstrumentedBinderClass).  The plain binder
+### classes do not check for an Instrumentation, so runtimes without one pay
+### nothing.  Records are keyed by binder kind
+### and id so that they do not keep binders alive.  A runtime's binders live
+### as long as its binder tables, so ids are not reused while it records.
+###
+class BinderInstrumentation (object):
+    def __init__ (self):
+        self._lock = thread.allocate_lock()
+        self._records = dict()
+
+    def Reset (self):
+        with self._lock:
+            self._records.clear()
+
+    ### GetStats returns a list of BinderRecords, one per binder that has
+    ### fallen back since the last Reset.
+    ###
+    def GetStats (self):
+        with self._lock:
+            return [r.Copy() for r in self._records.values()]
+
+    ### Report prints the stats totalled per binder kind, with the highest
+    ### polymorphism degree of any binder of the kind, and then the top binders
+    ### by time spent binding, to out or stdout.
+    ###
+    def Report (self, out = None, top = 10):
+        out = out or sys.stdout
+        stats = self.GetStats()
+        kinds = dict()
+        for r in stats:
+            kinds.setdefault(r.Kind, []).append(r)
+        print >> out, "%-16s %7s %9s %7s %9s %5s" % (
+            "binder kind", "binders", "fallbacks", "defers", "ms", "poly")
+        for kind in sorted(kinds):
+            records = kinds[kind]
+            print >> out, "%-16s %7d %9d %7d %9.2f %5d" % (
+                kind, len(records), sum([r.Fallbacks for r in records]),
+                sum([r.Defers for r in records]),
+                sum([r.Seconds for r in records]) * 1000,
+                max([r.Polymorphism for r in records]))
+        stats.sort(key = lambda r: r.Seconds, reverse = True)
+        print >> out, "%-16s %-20s %9s %7s %9s %5s" % (
+            "top binders", "by time", "fallbacks", "defers", "ms", "poly")
+        for r in stats[:top]:
+            print >> out, "%-16s %-20s %9d %7d %9.2f %5d" % (
+                r.Kind, r.Name, r.Fallbacks, r.Defers, r.Seconds * 1000,
+                r.Polymorphism)
+
+    ### Fallback runs the binder's Fallback method fun on args, recording it.
+    ###
+    def Fallback (self, fun, binder, args):
+        start = Stopwatch.GetTimestamp()
+        try:
+            return fun(binder, *args)
+        finally:
+            secs = (float(Stopwatch.GetTimestamp() - start) /
+                    Stopwatch.Frequency)
+            ## The last arg is always the error suggestion.
+            signature = tuple([_limitTypes(a) for a in args[:-1]])
+            with self._lock:
+                r = self._record(binder)
+                r.Fallbacks += 1
+                r.Seconds += secs
+                r.Signatures.add(signature)
+
+    def Defer (self, binder):
+        with self._lock:
+            self._record(binder).Defers += 1
+
+    def _record (self, binder):
+        kind = _binderKind(binder)
+        key = (kind, id(binder))
+        r = self._records.get(key)
+        if r is None:
+            r = BinderRecord(kind, _binderName(binder))
+            self._records[key] = r
+        return r
+
+### BinderRecord holds the counts for one binder.  Signatures holds a tuple of
+### operand LimitTypes for each kind of operands the binder bound rules for.
+###
+class BinderRecord (object):
+    def __init__ (self, kind, name):
+        self.Kind = kind
+        self.Name = name
+        self.Fallbacks = 0
+        self.Defers = 0
+        self.Seconds = 0.0
+        self.Signatures = set()
+
+    @property
+    def Polymorphism (self):
+        return len(self.Signatures)
+
+    def Copy (self):
+        r = BinderRecord(self.Kind, self.Name)
+        r.Fallbacks = self.Fallbacks
+        r.Defers = self.Defers
+        r.Seconds = self.Seconds
+        r.Signatures = set(self.Signatures)
+        return r
+
+### InstrumentedBinderClass returns a subclass of the Sympl binder class cls,
+### with the same name, whose Fallback methods and Defer record to the
+### Instrumentation of the binder's Runtime.  It makes one subclass per class.
+###
+def InstrumentedBinderClass (cls):
+    sub = _instrumentedClasses.get(cls)
+    if sub is None:
+        with _instrumentedClassesLock:
+            sub = _instrumentedClasses.get(cls)
+            if sub is None:
+                members = {"Defer": _instrumentedDefer}
+                for name, fun in cls.__dict__.items():
+                    if name.startswith("Fallback") and callable(fun):
+                        members[name] = _instrumentFallback(fun)
+                sub = type(cls.__name__, (cls,), members)
+                _instrumentedClasses[cls] = sub
+    return sub
+
+_instrumentedClasses = dict()
+_instrumentedClassesLock = thread.allocate_lock()
+
+### _getInstrumentation returns the BinderInstrumentation of binder's Runtime,
+### or None if it has none.
+###
+def _getInstrumentation (binder):
+    runtime = binder.Runtime
+    if runtime is None:
+        return None
+    return runtime.Instrumentation
+
+def _instrumentFallback (fun):
+    def fallback (binder, *args):
+        instrumentation = _getInstrumentation(binder)
+        if instrumentation is None:
+            return fun(binder, *args)
+        return instrumentation.Fallback(fun, binder, args)
+    return fallback
+
+def _instrumentedDefer (binder, *args):
+    instrumentation = _getInstrumentation(binder)
+    if instrumentation is not None:
+        instrumentation.Defer(binder)
+    return DynamicMetaObjectBinder.Defer(binder, *args)
+
+def _binderKind (binder):
+    name = type(binder).__name__
+    if name.startswith("Sympl"):
+        name = name[len("Sympl"):]
+    if name.endswith("Binder"):
+        name = name[:-len("Binder")]
+    return name
+
+def _binderName (binder):
+    for attr in ["Name", "Operation"]:
+        val = getattr(binder, attr, None)
+        if val is not None:
+            return str(val)
+    info = getattr(binder, "CallInfo", None)
+    if info is not None:
+        return "%d args" % info.ArgumentCount
+    return ""
+
+### _limitTypes returns the LimitType of a DynamicMetaObject arg, or a tuple of
+### them for an array of them, with None for MOs that have no value.
+###
+def _limitTypes (arg):
+    if isinstance(arg, DynamicMetaObject):
+        if arg.HasValue:
+            return arg.LimitType
+        return None
+    if arg is None:
+        return None
+    return tuple([_limitTypes(a) for a in arg])
+
+
+
 ###########################
 ### Cons Cells and Symbols
 ###########################
 
+### Symbols and Cons cells use __slots__ and plain attributes rather than
+### properties since quoted data can make a great many of them.
+###
 class Symbol (object):
+    __slots__ = ['Name', 'Value', 'PList']
+
     def __init__ (self, name):
-        self._name = name
-        self._value = None
-        self.Plist = None
+        self.Name = name
+        self.Value = None
+        self.PList = None
 
     ### Need __repr__ to just print name, not <Symbol name>, when Symbols are
     ### inside list structures.
     ###
     def __repr__ (self):
-        return self._name
+        return self.Name
         ## IPy doesn't bind repr for Py printing, and ToString for .NET
         ## printing.  Need to print here like we want for ToString.
         #return "<Symbol " + self.Name + ">"
@@ -1202,31 +1972,15 @@ class Symbol (object):
     ### Otherwise, it prints as internal IPy constructed type.
     ###
     def ToString (self):
-        return self._name
-
-    def _getName (self): return self._name
-    def _setName (self, value):
-        self._name = value
-        return value
-    Name = property(_getName, _setName)
+        return self.Name
 
-    def _getValue (self): return self._value
-    def _setValue (self, value):
-        self._value = value
-        return value
-    Value = property(_getValue, _setValue)
-
-    def _getPlist (self): return self._plist
-    def _setPlist (self, value):
-        self._plist = value
-        return value
-    PList = property(_getPlist, _setPlist)
 
-
-class Cons (object):
-    def __init__ (self, first, rest):
-        self._first = first
-        self._rest = rest
+### ConsCell is the base of Cons and VectorCons, so code checks for lists with
+### isinstance(x, ConsCell).  It has no slots of its own, since each kind of
+### cell keeps First and Rest differently.
+###
+class ConsCell (object):
+    __slots__ = []
 
     ### NOTE: does not handle circularities!
     ###
@@ -1234,50 +1988,131 @@ class Cons (object):
         head = self
         res = "("
         while head is not None:
-            res = res + repr(head._first)
-            if head._rest is None:
+            res = res + repr(head.First)
+            rest = head.Rest
+            if rest is None:
                 head = None
-            elif type(head._rest) is Cons:
-                head = head._rest
+            elif isinstance(rest, ConsCell):
+                head = rest
                 res = res + " "
             else:
-                res = res + " . " + repr(head._rest)
+                res = res + " . " + repr(rest)
                 head = None
         return res + ")"
 
     def ToString (self):
         return self.__repr__()
 
+
+class Cons (ConsCell):
+    __slots__ = ['First', 'Rest']
+
+    def __init__ (self, first, rest):
+        self.First = first
+        self.Rest = rest
+
+    ### In C# this will be internal to the Sympl Runtime, called only by the
+    ### code emitted when analyzing a keyword form invocation for List.
+    ###
+    ### This returns a VectorCons over the elements so that indexing is
+    ### constant time.
+    ###
+    @staticmethod
+    def _List (*elements):
+        if len(elements) == 0: return None
+        return _ConsVector(list(elements)).GetCell(0)
+
+
+### VectorCons is a Cons cell in a list made by Cons._List.  All the cells of
+### the list share a _ConsVector holding the list's items, so RuntimeHelpers
+### can index the list in constant time.  VectorCons cells are only made when
+### code fetches the Rest of a cell, and the same cell comes back each time so
+### that lists compare with Eq as they do with Cons cells.
+###
+### Setting a VectorCons's Rest cuts the cell out of the vector, so from then
+### on its Rest is just the value, and indexing walks the list past the cut.
+###
+class VectorCons (ConsCell):
+    __slots__ = ['_vector', '_index', '_cut', '_rest']
+
+    def __init__ (self, vector, index):
+        self._vector = vector
+        self._index = index
+        self._cut = False
+        self._rest = None
+
     def _getFirst (self):
-        return self._first
+        return self._vector.Items[self._index]
 
     def _setFirst (self, value):
-        self._first = value
+        self._vector.Items[self._index] = value
         return value
 
     First = property(_getFirst, _setFirst)
 
+    ### The next cell never changes unless this one is cut, so keep it in
+    ### _rest.
+    ###
     def _getRest (self):
-        return self._rest
+        rest = self._rest
+        if rest is None and not self._cut:
+            rest = self._vector.GetCell(self._index + 1)
+            self._rest = rest
+        return rest
 
     def _setRest (self, value):
+        if not self._cut:
+            self._cut = True
+            bisect.insort(self._vector.Cuts, self._index)
         self._rest = value
         return value
 
     Rest = property(_getRest, _setRest)
 
-    ### In C# this will be internal to the Sympl Runtime, called only by the
-    ### code emitted when analyzing a keyword form invocation for List.
+### _ConsVector holds the items of a VectorCons list, the cells made so far,
+### and the sorted indexes of cells whose Rest has been set.
+###
+class _ConsVector (object):
+    __slots__ = ['Items', 'Cells', 'Cuts']
+
+    def __init__ (self, items):
+        self.Items = items
+        self.Cells = [None] * len(items)
+        self.Cuts = []
+
+    def GetCell (self, index):
+        if index >= len(self.Items):
+            return None
+        cell = self.Cells[index]
+        if cell is None:
+            cell = VectorCons(self, index)
+            self.Cells[index] = cell
+        return cell
+
+    ### Reaches returns whether taking Rests from the cell at start gets to
+    ### the cell at index end without leaving the vector.
     ###
-    @staticmethod
-    def _List (*elements):
-        if len(elements) == 0: return None
-        head = Cons(elements[0], None)
-        tail = head
-        for elt in elements[1:]:
-            tail.Rest = Cons(elt, None)
-            tail = tail.Rest
-        return head
+    def Reaches (self, start, end):
+        if end >= len(self.Items):
+            return False
+        cuts = self.Cuts
+        if not cuts:
+            return True
+        i = bisect.bisect_left(cuts, start)
+        return i == len(cuts) or cuts[i] >= end
+
+    ### Skip takes up to n Rests from the cell at index start without leaving
+    ### the vector, returning the cell it gets to and how many Rests are left.
+    ###
+    def Skip (self, start, n):
+        if self.Reaches(start, start + n):
+            return (self.GetCell(start + n), 0)
+        ## Go to the last cell before a cut or the end, and take its Rest.
+        last = len(self.Items) - 1
+        i = bisect.bisect_left(self.Cuts, start)
+        if i < len(self.Cuts):
+            last = self.Cuts[i]
+        return (self.GetCell(last).Rest, n - (last - start) - 1)
 
 
 
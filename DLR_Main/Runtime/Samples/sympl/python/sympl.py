@@ -13,6 +13,9 @@ else:
     clr.AddReference("System.Core")
     import System.Linq.Expressions as Exprs
 
+clr.AddReference("Microsoft.Dynamic")
+from Microsoft.Scripting.Generation import CompilerHelpers
+
 from System.Dynamic import (ExpandoObject, IDynamicMetaObjectProvider,
                              DynamicMetaObject, BindingRestrictions, CallInfo)
 from System.Collections.Generic import IEnumerable
@@ -20,72 +23,388 @@ from System.Collections.Generic import IEnumerable
 import runtime
 import parser
 import etgen
+import lexer
+import optimizer
 
 import System.Reflection as refl
 
-from System.IO import StreamReader, Path, StringReader
+from System.IO import (StreamReader, Path, StringReader, File, FileInfo,
+                       MemoryStream)
+from System.Security.Cryptography import SHA1
+from System import BitConverter, Int32
+from System.Runtime.CompilerServices import StrongBox
+from System.Threading import ThreadPool, ManualResetEvent, Interlocked
 
 import System
 
 import thread #Used for locking binders canonicalization tables
+from collections import deque, OrderedDict
+
+
+### LruCache maps keys to values, keeping at most Capacity entries and evicting
+### the least recently used one when full.  Hits, Misses, and Evictions count
+### what happened so that hosts can see how well the cache works.  It is safe
+### to use from multiple threads.
+###
+class LruCache (object):
+    def __init__ (self, capacity):
+        self.Capacity = capacity
+        self.Hits = 0
+        self.Misses = 0
+        self.Evictions = 0
+        self._lock = thread.allocate_lock()
+        ## Map key to value, least recently used first.  Get and Put move an
+        ## entry to the end by removing and adding it again.
+        self._entries = OrderedDict()
+
+    def Get (self, key):
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                self.Misses += 1
+                return None
+            self.Hits += 1
+            self._entries[key] = value
+            return value
+
+    def Put (self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.Capacity:
+                self._entries.popitem(last = False)
+                self.Evictions += 1
+
+    def Clear (self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__ (self):
+        return len(self._entries)
+
+
+### BinderTable canonicalizes one kind of binder, mapping binder metadata to
+### the binder instance for it, which make creates.  Entries are only ever
+### added, and IronPython dicts allow reads while another thread writes, so Get
+### only takes the table's lock to add a binder.  Hits and Misses count
+### lookups, but since reads do not lock, they may miss a few counts when
+### threads race.  Each binder's use count is a StrongBox[int] that Get
+### increments atomically, so Items' counts are exact.
+###
+class BinderTable (object):
+    def __init__ (self, make):
+        self.Hits = 0
+        self.Misses = 0
+        self._make = make
+        self._lock = thread.allocate_lock()
+        self._binders = dict()
+        self._uses = dict()
+
+    def Get (self, key):
+        b = self._binders.get(key)
+        if b is not None:
+            self.Hits += 1
+            _increment(self._uses[key])
+            return b
+        with self._lock:
+            ## Another thread may have added it since we looked.
+            b = self._binders.get(key)
+            if b is not None:
+                self.Hits += 1
+                _increment(self._uses[key])
+                return b
+            self.Misses += 1
+            b = self._make(key)
+            self._uses[key] = StrongBox[int](1)
+            self._binders[key] = b
+        return b
+
+    ### Items returns (key, binder, uses) tuples, where uses counts the Gets
+    ### that returned the binder, which is about how many sites share it.
+    ###
+    def Items (self):
+        with self._lock:
+            return [(k, b, self._uses[k].Value)
+                    for k, b in self._binders.items()]
+
+    def __len__ (self):
+        return len(self._binders)
+
+### _increment atomically adds one to a StrongBox[int]'s Value.  IronPython
+### passes a StrongBox to a ref parameter by copying its Value in and out, so
+### calling Interlocked.Increment directly would not be atomic.  This lambda
+### passes Interlocked.Increment the address of the Value field instead.
+###
+def _makeIncrement ():
+    box = Exprs.Expression.Parameter(StrongBox[int], "box")
+    increment = clr.GetClrType(Interlocked).GetMethod(
+                    "Increment",
+                    System.Array[System.Type](
+                        [clr.GetClrType(Int32).MakeByRefType()]))
+    return Exprs.Expression.Lambda(
+               Exprs.Expression.Call(increment,
+                                     Exprs.Expression.Field(box, "Value")),
+               box).Compile()
+
+_increment = _makeIncrement()
+
+
+### DefunCompiler compiles defun lambdas on thread pool threads while the rest
+### of the file is analyzed, rather than as part of one big module lambda.  It
+### runs at most threads work items at once, each compiling queued defuns
+### until the queue is empty, so files with few defuns use few threads.  Each
+### defun compiles to a factory taking the module lambda's runtime and module
+### parameters (and global slots, if any), so the defun closes over the same
+### runtime and module it would inside the module lambda.  Add returns an
+### expression that calls the factory to make the function.  Call Finish after
+### analyzing the file, and then check Errors before compiling the module
+### lambda.
+###
+class DefunCompiler (object):
+    def __init__ (self, threads):
+        self.Errors = []
+        self._lock = thread.allocate_lock()
+        self._pending = deque()
+        self._threads = threads
+        ## How many work items are running, and an event set when none are.
+        self._running = 0
+        self._idle = ManualResetEvent(True)
+
+    def Add (self, fun, scope):
+        params = [scope.RuntimeExpr, scope.ModuleExpr]
+        if scope.GlobalSlots is not None:
+            params.append(scope.GlobalSlots.Expr)
+        factory = Exprs.Expression.Lambda(
+                      Exprs.Expression.GetFuncType(System.Array[System.Type](
+                          [p.Type for p in params] + [object])),
+                      Exprs.Expression.Convert(fun, object),
+                      *params)
+        box = StrongBox[object]()
+        self._post((factory, box))
+        return Exprs.Expression.Invoke(
+                   Exprs.Expression.Convert(
+                       Exprs.Expression.Field(Exprs.Expression.Constant(box),
+                                              "Value"),
+                       factory.Type),
+                   *params)
+
+    ### Finish waits for all the defuns to compile.
+    ###
+    def Finish (self):
+        self._idle.WaitOne()
+
+    def _post (self, item):
+        with self._lock:
+            self._pending.append(item)
+            start = self._running < self._threads
+            if start:
+                self._running += 1
+                self._idle.Reset()
+        if start:
+            ThreadPool.QueueUserWorkItem(self._work)
+
+    def _work (self, state):
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._running -= 1
+                    if self._running == 0:
+                        self._idle.Set()
+                    return
+                item = self._pending.popleft()
+            factory, box = item
+            try:
+                box.Value = factory.Compile()
+            except Exception, e:
+                with self._lock:
+                    self.Errors.append(e)
 
 
 class Sympl (object):
     def __init__ (self, assms = None):
-        ## Host Globals, also used by reflection of assemblies.
-        self.Globals = ExpandoObject()
+        ## Host Globals, also used by reflection of assemblies.  The Globals
+        ## property adds the assemblies' namespaces the first time it is read.
+        self._globals = ExpandoObject()
+        self._namespacesAdded = False
+        self._namespacesLock = thread.allocate_lock()
         ## Set up assemblies reflection.
         object.__setattr__(
             self, "_assemblies",
             assms or [refl.Assembly.LoadWithPartialName("System"),
                       refl.Assembly.LoadWithPartialName("mscorlib")])
-        self._addNamespacesAndTypes()
         ## Set up Symbols interning table.
         self.Symbols = dict()
         self.Symbols["nil"] = runtime.Symbol("nil")
         self.Symbols["true"] = runtime.Symbol("true")
         self.Symbols["false"] = runtime.Symbol("false")
-        ## Set up binder canonicalization tables.
-        ## Should have lock per table, but this is good enough for smaple.
-        self._lock = thread.allocate_lock()
-        self._getMemberBinders = dict()
-        self._setMemberBinders = dict()
-        self._invokeBinders = dict()
-        self._invokeMemberBinders = dict()
-        self._createInstanceBinders = dict()
-        self._getIndexBinders = dict()
-        self._setIndexBinders = dict()
-        self._binaryOperationBinders = dict()
-        self._unaryOperationBinders = dict()
-
-
-    ### _addNamespacesAndTypes builds a tree of ExpandoObjects representing
-    ### .NET namespaces, with TypeModel objects at the leaves.  Though Sympl is
-    ### case-insensitive, we store the names as they appear in .NET reflection
-    ### in case our globals object or a namespace object gets passed as an IDO
-    ### to another language or library, where they may be looking for names
-    ### case-sensitively using EO's default lookup.
+        ## Set up binder canonicalization tables, each with its own lock.
+        self._getMemberBinders = self._makeBinderTable(
+            runtime.SymplGetMemberBinder)
+        self._setMemberBinders = self._makeBinderTable(
+            runtime.SymplSetMemberBinder)
+        self._invokeBinders = self._makeBinderTable(runtime.SymplInvokeBinder)
+        self._invokeMemberBinders = self._makeBinderTable(
+            runtime.SymplInvokeMemberBinder,
+            lambda cls, info: cls(info.Name, info.Info))
+        self._createInstanceBinders = self._makeBinderTable(
+            runtime.SymplCreateInstanceBinder)
+        self._getIndexBinders = self._makeBinderTable(
+            runtime.SymplGetIndexBinder)
+        self._setIndexBinders = self._makeBinderTable(
+            runtime.SymplSetIndexBinder)
+        self._binaryOperationBinders = self._makeBinderTable(
+            runtime.SymplBinaryOperationBinder)
+        self._unaryOperationBinders = self._makeBinderTable(
+            runtime.SymplUnaryOperationBinder)
+        self._runHelpersInvokeBinders = BinderTable(
+            runtime.RunHelpersInvokeBinder)
+        ## Set up compiled file modules cache.
+        self.CompiledModules = LruCache(self.CompiledModulesSize)
+        self.OptimizerStats = optimizer.OptimizerStats()
+
+    ### _makeBinderTable returns a BinderTable whose binders have this Sympl
+    ### instance as their Runtime, so that the call sites they build while
+    ### binding get their binders from our tables too.  The binders are of
+    ### class cls, or its instrumented subclass if Instrumentation is set, and
+    ### make, if given, makes one from the class and the table key.
+    ###
+    def _makeBinderTable (self, cls, make = None):
+        def makeBinder (key):
+            binderClass = cls
+            if self.Instrumentation is not None:
+                binderClass = runtime.InstrumentedBinderClass(cls)
+            if make is None:
+                b = binderClass(key)
+            else:
+                b = make(binderClass, key)
+            b.Runtime = self
+            return b
+        return BinderTable(makeBinder)
+
+    ### Globals is the ExpandoObject of host globals, which import fetches
+    ### names from.  Making a runtime does not look at the assemblies' types,
+    ### since code that never reads Globals does not need them.  The first
+    ### read adds the namespaces (see _addNamespacesAndTypes).
+    ###
+    def _getGlobals (self):
+        if not self._namespacesAdded:
+            with self._namespacesLock:
+                if not self._namespacesAdded:
+                    self._addNamespacesAndTypes()
+                    self._namespacesAdded = True
+        return self._globals
+    Globals = property(_getGlobals)
+
+    ### _addNamespacesAndTypes adds the top-level .NET namespaces (and any
+    ### types not in a namespace) to Globals, except where the host or
+    ### ExecuteFile has already set the name.  Namespaces are NamespaceModels,
+    ### which make their nested namespaces and TypeModels when code first
+    ### looks them up.  Though Sympl is case-insensitive, we store the names
+    ### as they appear in .NET reflection in case our globals object or a
+    ### namespace object gets passed as an IDO to another language or library,
+    ### where they may be looking for names case-sensitively.
     ###
     def _addNamespacesAndTypes (self):
         helpers = runtime.DynamicObjectHelpers
+        types = []
         for assm in self._assemblies:
-            for typ in assm.GetExportedTypes():
-                names = typ.FullName.split('.')
-                table = self.Globals
-                for ns in names[:-1]:
-                    if helpers.HasMember(table, ns):
-                        table = helpers.GetMember(table, ns)
-                    else:
-                        tmp = ExpandoObject()
-                        helpers.SetMember(table, ns, tmp)
-                        table = tmp
-                helpers.SetMember(table, names[-1], runtime.TypeModel(typ))
+            types.extend([(name, assm) for name in
+                          _getExportedTypeNames(assm,
+                                                self.TypeIndexDirectory)])
+        root = runtime.NamespaceContents("", types)
+        for name in root.GetMemberNames():
+            if not helpers.HasMember(self._globals, name):
+                helpers.SetMember(self._globals, name,
+                                  root.GetMember(name, False))
     
     def __setattr__ (self, name, value):
         if name != "_assemblies":
             object.__setattr__(self, name, value)
         else: raise("Can't set 'Assemblies' after instantiating Sympl.")
 
+    ### TypeIndexDirectory, when not None, names a directory where the runtime
+    ### saves the names of each assembly's exported types, so that runtimes
+    ### in later processes can skip reflecting over the assemblies to build
+    ### Globals.  It must be set on the class before reading Globals.
+    ###
+    TypeIndexDirectory = None
+
+    ### EmitDebugInfo controls whether ExecuteFile adds DebugInfo expressions
+    ### with file, line, and column info to the Expression Trees it compiles.
+    ###
+    EmitDebugInfo = True
+
+    ### CompileThreads, when more than 0, makes ExecuteFile compile each
+    ### top-level defun on its own, using up to that many thread pool threads
+    ### (see DefunCompiler).  This helps load files with many defuns, which are
+    ### slow to compile as one module lambda.
+    ###
+    CompileThreads = 0
+
+    ### SnippetMode controls how ExecuteExpr runs the code it generates.
+    ### "compile" compiles it to IL, which is slow to start but fastest to run.
+    ### "interpret" runs it in the DLR interpreter, which starts quickly but
+    ### runs slower.  "adaptive" interprets it, but the interpreter compiles
+    ### each lambda or loop once it has run CompilationThreshold times.
+    ###
+    SnippetMode = "compile"
+    CompilationThreshold = 32
+
+    ### ResolveGlobals makes code reach module globals through slots that
+    ### etgen.GlobalSlots numbers at analysis time, rather than a dynamic
+    ### member lookup on the module ExpandoObject for every reference.  The
+    ### module object still holds the globals for hosts and other modules.
+    ### It needs .NET 4.
+    ###
+    ResolveGlobals = False
+
+    ### Optimize runs optimizer.Optimize over the ASTs before analyzing them,
+    ### folding constants and pruning branches whose tests are constants, so
+    ### etgen makes fewer dynamic sites.  OptimizerStats on each runtime adds
+    ### up what the optimizer did for code this runtime compiled.
+    ###
+    Optimize = False
+
+    ### TailCalls controls what code does for calls in tail position, that is,
+    ### calls whose value is the value of the function making them.  "none"
+    ### makes them like any call.  "self" makes a defun's tail calls to itself
+    ### jump back to the top of the defun with new arguments, so recursion
+    ### that walks a list runs in a loop without using up the stack.  These
+    ### calls go to the defun being compiled even if code sets the global to
+    ### another function later.  "trampoline" also makes other tail calls to
+    ### function values return a runtime.TailCall for the function making
+    ### them to run, so mutually recursive functions run in constant stack
+    ### too.  Functions still return only values to their callers, so hosts
+    ### and .NET code can call them as usual.  "trampoline" needs .NET 4.
+    ###
+    TailCalls = "none"
+
+    ### CheckFileContents makes ExecuteFile read and hash a file on every load
+    ### instead of trusting an unchanged last write time and length to mean
+    ### the file has not changed (see _getFileKey).
+    ###
+    CheckFileContents = False
+
+    ### Instrumentation is a runtime.BinderInstrumentation recording how the
+    ### binders this instance makes are doing, or None to not record them.
+    ### Set it before running code, since only binders made while it is set
+    ### record.
+    ###
+    Instrumentation = None
+
+    ### ParsedModules caches the ASTs of files ExecuteFile has loaded, and
+    ### CompiledModules caches the compiled module functions.  Both use keys
+    ### made from the file's full path, last write time, length, and content
+    ### hash.  ParsedModules is shared by all Sympl runtimes since ASTs do not
+    ### refer to a runtime and nothing modifies them after parsing.  Each
+    ### runtime has its own CompiledModules since the code refers to the
+    ### runtime's Symbols and binders.  CompiledModulesSize is the capacity for
+    ### new runtimes.
+    ###
+    ParsedModules = LruCache(256)
+    CompiledModulesSize = 64
+
     dbgmodule = None
     dbgASTs = None
     dbgascope = None
@@ -101,48 +420,137 @@ class Sympl (object):
         self.dbgmodule = moduleEO
         self.ExecuteFileInScope(filename, moduleEO)
         globalVar = globalVar or Path.GetFileNameWithoutExtension(filename)
-        runtime.DynamicObjectHelpers.SetMember(self.Globals, globalVar,
+        ## Storing the module does not need the namespaces in Globals.
+        runtime.DynamicObjectHelpers.SetMember(self._globals, globalVar,
                                                moduleEO)
         return moduleEO
     
     ### ExecuteFileInScope executes the file in the given module scope.  This
     ### does NOT store the module scope on Globals.  This function returns
-    ### nothing.
+    ### nothing.  If the file has not changed since this runtime last loaded
+    ### it, this reuses the compiled code from CompiledModules.
     ###
     def ExecuteFileInScope (self, filename, moduleEO):
+        path = Path.GetFullPath(filename)
+        key, data = _getFileKey(path, self.CheckFileContents)
+        runtime.DynamicObjectHelpers.SetMember(moduleEO, "__file__", path)
+        modkey = key + (self.EmitDebugInfo, self.ResolveGlobals,
+                        self.Optimize, self.TailCalls)
+        modulefun = self.CompiledModules.Get(modkey)
+        if modulefun is None:
+            modulefun = self._compileFile(filename, key, data)
+            self.CompiledModules.Put(modkey, modulefun)
+        modulefun(self, moduleEO)
+
+    ### _compileFile returns the compiled module function for the file, getting
+    ### the ASTs from ParsedModules or parsing data (or the file if data is
+    ### None).
+    ###
+    def _compileFile (self, filename, key, data):
+        parsed = self.ParsedModules.Get(key)
+        if parsed is None:
+            if data is None:
+                data = File.ReadAllBytes(key[0])
+            f = StreamReader(MemoryStream(data))
+            try:
+                source = lexer.SourceIndex()
+                ASTs = parser.ParseFile(f, source = source)
+            finally:
+                f.Close()
+            ## Find line starts now so that runtimes sharing the cached
+            ## SourceIndex only read it.
+            source.GetLineColumn(0)
+            parsed = (ASTs, source)
+            self.ParsedModules.Put(key, parsed)
+        ASTs, source = parsed
+        self._checkOptions()
+        if self.Optimize:
+            ASTs = optimizer.Optimize(ASTs, self.OptimizerStats)
+        self.dbgASTs = ASTs
+        if self.EmitDebugInfo:
+            document = Exprs.Expression.SymbolDocument(key[0])
+        else:
+            document = None
+        scope = etgen.AnalysisScope(
+                    None, #parent
+                    filename,
+                    self,
+                    Exprs.Expression.Parameter(Sympl, "symplRuntime"),
+                    Exprs.Expression.Parameter(ExpandoObject, "fileModule"),
+                    document,
+                    source)
+        if self.ResolveGlobals:
+            scope.GlobalSlots = etgen.GlobalSlots()
+        self.dbgascope = scope
+        compiler = None
+        if self.CompileThreads > 0:
+            compiler = DefunCompiler(self.CompileThreads)
+            scope.DefunCompiler = compiler
         try:
-            f = StreamReader(filename)
-            runtime.DynamicObjectHelpers.SetMember(moduleEO, "__file__", 
-                                                   Path.GetFullPath(filename))
-            ASTs = parser.ParseFile(f)
-            self.dbgASTs = ASTs
-            scope = etgen.AnalysisScope(
-                        None, #parent
-                        filename,
-                        self,
-                        Exprs.Expression.Parameter(Sympl, "symplRuntime"),
-                        Exprs.Expression.Parameter(ExpandoObject, "fileModule"))
-            self.dbgascope = scope
-            body = []
-            self.dbgbody = body
-            for e in ASTs:
-                body.append(etgen.AnalyzeExpr(e, scope))
-            ## Use ftype with void return so that lambda ignores body result.
-            ftype = Exprs.Expression.GetActionType(System.Array[System.Type](
-                                                      [Sympl, ExpandoObject]))
-            ## Due to .NET 4.0 co/contra-variance, IPy's binding isn't picking
-            ## the overload with just IEnumerable<Expr>, so pick it explicitly.
-            body = Exprs.Expression.Block.Overloads[IEnumerable[Exprs.Expression]](body)
-            modulefun = Exprs.Expression.Lambda(ftype, body, scope.RuntimeExpr,
-                                                scope.ModuleExpr)
-            dbgmodfun = modulefun
-            modulefun.Compile()(self, moduleEO)
+            body = etgen.AnalyzeBody(ASTs, scope)
         finally:
-            f.Close()
+            if compiler is not None:
+                compiler.Finish()
+        if compiler is not None and compiler.Errors:
+            raise compiler.Errors[0]
+        body = etgen.AddGlobalSlots(body, scope)
+        self.dbgbody = body
+        ## Use ftype with void return so that lambda ignores body result.
+        ftype = Exprs.Expression.GetActionType(System.Array[System.Type](
+                                                  [Sympl, ExpandoObject]))
+        ## Due to .NET 4.0 co/contra-variance, IPy's binding isn't picking
+        ## the overload with just IEnumerable<Expr>, so pick it explicitly.
+        body = Exprs.Expression.Block.Overloads[IEnumerable[Exprs.Expression]](body)
+        modulefun = Exprs.Expression.Lambda(ftype, body, scope.RuntimeExpr,
+                                            scope.ModuleExpr)
+        dbgmodfun = modulefun
+        return modulefun.Compile()
         
     def ExecuteExpr (self, expr_str, moduleEO):
         f = StringReader(expr_str)
-        ASTs = parser.ParseExpr(f)
+        return self.ExecuteParsedExpr(parser.ParseExpr(f), moduleEO)
+
+    ### ExecuteStream executes the top-level expressions read from reader (a
+    ### TextReader, such as Console.In) in moduleEO, each as soon as the text
+    ### read so far completes it, and returns the value of the last one.  It
+    ### reads chunkSize chars at a time, handing them to a
+    ### parser.IncrementalParser, so it never holds more of the input than the
+    ### chunk and the expression in progress.  Each expression runs before
+    ### the next is parsed, so the ones before a syntax error run.
+    ###
+    def ExecuteStream (self, reader, moduleEO, chunkSize = 4096):
+        incremental = parser.IncrementalParser()
+        buffer = System.Array.CreateInstance(System.Char, chunkSize)
+        res = None
+        while True:
+            count = reader.Read(buffer, 0, chunkSize)
+            final = count == 0
+            if not final:
+                incremental.Feed(System.String(buffer, 0, count))
+            for ast in incremental.GetExprs(final):
+                res = self.ExecuteParsedExpr(ast, moduleEO)
+            if final:
+                return res
+
+    ### _checkOptions raises if the runtime's options need .NET 4 and this is
+    ### .NET 3.5.  ResolveGlobals and trampolining keep per module and per
+    ### function state in ConditionalWeakTables, and with a plain table on 3.5
+    ### every module and function compiled with them would never be freed.
+    ###
+    def _checkOptions (self):
+        if clr.use35 and (self.ResolveGlobals or
+                          self.TailCalls == "trampoline"):
+            raise Exception("ResolveGlobals and TailCalls = 'trampoline' " +
+                            "need .NET 4.")
+
+    ### ExecuteParsedExpr compiles and runs the top-level SymplExpr in
+    ### moduleEO, returning its value, for hosts that parse with
+    ### parser.IncrementalParser themselves.
+    ###
+    def ExecuteParsedExpr (self, ASTs, moduleEO):
+        self._checkOptions()
+        if self.Optimize:
+            ASTs = optimizer.OptimizeExpr(ASTs, self.OptimizerStats)
         self.dbgASTs = ASTs
         scope = etgen.AnalysisScope(
                     None, #parent
@@ -150,9 +558,12 @@ class Sympl (object):
                     self,
                     Exprs.Expression.Parameter(Sympl, "symplRuntime"),
                     Exprs.Expression.Parameter(ExpandoObject, "fileModule"))
+        if self.ResolveGlobals:
+            scope.GlobalSlots = etgen.GlobalSlots()
         self.dbgascope = scope
         body = [Exprs.Expression.Convert(etgen.AnalyzeExpr(ASTs, scope),
                                          object)]
+        body = etgen.AddGlobalSlots(body, scope)
         #body = [etgen.AnalyzeExpr(ASTs, scope)]
         self.dbgbody = body
         ftype = Exprs.Expression.GetFuncType(
@@ -164,7 +575,19 @@ class Sympl (object):
         fun = Exprs.Expression.Lambda(ftype, body, scope.RuntimeExpr,
                                       scope.ModuleExpr)
         dbgmodfun = fun
-        return fun.Compile()(self, moduleEO)
+        return self._compileSnippet(fun)(self, moduleEO)
+
+    def _compileSnippet (self, fun):
+        mode = self.SnippetMode
+        if mode == "compile":
+            return fun.Compile()
+        elif mode == "interpret":
+            ## The interpreter counts down from the threshold to compile.
+            return CompilerHelpers.LightCompile(fun, Int32.MaxValue)
+        elif mode == "adaptive":
+            return CompilerHelpers.LightCompile(fun, self.CompilationThreshold)
+        else:
+            raise Exception("Unknown SnippetMode -- " + repr(mode))
     
     def CreateScope (self):
         return ExpandoObject()
@@ -200,83 +623,134 @@ class Sympl (object):
         ## in case some DynamicMetaObject ignores ignoreCase.  This makes
         ## some interop cases work, but the cost is that if a Sympl program
         ## spells ".foo" and ".Foo" at different sites, they won't share rules.
-        with self._lock:
-            if self._getMemberBinders.ContainsKey(name):
-                return self._getMemberBinders[name]
-            b = runtime.SymplGetMemberBinder(name)
-            self._getMemberBinders[name] = b
-        return b
+        return self._getMemberBinders.Get(name)
     
     def GetSetMemberBinder (self, name):
         ## Don't lower the name.  Sympl is case-preserving in the metadata
         ## in case some DynamicMetaObject ignores ignoreCase.  This makes
         ## some interop cases work, but the cost is that if a Sympl program
         ## spells ".foo" and ".Foo" at different sites, they won't share rules.
-        with self._lock:
-            if self._setMemberBinders.ContainsKey(name):
-                return self._setMemberBinders[name]
-            b = runtime.SymplSetMemberBinder(name)
-            self._setMemberBinders[name] = b
-        return b
+        return self._setMemberBinders.Get(name)
 
     def GetInvokeBinder (self, info):
-        with self._lock:
-            if self._invokeBinders.ContainsKey(info):
-                return self._invokeBinders[info]
-            b = runtime.SymplInvokeBinder(info)
-            self._invokeBinders[info] = b
-        return b
+        return self._invokeBinders.Get(info)
     
     def GetInvokeMemberBinder (self, info):
-        with self._lock:
-            if self._invokeMemberBinders.ContainsKey(info):
-                return self._invokeMemberBinders[info]
-            b = runtime.SymplInvokeMemberBinder(info.Name, info.Info)
-            self._invokeMemberBinders[info] = b
-        return b
+        return self._invokeMemberBinders.Get(info)
         
     def GetCreateInstanceBinder (self, info):
-        with self._lock:
-            if self._createInstanceBinders.ContainsKey(info):
-                return self._createInstanceBinders[info]
-            b = runtime.SymplCreateInstanceBinder(info)
-            self._createInstanceBinders[info] = b
-        return b
+        return self._createInstanceBinders.Get(info)
     
     def GetGetIndexBinder (self, info):
-        with self._lock:
-            if self._getIndexBinders.ContainsKey(info):
-                return self._getIndexBinders[info]
-            b = runtime.SymplGetIndexBinder(info)
-            self._getIndexBinders[info] = b
-        return b
+        return self._getIndexBinders.Get(info)
     
     def GetSetIndexBinder (self, info):
-        with self._lock:
-            if self._setIndexBinders.ContainsKey(info):
-                return self._setIndexBinders[info]
-            b = runtime.SymplSetIndexBinder(info)
-            self._setIndexBinders[info] = b
-        return b
+        return self._setIndexBinders.Get(info)
     
     def GetBinaryOperationBinder (self, op):
-        with self._lock:
-            if self._binaryOperationBinders.ContainsKey(op):
-                return self._binaryOperationBinders[op]
-            b = runtime.SymplBinaryOperationBinder(op)
-            self._binaryOperationBinders[op] = b
-        return b
+        return self._binaryOperationBinders.Get(op)
     
     def GetUnaryOperationBinder (self, op):
-        with self._lock:
-            if self._unaryOperationBinders.ContainsKey(op):
-                return self._unaryOperationBinders[op]
-            b = runtime.SymplUnaryOperationBinder(op)
-            self._unaryOperationBinders[op] = b
-        return b
+        return self._unaryOperationBinders.Get(op)
+
+    ### GetRunHelpersInvokeBinder returns the binder for the sites the runtime
+    ### uses to call its Python helpers, such as SymplEq and GetConsElt.
+    ###
+    def GetRunHelpersInvokeBinder (self, info):
+        return self._runHelpersInvokeBinders.Get(info)
+
+    ### GetBinderStats returns a list of (kind, binders, hits, misses) tuples
+    ### for the binder canonicalization tables.
+    ###
+    def GetBinderStats (self):
+        return [(kind, len(table), table.Hits, table.Misses)
+                for kind, table in self._binderTables()]
+
+    ### GetRuleStats returns a list of (kind, key, sites, rules) tuples, one
+    ### per canonical binder, where sites is about how many call sites use the
+    ### binder, and rules is how many times the binder had to bind a rule (see
+    ### runtime's General Runtime Binders).  When rules stays well below sites
+    ### in a large program, its sites are reusing rules from the binder's L2
+    ### cache.  The runtime helper binders do no binding of their own, so they
+    ### report None for rules.
+    ###
+    def GetRuleStats (self):
+        return [(kind, key, uses, getattr(binder, "Rules", None))
+                for kind, table in self._binderTables()
+                for key, binder, uses in table.Items()]
+
+    def _binderTables (self):
+        return [("GetMember", self._getMemberBinders),
+                ("SetMember", self._setMemberBinders),
+                ("Invoke", self._invokeBinders),
+                ("InvokeMember", self._invokeMemberBinders),
+                ("CreateInstance", self._createInstanceBinders),
+                ("GetIndex", self._getIndexBinders),
+                ("SetIndex", self._setIndexBinders),
+                ("BinaryOperation", self._binaryOperationBinders),
+                ("UnaryOperation", self._unaryOperationBinders),
+                ("RunHelpersInvoke", self._runHelpersInvokeBinders)]
   
     
 
+### _getFileKey returns the module cache key for the file at the full path,
+### and the file's contents if it had to read them.  To avoid reading and
+### hashing files that have not changed, we remember the hash for each path
+### along with the last write time and length we computed it for.  This
+### assumes a rewrite changes the last write time or the length; a rewrite
+### with the same length in the same tick of the file system's clock (which
+### can be seconds on some file systems, or kept by copy tools) reuses the
+### old code.  Set Sympl.CheckFileContents to hash the file on every load.
+###
+def _getFileKey (path, checkContents = False):
+    info = FileInfo(path)
+    stamp = (info.LastWriteTimeUtc.Ticks, info.Length)
+    if not checkContents:
+        with _fileHashesLock:
+            known = _fileHashes.get(path)
+        if known is not None and known[0] == stamp:
+            return ((path, stamp, known[1]), None)
+    data = File.ReadAllBytes(path)
+    digest = BitConverter.ToString(SHA1.Create().ComputeHash(data))
+    with _fileHashesLock:
+        _fileHashes[path] = (stamp, digest)
+    return ((path, stamp, digest), data)
+
+_fileHashes = dict()
+_fileHashesLock = thread.allocate_lock()
+
+### _getExportedTypeNames returns the full names of the assembly's exported
+### types.  If directory is not None, this first looks there for a file of the
+### names saved for this build of the assembly (by module version id), and
+### saves the names there if there is no file.  Errors reading or writing the
+### file just mean we use reflection.
+###
+def _getExportedTypeNames (assm, directory):
+    filename = None
+    if directory is not None:
+        filename = Path.Combine(directory,
+                                "%s.%s.types" % (
+                                    assm.GetName().Name,
+                                    assm.ManifestModule.ModuleVersionId))
+        try:
+            if File.Exists(filename):
+                return list(File.ReadAllLines(filename))
+        except System.IO.IOException:
+            pass
+    names = [typ.FullName for typ in assm.GetExportedTypes()]
+    if filename is not None:
+        ## Write then move the file so that other processes never read part.
+        tmpname = filename + "." + str(System.Guid.NewGuid())
+        try:
+            File.WriteAllLines(tmpname, System.Array[str](names))
+            File.Move(tmpname, filename)
+        except (System.IO.IOException, System.UnauthorizedAccessException):
+            if File.Exists(tmpname):
+                File.Delete(tmpname)
+    return names
+
+
+
 ##################
 ### Dev-time Utils
 ##################
@@ -6,18 +6,43 @@ feo = s.ExecuteFile(r"..\examples\test.sympl")
 print "ExecuteExpr ... ",
 s.ExecuteExpr("(print 5)", feo)
 
+### Functions compiled with trampolining return values, not TailCalls, to the
+### host, whether it calls them directly or through the delegate.
+###
+print "Trampolined calls from host ... ",
+t = sympl.Sympl()
+t.TailCalls = "trampoline"
+tmod = t.CreateScope()
+t.ExecuteExpr("(defun evenp (n) (if (= n 0) true (oddp (- n 1))))", tmod)
+t.ExecuteExpr("(defun oddp (n) (if (= n 0) false (evenp (- n 1))))", tmod)
+evenp = sympl.runtime.DynamicObjectHelpers.GetMember(tmod, "evenp")
+results = [evenp(100000), evenp.DynamicInvoke(100001),
+           t.ExecuteExpr("(oddp 100001)", tmod)]
+print results
+if results != [True, False, True]:
+    raise Exception("Trampolined calls returned " + repr(results))
+
 import sys
 
 if "norepl" in sys.argv: sys.exit(0)
 
-### Quicky REPL
-###
 import clr
 from System import Console
-from System.IO import StringReader
 
+### With "stream", run the program piped to stdin, for example:
+###     ipy test.py stream < program.sympl
+###
+if "stream" in sys.argv:
+    s.ExecuteStream(Console.In, feo)
+    sys.exit(0)
+
+### Quicky REPL
+###
+### The IncrementalParser keeps what it has scanned of an expression that
+### spans lines, so each line is only scanned once.
+###
 input = None
-exprstr = ""
+incremental = sympl.parser.IncrementalParser()
 prompt = ">>> "
 print "\n"*3
 print "Enter expressions.  Enter blank line to abort input."
@@ -26,27 +51,29 @@ print "\n"
 while True:
     print prompt,
     input = Console.ReadLine()
+    if input is None: break
     if (input == ""):
-        exprstr = ""
+        incremental.Reset()
         prompt = ">>> "
         continue
-    else:
-        exprstr = exprstr + " " + input
     ## See if we have complete input.
-    try:
-        sympl.parser.ParseExpr(StringReader(exprstr))
-    except Exception, e:
+    status = incremental.Feed(input + "\n")
+    if status == "incomplete":
         prompt = "... "
         continue
+    elif status == "empty":
+        continue
     ## We do, so execute.
     try:
-        res = s.ExecuteExpr(exprstr, feo)
-        exprstr = ""
         prompt = ">>> "
+        res = None
+        for e in incremental.GetExprs(True):
+            res = s.ExecuteParsedExpr(e, feo)
+            if res is s.MakeSymbol("exit"): break
+            print res
         if res is s.MakeSymbol("exit"): break
-        print res
     except Exception, e:
-        exprstr = ""
+        incremental.Reset()
         prompt = ">>> "
         Console.Write("ERROR: ");
         Console.WriteLine(e);